@@ -0,0 +1,309 @@
+"""
+AnyOCRAdmission.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Admission control in front of the upstream GPT-4V calls: a bounded number of calls in flight,
+a bounded wait queue shared fairly between clients, and fast rejection when the queue is full.
+Waiting calls are split into priority lanes (e.g. interactive and bulk), dequeued by weight, with a
+bound on how long a lower lane can be starved. A call fanning out to several concurrent upstream calls
+(tiles, pages, packs, prompts) holds one slot per concurrent upstream call.
+"""
+
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+OCR_ADMISSION_DEFAULT_MAX_IN_FLIGHT = 8
+OCR_ADMISSION_DEFAULT_MAX_QUEUE = 32
+# Number of recent queue waits kept for percentiles
+OCR_ADMISSION_WAIT_SAMPLES = 1000
+# Priority lanes, highest first, with their dequeue weights. A lane with weight 0 is only served when
+# no weighted lane is waiting (strict priority), or when its oldest waiter passed the starvation bound.
+OCR_ADMISSION_DEFAULT_LANES = {"interactive": 1, "bulk": 0}
+OCR_ADMISSION_DEFAULT_MAX_STARVATION_SECONDS = 30.0
+
+
+class AnyOCRAdmissionRejected(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Service is busy, retry after {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class AnyOCRWaitStats:
+    # Admitted/rejected calls and their queue waits (average, percentiles of recent waits, max)
+
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self._wait_samples = deque(maxlen=OCR_ADMISSION_WAIT_SAMPLES)
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def record(self, wait_seconds: float):
+        self.admitted += 1
+        self._wait_samples.append(wait_seconds)
+        self._wait_total += wait_seconds
+        self._wait_max = max(self._wait_max, wait_seconds)
+
+    def stats(self) -> dict:
+        samples = sorted(self._wait_samples)
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_wait_avg": self._wait_total / self.admitted if self.admitted else 0.0,
+            "queue_wait_p50": samples[len(samples) // 2] if samples else 0.0,
+            "queue_wait_p95": samples[int(len(samples) * 0.95)] if samples else 0.0,
+            "queue_wait_max": self._wait_max,
+        }
+
+
+class AnyOCRAdmissionController:
+    """
+    Bounded in-flight limit and bounded wait queue for one event loop.
+    Free slots go to the priority lanes by smooth weighted round-robin over the lanes with waiters
+    (ties to the higher lane); a lane with weight 0 only gets them when no weighted lane is waiting,
+    unless its oldest waiter has waited max_starvation_seconds. Within a lane, waiting clients are
+    served round-robin. A waiter needing more slots than are free holds up the ones behind it, so calls
+    taking several slots aren't overtaken forever. When the queue is full, a newcomer takes the place of the newest waiter of a
+    lower lane, or else of the client holding the most slots in its own lane, so a single batch caller
+    can't starve interactive users.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = OCR_ADMISSION_DEFAULT_MAX_IN_FLIGHT,
+        max_queue: int = OCR_ADMISSION_DEFAULT_MAX_QUEUE,
+        lanes: dict | None = None,
+        max_starvation_seconds: float | None = OCR_ADMISSION_DEFAULT_MAX_STARVATION_SECONDS,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        # Lane name -> weight, highest priority first
+        self.lanes = dict(lanes or OCR_ADMISSION_DEFAULT_LANES)
+        self.max_starvation_seconds = max_starvation_seconds
+
+        self.in_flight = 0
+        # lane -> client_id -> deque of waiting futures, in round-robin order
+        self._waiters = {lane: OrderedDict() for lane in self.lanes}
+        self._queued = 0
+        # waiting future -> time.monotonic() it was queued, for the starvation bound
+        self._queued_at = {}
+        # waiting future -> number of slots it needs
+        self._waiter_slots = {}
+        # Smooth weighted round-robin state per lane
+        self._lane_credit = {lane: 0 for lane in self.lanes}
+
+        # Moving average of how long an admitted call holds its slot, for Retry-After
+        self._avg_service_seconds = 5.0
+
+        self._wait_stats = AnyOCRWaitStats()
+        self._lane_wait_stats = {lane: AnyOCRWaitStats() for lane in self.lanes}
+        # Waiters served ahead of higher lanes because they reached the starvation bound
+        self._lane_promoted = {lane: 0 for lane in self.lanes}
+
+    @property
+    def admitted(self) -> int:
+        return self._wait_stats.admitted
+
+    @property
+    def rejected(self) -> int:
+        return self._wait_stats.rejected
+
+    @property
+    def default_lane(self) -> str:
+        return next(iter(self.lanes))
+
+    @asynccontextmanager
+    async def admit(self, client_id: str, lane: str | None = None, slots: int = 1):
+        slots = await self.acquire(client_id, lane, slots)
+        start_time = time.monotonic()
+        try:
+            yield slots
+        finally:
+            self._avg_service_seconds = 0.9 * self._avg_service_seconds + 0.1 * (time.monotonic() - start_time)
+            self.release(slots)
+
+    def slots_for(self, slots: int) -> int:
+        # A call never needs more slots than there are
+        return max(1, min(slots, self.max_in_flight))
+
+    async def acquire(self, client_id: str, lane: str | None = None, slots: int = 1) -> int:
+        """
+        Wait for in-flight slots (one per concurrent upstream call, up to max_in_flight) in the given priority
+        lane (the highest by default). Returns the number of slots held, to release(), or raises
+        AnyOCRAdmissionRejected when the queue is full.
+        """
+        if lane is None:
+            lane = self.default_lane
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown priority lane {lane}, use one of {', '.join(self.lanes)}")
+        slots = self.slots_for(slots)
+
+        if self.in_flight + slots <= self.max_in_flight and self._queued == 0:
+            self.in_flight += slots
+            self._record_admitted(lane, 0.0)
+            return slots
+
+        if self._queued >= self.max_queue:
+            self._make_room_for(client_id, lane)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].setdefault(client_id, deque()).append(waiter)
+        self._queued += 1
+
+        start_time = time.monotonic()
+        self._queued_at[waiter] = start_time
+        self._waiter_slots[waiter] = slots
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slots were handed over just as the caller went away
+                self.release(slots)
+            else:
+                self._remove_waiter(lane, client_id, waiter)
+            raise
+        except AnyOCRAdmissionRejected:
+            self._record_rejected(lane)
+            raise
+
+        wait_seconds = time.monotonic() - start_time
+        self._record_admitted(lane, wait_seconds)
+        return slots
+
+    def release(self, slots: int = 1):
+        self.in_flight -= slots
+        self._dispatch()
+
+    def _dispatch(self):
+        # Hand free slots to the next lane, and within it to waiting clients, one waiter per client in turn
+        while self.in_flight < self.max_in_flight and self._queued > 0:
+            lane_credit = dict(self._lane_credit)
+            lane_promoted = dict(self._lane_promoted)
+            lane_waiters = self._waiters[self._next_lane()]
+            client_id, waiters = next(iter(lane_waiters.items()))
+            if self.in_flight + self._waiter_slots[waiters[0]] > self.max_in_flight:
+                # Not yet: the same waiter is picked again once enough slots are released
+                self._lane_credit = lane_credit
+                self._lane_promoted = lane_promoted
+                return
+
+            waiter = waiters.popleft()
+            self._queued -= 1
+            self._queued_at.pop(waiter, None)
+            slots = self._waiter_slots.pop(waiter)
+            if waiters:
+                lane_waiters.move_to_end(client_id)
+            else:
+                del lane_waiters[client_id]
+
+            if not waiter.done():
+                self.in_flight += slots
+                waiter.set_result(True)
+
+    def _next_lane(self) -> str:
+        waiting_lanes = [lane for lane in self.lanes if self._waiters[lane]]
+
+        # The longest-starved lane past the bound goes first
+        if self.max_starvation_seconds is not None:
+            now = time.monotonic()
+            starved = [
+                (now - self._oldest_queued_at(lane), lane) for lane in waiting_lanes[1:]
+                if now - self._oldest_queued_at(lane) >= self.max_starvation_seconds
+            ]
+            if starved:
+                lane = max(starved)[1]
+                self._lane_promoted[lane] += 1
+                return lane
+
+        # Smooth weighted round-robin over the weighted lanes, falling back to the highest waiting lane
+        weighted_lanes = [lane for lane in waiting_lanes if self.lanes[lane] > 0]
+        if not weighted_lanes:
+            return waiting_lanes[0]
+        for lane in weighted_lanes:
+            self._lane_credit[lane] += self.lanes[lane]
+        lane = max(weighted_lanes, key=lambda waiting_lane: self._lane_credit[waiting_lane])
+        self._lane_credit[lane] -= sum(self.lanes[waiting_lane] for waiting_lane in weighted_lanes)
+        return lane
+
+    def _oldest_queued_at(self, lane: str) -> float:
+        # Waiters of a client are queued in order, so the oldest is at the head of one of them
+        return min(self._queued_at[waiters[0]] for waiters in self._waiters[lane].values())
+
+    def _make_room_for(self, client_id: str, lane: str):
+        # Reject the newest waiter of the heaviest client of the lowest lane below this one, or of this lane
+        # if that client holds more than its share
+        lane_index = list(self.lanes).index(lane)
+        for lower_lane in reversed(list(self.lanes)[lane_index + 1:]):
+            if self._waiters[lower_lane]:
+                self._evict_newest(lower_lane, max(self._waiters[lower_lane], key=lambda waiting_id: len(self._waiters[lower_lane][waiting_id])))
+                return
+
+        lane_waiters = self._waiters[lane]
+        if not lane_waiters:
+            self._record_rejected(lane)
+            raise AnyOCRAdmissionRejected(self.retry_after())
+
+        heaviest_id = max(lane_waiters, key=lambda waiting_id: len(lane_waiters[waiting_id]))
+        own_count = len(lane_waiters.get(client_id, ()))
+        if heaviest_id == client_id or len(lane_waiters[heaviest_id]) <= own_count + 1:
+            self._record_rejected(lane)
+            raise AnyOCRAdmissionRejected(self.retry_after())
+
+        self._evict_newest(lane, heaviest_id)
+
+    def _evict_newest(self, lane: str, client_id: str):
+        waiters = self._waiters[lane][client_id]
+        evicted = waiters.pop()
+        if not waiters:
+            del self._waiters[lane][client_id]
+        self._queued -= 1
+        self._queued_at.pop(evicted, None)
+        self._waiter_slots.pop(evicted, None)
+        evicted.set_exception(AnyOCRAdmissionRejected(self.retry_after()))
+
+    def _remove_waiter(self, lane: str, client_id: str, waiter):
+        waiters = self._waiters[lane].get(client_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            self._queued_at.pop(waiter, None)
+            self._waiter_slots.pop(waiter, None)
+            if not waiters:
+                del self._waiters[lane][client_id]
+
+    def _record_admitted(self, lane: str, wait_seconds: float):
+        self._wait_stats.record(wait_seconds)
+        self._lane_wait_stats[lane].record(wait_seconds)
+
+    def _record_rejected(self, lane: str):
+        self._wait_stats.rejected += 1
+        self._lane_wait_stats[lane].rejected += 1
+
+    def retry_after(self) -> int:
+        # Time until the queue ahead would drain, in whole seconds
+        drain_seconds = self._avg_service_seconds * (self._queued + 1) / max(1, self.max_in_flight)
+        return max(1, min(60, math.ceil(drain_seconds)))
+
+    def stats(self) -> dict:
+        lanes = {}
+        for lane, lane_waiters in self._waiters.items():
+            lanes[lane] = {
+                "queued": sum(len(waiters) for waiters in lane_waiters.values()),
+                "queued_clients": len(lane_waiters),
+                **self._lane_wait_stats[lane].stats(),
+                "promoted": self._lane_promoted[lane],
+            }
+        return {
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "queued_clients": sum(lane["queued_clients"] for lane in lanes.values()),
+            **self._wait_stats.stats(),
+            "lanes": lanes,
+        }
+
+    def __repr__(self):
+        return f"<AnyOCRAdmissionController in_flight={self.in_flight}/{self.max_in_flight} queued={self._queued}/{self.max_queue}>"
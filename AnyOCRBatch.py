@@ -0,0 +1,243 @@
+"""
+AnyOCRBatch.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Offline bulk mode: turn a set of images plus a prompt template into Batch API
+compatible JSONL request files, and ingest the batch result JSONL back into
+per-image parsed outputs and token usage.
+
+Usage:
+    python AnyOCRBatch.py emit -p prompt_json_toll.md -o batch/ images/*.jpg
+    python AnyOCRBatch.py ingest -m batch/manifest.json batch_output.jsonl
+    python AnyOCRBatch.py ingest -m batch/manifest.json --sink results.parquet batch_output.jsonl
+"""
+
+import os
+import json
+import hashlib
+import logging
+import argparse
+from types import SimpleNamespace
+
+from AnyOCREngine import AnyOCREngine, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode
+
+# Batch API limits per input file
+OCR_BATCH_MAX_LINES = 50000
+OCR_BATCH_MAX_FILE_BYTES = 100 * 1024 * 1024
+OCR_BATCH_ENDPOINT_URL = "/chat/completions"
+# Batch API requests are billed at half of the synchronous price
+OCR_BATCH_COST_RATIO = 0.5
+
+OCR_BATCH_MANIFEST_FILENAME = "manifest.json"
+
+
+def make_custom_id(index: int, img_url: str) -> str:
+    return f"{index:06d}-{hashlib.sha1(img_url.encode('utf-8')).hexdigest()[:12]}"
+
+
+def build_batch_request(
+    engine: AnyOCREngine,
+    custom_id: str,
+    img_src: str,
+    user_message: str | None,
+    img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+    max_tokens: int = 4096,
+    temperature: float = 0.2,
+) -> dict:
+    # Same messages as AnyOCREngine.recognize(). Azure AI Vision enhancements are not available in batch.
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": OCR_BATCH_ENDPOINT_URL,
+        "body": {
+            "model": engine.azure_deployment_name,
+            "messages": engine.build_messages(user_message, img_src, img_detail_level),
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        },
+    }
+
+
+def write_batch_files(
+    engine: AnyOCREngine,
+    img_urls: list,
+    user_message: str | None,
+    out_dir: str,
+    img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+    max_tokens: int = 4096,
+    temperature: float = 0.2,
+    max_lines: int = OCR_BATCH_MAX_LINES,
+    max_file_bytes: int = OCR_BATCH_MAX_FILE_BYTES,
+    file_prefix: str = "batch_input",
+) -> list:
+    """
+    Write Batch API request files for the given images into out_dir, starting a new file whenever
+    max_lines or max_file_bytes would be exceeded. Images are loaded one at a time, so memory stays bounded.
+    A manifest mapping each custom_id to its image is written next to the files.
+    Returns the list of written request file paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    file_paths = []
+    manifest = {}
+    out_file = None
+    file_lines = 0
+    file_bytes = 0
+
+    try:
+        for index, img_url in enumerate(img_urls):
+            custom_id = make_custom_id(index, img_url)
+            img_src = AnyOCREngine.load_image(img_url)
+            request_line = json.dumps(
+                build_batch_request(engine, custom_id, img_src, user_message, img_detail_level, max_tokens, temperature),
+                ensure_ascii=False,
+            ) + "\n"
+            line_bytes = len(request_line.encode("utf-8"))
+            if line_bytes > max_file_bytes:
+                raise ValueError(f"Request for {img_url} is larger than the batch file size limit ({max_file_bytes} bytes).")
+
+            if out_file is None or file_lines + 1 > max_lines or file_bytes + line_bytes > max_file_bytes:
+                if out_file is not None:
+                    out_file.close()
+                file_path = os.path.join(out_dir, f"{file_prefix}_{len(file_paths) + 1:03d}.jsonl")
+                out_file = open(file_path, "w", encoding="utf-8")
+                file_paths.append(file_path)
+                file_lines = 0
+                file_bytes = 0
+
+            out_file.write(request_line)
+            file_lines += 1
+            file_bytes += line_bytes
+            manifest[custom_id] = {"img_url": img_url, "file": os.path.basename(file_paths[-1])}
+    finally:
+        if out_file is not None:
+            out_file.close()
+
+    with open(os.path.join(out_dir, OCR_BATCH_MANIFEST_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    logging.getLogger("rich").info(f"Wrote [bold green]{len(manifest)}[/] request(s) into {len(file_paths)} batch file(s) in [bold green]{out_dir}[/]", extra={"markup": True})
+    return file_paths
+
+
+def parse_batch_result_line(result: dict, manifest: dict | None = None, convert_idr: bool = False) -> dict:
+    custom_id = result.get("custom_id")
+    parsed_result = {
+        "custom_id": custom_id,
+        "img_url": (manifest or {}).get(custom_id, {}).get("img_url"),
+        "usage": None,
+    }
+
+    response = result.get("response") or {}
+    body = response.get("body") or {}
+    error = result.get("error") or body.get("error")
+    if error or response.get("status_code", 200) != 200:
+        parsed_result["status"] = "ERROR"
+        parsed_result["error"] = error or {"status_code": response.get("status_code")}
+        return parsed_result
+
+    usage = body.get("usage")
+    if usage:
+        token_info = AnyOCREngine.process_token_usage(SimpleNamespace(**usage), convert_idr)
+        # Batch API discount
+        for cost_key in ("est_cost", "est_cost_idr"):
+            token_info[cost_key] *= OCR_BATCH_COST_RATIO
+        parsed_result["usage"] = token_info
+
+    content = body["choices"][0]["message"].get("content") or ""
+    try:
+        parsed_result["data"] = AnyOCREngine.parse_json_content(content)
+        parsed_result["status"] = "OK"
+    except json.JSONDecodeError:
+        parsed_result["content"] = content
+        parsed_result["status"] = "NOT_JSON"
+    return parsed_result
+
+
+def ingest_batch_results(result_files: list, manifest_file: str | None = None, convert_idr: bool = False) -> list:
+    """
+    Read Batch API output (and error) JSONL files back into per-image results with parsed data and usage,
+    ordered by custom_id so they follow the order of the submitted images.
+    """
+    manifest = None
+    if manifest_file:
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    results = []
+    for result_file in result_files:
+        with open(result_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    results.append(parse_batch_result_line(json.loads(line), manifest, convert_idr))
+
+    return sorted(results, key=lambda r: r["custom_id"] or "")
+
+
+def sum_batch_usage(results: list) -> dict:
+    usage = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0, "est_cost": 0.0, "est_cost_idr": 0.0}
+    for result in results:
+        for key in usage:
+            usage[key] += (result["usage"] or {}).get(key, 0)
+    return usage
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="AnyOCR Batch - Emit and ingest Batch API JSONL files", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    emit_parser = subparsers.add_parser("emit", help="Write Batch API request files for images", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    emit_parser.add_argument('images', nargs='+', help='URLs or file paths of the images')
+    emit_parser.add_argument('-p', '--prompt', help='Path to the prompt file to read', required=True)
+    emit_parser.add_argument('-o', '--output', help='Output directory of the request files', default="batch")
+    emit_parser.add_argument('-l', '--detail', help='Image detail level', choices=[d.value for d in AnyOCREngineImageDetailLevel], default=AnyOCREngineImageDetailLevel.DetailAuto.value)
+    emit_parser.add_argument('--max-lines', help='Maximum requests per file', type=int, default=OCR_BATCH_MAX_LINES)
+    emit_parser.add_argument('--max-bytes', help='Maximum size per file in bytes', type=int, default=OCR_BATCH_MAX_FILE_BYTES)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Parse Batch API result files", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ingest_parser.add_argument('results', nargs='+', help='Batch output/error JSONL files')
+    ingest_parser.add_argument('-m', '--manifest', help='Manifest written by emit')
+    ingest_parser.add_argument('-o', '--output', help='Output JSON file of parsed results')
+    ingest_parser.add_argument('--sink', help='Also write flattened results to this .parquet, .csv or .jsonl file')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from rich.console import Console
+    from rich.logging import RichHandler
+    from _constants import OCR_PROMPT_GENERATOR_FILEPATH
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(message)s", datefmt="[%X]", handlers=[RichHandler()])
+    console = Console()
+    args = parse_arguments()
+
+    if args.command == "emit":
+        engine = AnyOCREngine(azure_deployment_name=os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"), azure_vision_active=False)
+        user_message = AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, args.prompt, OCR_PROMPT_GENERATOR_FILEPATH)
+        write_batch_files(
+            engine,
+            args.images,
+            user_message,
+            args.output,
+            img_detail_level=AnyOCREngineImageDetailLevel(args.detail),
+            max_lines=args.max_lines,
+            max_file_bytes=args.max_bytes,
+        )
+    else:
+        results = ingest_batch_results(args.results, args.manifest, convert_idr=True)
+        if args.sink:
+            from AnyOCRSinks import create_sink
+            with create_sink(args.sink) as sink:
+                for result in results:
+                    if "data" in result:
+                        sink.write(result["data"], source=result["img_url"] or result["custom_id"], status=result["status"])
+            console.print({"sink": args.sink, "records": sink.records_written})
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+        else:
+            console.print(results)
+        console.print({"results": len(results), "usage": sum_batch_usage(results)})
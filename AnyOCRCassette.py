@@ -0,0 +1,255 @@
+"""
+AnyOCRCassette.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Record/replay of upstream GPT-4V traffic. The recording transport captures requests and responses,
+including the timing of every streamed chunk, to a cassette file (JSON) with secrets redacted and
+images replaced by their digest. The replay transport serves them back offline, at the recorded
+speed or faster, so load and regression tests are deterministic.
+
+Usage:
+    engine = AnyOCREngine(..., http_client=create_replay_client("test_fixtures/cassette_vision_stream.json", speed=0))
+"""
+
+import re
+import json
+import time
+import base64
+import hashlib
+import threading
+import collections
+import urllib.parse
+
+import httpx
+
+OCR_CASSETTE_VERSION = 1
+OCR_CASSETTE_REDACTED = "REDACTED"
+
+# Headers and body fields holding credentials (or naming the resources), compared lowercase
+OCR_CASSETTE_SECRET_HEADERS = {"api-key", "authorization", "ocp-apim-subscription-key", "cookie", "set-cookie", "host"}
+OCR_CASSETTE_SECRET_FIELDS = {"key", "api_key", "apikey", "endpoint"}
+
+# Headers that don't apply to the replayed (already decoded) body
+OCR_CASSETTE_SKIPPED_HEADERS = {"content-length", "content-encoding", "transfer-encoding", "connection"}
+
+OCR_CASSETTE_DATA_URL_PATTERN = re.compile(r"data:([\w/+.-]+);base64,([A-Za-z0-9+/=]+)")
+
+
+class AnyOCRCassetteMismatch(Exception):
+    pass
+
+
+def redact_headers(headers) -> dict:
+    return {
+        name: OCR_CASSETTE_REDACTED if name.lower() in OCR_CASSETTE_SECRET_HEADERS else value
+        for name, value in headers.items()
+    }
+
+
+def redact_body(value):
+    # Credentials are redacted, and images are replaced by their digest to keep cassettes small
+    if isinstance(value, dict):
+        return {key: OCR_CASSETTE_REDACTED if key.lower() in OCR_CASSETTE_SECRET_FIELDS else redact_body(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact_body(item) for item in value]
+    if isinstance(value, str):
+        return OCR_CASSETTE_DATA_URL_PATTERN.sub(
+            lambda match: f"data:{match.group(1)};sha256,{hashlib.sha256(match.group(2).encode()).hexdigest()}", value
+        )
+    return value
+
+
+def request_to_dict(request: httpx.Request) -> dict:
+    try:
+        body = redact_body(json.loads(request.content or b"null"))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        body = None
+    return {
+        "method": request.method,
+        # The resource host is left out
+        "path": request.url.path,
+        "query": dict(urllib.parse.parse_qsl(request.url.query.decode())),
+        "headers": redact_headers(request.headers),
+        "body": body,
+    }
+
+
+def chunk_to_dict(offset: float, chunk: bytes) -> dict:
+    try:
+        return {"t": round(offset, 4), "data": chunk.decode("utf-8")}
+    except UnicodeDecodeError:
+        # A multi-byte character split over two chunks
+        return {"t": round(offset, 4), "data_b64": base64.b64encode(chunk).decode()}
+
+
+def chunk_from_dict(chunk: dict) -> bytes:
+    if "data_b64" in chunk:
+        return base64.b64decode(chunk["data_b64"])
+    return chunk["data"].encode("utf-8")
+
+
+class AnyOCRCassette:
+    """
+    Recorded interactions: [{"request": {...}, "response": {"status_code", "headers", "chunks": [{"t", "data"}], "complete"}}].
+    Chunk offsets ("t") are in seconds since the request was sent, so they include the time to first byte.
+    """
+    file_path: str
+
+    def __init__(self, file_path: str, interactions: list | None = None):
+        self.file_path = file_path
+        self.interactions = interactions or []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, file_path: str) -> "AnyOCRCassette":
+        with open(file_path, "r", encoding="utf-8") as f:
+            cassette = json.load(f)
+        if cassette.get("version") != OCR_CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version {cassette.get('version')} in {file_path}")
+        return cls(file_path, cassette["interactions"])
+
+    def append(self, interaction: dict):
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def save(self):
+        with self._lock:
+            with open(self.file_path, "w", encoding="utf-8") as f:
+                json.dump({"version": OCR_CASSETTE_VERSION, "interactions": self.interactions}, f, indent=2, ensure_ascii=False)
+
+    def __repr__(self):
+        return f"<AnyOCRCassette {self.file_path} interactions={len(self.interactions)}>"
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    def __init__(self, stream, start_time: float, on_close):
+        self._stream = stream
+        self._start_time = start_time
+        self._on_close = on_close
+        self.chunks = []
+        self.complete = False
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self.chunks.append(chunk_to_dict(time.monotonic() - self._start_time, chunk))
+            yield chunk
+        self.complete = True
+
+    def close(self):
+        # Called when the response is read completely, and when a stream is closed early
+        if self.closed:
+            return
+        self.closed = True
+        self._stream.close()
+        self._on_close(self)
+
+
+class AnyOCRRecordingTransport(httpx.BaseTransport):
+    """
+    Forwards requests to the upstream transport and records them, with every response chunk, to the cassette.
+    Every interaction is saved as soon as its response is closed.
+    """
+
+    def __init__(self, cassette: AnyOCRCassette, transport: httpx.BaseTransport | None = None):
+        self.cassette = cassette
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        # Uncompressed, so the recorded chunks are readable and replay as they are
+        request.headers["Accept-Encoding"] = "identity"
+        recorded_request = request_to_dict(request)
+
+        start_time = time.monotonic()
+        response = self.transport.handle_request(request)
+
+        def on_close(stream: _RecordingStream):
+            self.cassette.append({
+                "request": recorded_request,
+                "response": {
+                    "status_code": response.status_code,
+                    "headers": redact_headers(response.headers),
+                    "chunks": stream.chunks,
+                    "complete": stream.complete,
+                },
+            })
+            self.cassette.save()
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(response.stream, start_time, on_close),
+            extensions=response.extensions,
+        )
+
+    def close(self):
+        self.transport.close()
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, chunks: list, start_time: float, speed: float):
+        self._chunks = chunks
+        self._start_time = start_time
+        self._speed = speed
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if self._speed > 0:
+                delay = self._start_time + chunk["t"] / self._speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield chunk_from_dict(chunk)
+
+
+class AnyOCRReplayTransport(httpx.BaseTransport):
+    """
+    Serves recorded responses instead of calling upstream. Requests are matched by method and path, in
+    recorded order (so the plain and /extensions routes can be interleaved); an unmatched request raises
+    AnyOCRCassetteMismatch. speed is a multiple of the recorded timing: 1 replays it as recorded,
+    10 ten times faster, and 0 without any delay. With loop=True, the interactions of a route are served
+    over and over (e.g. for load tests).
+    """
+
+    def __init__(self, cassette: AnyOCRCassette, speed: float = 1.0, loop: bool = False):
+        self.cassette = cassette
+        self.speed = speed
+        self.loop = loop
+
+        self._lock = threading.Lock()
+        self._interactions = collections.defaultdict(collections.deque)
+        for interaction in cassette.interactions:
+            request = interaction["request"]
+            self._interactions[(request["method"], request["path"])].append(interaction)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        start_time = time.monotonic()
+        with self._lock:
+            interactions = self._interactions.get((request.method, request.url.path))
+            if not interactions:
+                raise AnyOCRCassetteMismatch(f"No recorded response left for {request.method} {request.url.path} in {self.cassette.file_path}")
+            interaction = interactions.popleft()
+            if self.loop:
+                interactions.append(interaction)
+
+        response = interaction["response"]
+        headers = {name: value for name, value in response["headers"].items() if name.lower() not in OCR_CASSETTE_SKIPPED_HEADERS}
+        return httpx.Response(
+            status_code=response["status_code"],
+            headers=headers,
+            stream=_ReplayStream(response["chunks"], start_time, self.speed),
+            request=request,
+        )
+
+
+def create_recording_client(cassette_file: str) -> httpx.Client:
+    # Appends to an existing cassette
+    try:
+        cassette = AnyOCRCassette.load(cassette_file)
+    except FileNotFoundError:
+        cassette = AnyOCRCassette(cassette_file)
+    return httpx.Client(transport=AnyOCRRecordingTransport(cassette))
+
+
+def create_replay_client(cassette_file: str, speed: float = 1.0, loop: bool = False) -> httpx.Client:
+    return httpx.Client(transport=AnyOCRReplayTransport(AnyOCRCassette.load(cassette_file), speed, loop))
@@ -0,0 +1,126 @@
+"""
+AnyOCRCheckpoint.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Checkpoint of processed files (SQLite), keyed by content hash, so a restarted watcher
+never sends an image to GPT-4V again once its result is written.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from enum import Enum
+
+
+class AnyOCRCheckpointState(Enum):
+    InProgress = "in_progress"
+    Done = "done"
+    Failed = "failed"
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AnyOCRCheckpoint:
+    db_path: str
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Work by content: a copied or renamed image is still done
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint ("
+            " sha256 TEXT PRIMARY KEY,"
+            " path TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " result_path TEXT,"
+            " usage TEXT,"
+            " error TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        # Files already hashed, so unchanged files aren't read again on every poll
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime REAL NOT NULL,"
+            " sha256 TEXT NOT NULL)"
+        )
+
+    def file_hash(self, file_path: str, size: int, mtime: float) -> str:
+        # Content hash of a file, cached by (path, size, mtime)
+        with self._lock:
+            row = self._conn.execute("SELECT size, mtime, sha256 FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row is not None and row[0] == size and row[1] == mtime:
+            return row[2]
+
+        sha256 = file_sha256(file_path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)", (file_path, size, mtime, sha256)
+            )
+        return sha256
+
+    def get(self, sha256: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, state, attempts, result_path, usage, error FROM checkpoint WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "path": row[0],
+            "state": AnyOCRCheckpointState(row[1]),
+            "attempts": row[2],
+            "result_path": row[3],
+            "usage": json.loads(row[4]) if row[4] else None,
+            "error": row[5],
+        }
+
+    def start(self, sha256: str, file_path: str) -> int:
+        # Returns the attempt number
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO checkpoint (sha256, path, state, attempts, updated_at) VALUES (?, ?, ?, 1, ?)"
+                " ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, state = excluded.state, attempts = attempts + 1, updated_at = excluded.updated_at",
+                (sha256, file_path, AnyOCRCheckpointState.InProgress.value, time.time()),
+            )
+            return self._conn.execute("SELECT attempts FROM checkpoint WHERE sha256 = ?", (sha256,)).fetchone()[0]
+
+    def complete(self, sha256: str, result_path: str | None, usage: dict | None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE checkpoint SET state = ?, result_path = ?, usage = ?, error = NULL, updated_at = ? WHERE sha256 = ?",
+                (AnyOCRCheckpointState.Done.value, result_path, json.dumps(usage) if usage else None, time.time(), sha256),
+            )
+
+    def fail(self, sha256: str, error: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE checkpoint SET state = ?, error = ?, updated_at = ? WHERE sha256 = ?",
+                (AnyOCRCheckpointState.Failed.value, error, time.time(), sha256),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM checkpoint GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __repr__(self):
+        return f"<AnyOCRCheckpoint {self.db_path}>"
@@ -0,0 +1,205 @@
+"""
+AnyOCRCircuitBreaker.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Circuit breakers around the upstream routes: "vision" (GPT-4V with Azure AI Vision enhancements, the
+/extensions endpoint) and "plain" (GPT-4V only). A breaker tracks the error rate and latency percentiles
+of recent calls and opens when its route degrades. While the vision breaker is open, AnyOCREngine sends
+requests to the plain route instead; after a while a few probe calls are let through (half-open), and
+the breaker closes again once they succeed.
+"""
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+OCR_CIRCUIT_ROUTES = ("vision", "plain")
+
+OCR_CIRCUIT_DEFAULT_WINDOW_SIZE = 50
+OCR_CIRCUIT_DEFAULT_MIN_CALLS = 10
+OCR_CIRCUIT_DEFAULT_MAX_ERROR_RATE = 0.5
+OCR_CIRCUIT_DEFAULT_OPEN_SECONDS = 30.0
+OCR_CIRCUIT_DEFAULT_HALF_OPEN_PROBES = 1
+
+# Upstream statuses that tell the route is degraded; any other error response (e.g. 400) means it works
+OCR_CIRCUIT_FAILURE_STATUS_CODES = {408, 429}
+
+
+class AnyOCRCircuitOpen(Exception):
+    def __init__(self, route: str, retry_after: int):
+        super().__init__(f"Upstream {route} route is unavailable, retry after {retry_after} seconds.")
+        self.route = route
+        self.retry_after = retry_after
+
+
+def is_route_failure(e: Exception) -> bool:
+    # Connection errors and timeouts have no status code
+    status_code = getattr(e, "status_code", None)
+    return status_code is None or status_code >= 500 or status_code in OCR_CIRCUIT_FAILURE_STATUS_CODES
+
+
+class AnyOCRCircuitBreaker:
+    """
+    Closed: calls go through, and the outcomes of the last window_size calls are kept. Once there are
+    min_calls of them, the breaker opens when the error rate exceeds max_error_rate, or the p95 latency
+    (to the first streamed chunk) exceeds max_p95_latency. Open: calls are refused for open_seconds.
+    Half-open: up to half_open_probes calls go through; a success closes the breaker, a failure opens it again.
+    Safe to share between threads.
+    """
+    route: str
+
+    def __init__(
+        self,
+        route: str,
+        window_size: int = OCR_CIRCUIT_DEFAULT_WINDOW_SIZE,
+        min_calls: int = OCR_CIRCUIT_DEFAULT_MIN_CALLS,
+        max_error_rate: float = OCR_CIRCUIT_DEFAULT_MAX_ERROR_RATE,
+        max_p95_latency: float | None = None,
+        open_seconds: float = OCR_CIRCUIT_DEFAULT_OPEN_SECONDS,
+        half_open_probes: int = OCR_CIRCUIT_DEFAULT_HALF_OPEN_PROBES,
+    ):
+        self.route = route
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self.max_p95_latency = max_p95_latency
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self.state = "closed"
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window_size)
+        self._latencies = deque(maxlen=window_size)
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+
+        self.opened = 0
+        self.refused = 0
+        self.last_open_reason = None
+
+    def allow(self) -> bool:
+        # Every allowed call must be followed by record() (see track())
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.refused += 1
+                    return False
+                self.state = "half_open"
+                self._probes_in_flight = 0
+
+            if self.state == "half_open":
+                if self._probes_in_flight >= self.half_open_probes:
+                    self.refused += 1
+                    return False
+                self._probes_in_flight += 1
+            return True
+
+    def record(self, ok: bool | None, latency: float | None = None):
+        """
+        Record the outcome of an allowed call: ok, failed, or None when the caller went away before it
+        said anything about the route. latency is left out when the call wasn't streamed.
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self._probes_in_flight -= 1
+                if ok is None:
+                    return
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                    self._latencies.clear()
+                else:
+                    self._open("probe failed")
+                return
+
+            if ok is None or self.state != "closed":
+                return
+            self._outcomes.append(ok)
+            if latency is not None:
+                self._latencies.append(latency)
+
+            if len(self._outcomes) < self.min_calls:
+                return
+            error_rate = self._outcomes.count(False) / len(self._outcomes)
+            if error_rate > self.max_error_rate:
+                self._open(f"error rate {error_rate:.0%}")
+            elif self.max_p95_latency is not None and len(self._latencies) >= self.min_calls:
+                p95_latency = self._percentile(0.95)
+                if p95_latency > self.max_p95_latency:
+                    self._open(f"p95 latency {p95_latency:.1f}s")
+
+    def _open(self, reason: str):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.opened += 1
+        self.last_open_reason = reason
+        self._outcomes.clear()
+        self._latencies.clear()
+
+    def _percentile(self, q: float) -> float:
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))] if latencies else 0.0
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return max(1, int(self.open_seconds - (time.monotonic() - self._opened_at)) + 1)
+
+    @contextmanager
+    def track(self):
+        """
+        Track one allowed call: with breaker.track() as call: ... call.first_response() ...
+        Errors are recorded as failures only when they tell the route is degraded (see is_route_failure).
+        """
+        call = AnyOCRTrackedCall(self)
+        try:
+            yield call
+        except Exception as e:
+            if getattr(e, "reason", None) == "cancelled":
+                # The caller went away (AnyOCREngineCancelled), nothing is known about the route
+                call.finish(None)
+            else:
+                call.finish(not is_route_failure(e))
+            raise
+        call.finish(True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "error_rate": self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0,
+                "latency_p50": self._percentile(0.5),
+                "latency_p95": self._percentile(0.95),
+                "opened": self.opened,
+                "refused": self.refused,
+                "last_open_reason": self.last_open_reason,
+            }
+
+    def __repr__(self):
+        return f"<AnyOCRCircuitBreaker {self.route} {self.state}>"
+
+
+class AnyOCRTrackedCall:
+    def __init__(self, breaker: AnyOCRCircuitBreaker):
+        self.breaker = breaker
+        self.start_time = time.monotonic()
+        self.latency = None
+        self.finished = False
+
+    def first_response(self):
+        # Latency is measured to the first streamed chunk: the rest depends on how long the answer is
+        if self.latency is None:
+            self.latency = time.monotonic() - self.start_time
+
+    def finish(self, ok: bool | None):
+        if self.finished:
+            return
+        self.finished = True
+        self.breaker.record(ok, self.latency)
+
+
+def create_circuit_breakers(max_p95_latency: dict | None = None, **kwargs) -> dict:
+    # One breaker per upstream route, max_p95_latency is per route (e.g. {"vision": 20.0, "plain": 15.0})
+    max_p95_latency = max_p95_latency or {}
+    return {route: AnyOCRCircuitBreaker(route, max_p95_latency=max_p95_latency.get(route), **kwargs) for route in OCR_CIRCUIT_ROUTES}
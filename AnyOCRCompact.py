@@ -0,0 +1,73 @@
+"""
+AnyOCRCompact.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Compact output encoding to cut completion tokens. Templates are wrapped to ask for arrays of objects
+(e.g. family members of a Kartu Keluarga, table rows) in a keyless, columnar form, where the keys are
+written once instead of once per item:
+
+    {"__k": ["nama_lengkap", "nik"], "__v": [["MUCHLIS", "5271042709720004"], ["SITI", "5271046510750002"]]}
+
+and the answer is expanded back to the template's original shape on the client side.
+"""
+
+OCR_COMPACT_KEYS = "__k"
+OCR_COMPACT_VALUES = "__v"
+
+OCR_COMPACT_MESSAGE = "\
+    Compact output: write every array of objects in the JSON above as a single object \
+    {\"__k\": [keys], \"__v\": [[values of the 1st object], [values of the 2nd object], ...]} instead, \
+    where the values of each object are in the order of \"__k\", with null for a value it doesn't have. \
+    Keep the rest of the JSON structure as described, and return it minified, without indentation. \
+    "
+
+
+def wrap_compact_prompt(user_message: str | None) -> str:
+    # The template itself is left as is, the compact encoding is asked for after it
+    return f"{user_message or ''}\n\n{OCR_COMPACT_MESSAGE}"
+
+
+def is_compact_table(value) -> bool:
+    return (
+        isinstance(value, dict)
+        and set(value) == {OCR_COMPACT_KEYS, OCR_COMPACT_VALUES}
+        and isinstance(value[OCR_COMPACT_KEYS], list)
+        and isinstance(value[OCR_COMPACT_VALUES], list)
+    )
+
+
+def expand_compact_json(data):
+    """
+    Expand every {"__k": [...], "__v": [[...]]} in the data back to an array of objects. Rows the model
+    wrote as objects anyway are kept as they are, and values past the keys are dropped.
+    """
+    if is_compact_table(data):
+        keys = [str(key) for key in data[OCR_COMPACT_KEYS]]
+        return [
+            dict(zip(keys, (expand_compact_json(value) for value in row))) if isinstance(row, list) else expand_compact_json(row)
+            for row in data[OCR_COMPACT_VALUES]
+        ]
+    if isinstance(data, dict):
+        return {key: expand_compact_json(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [expand_compact_json(value) for value in data]
+    return data
+
+
+def compact_json(data):
+    """
+    The inverse of expand_compact_json(): every non-empty array of objects becomes {"__k", "__v"}, with the
+    keys in order of first appearance and null for missing values. Used to estimate the savings of results.
+    """
+    if isinstance(data, list) and data and all(isinstance(item, dict) for item in data):
+        keys = list(dict.fromkeys(key for item in data for key in item))
+        return {
+            OCR_COMPACT_KEYS: keys,
+            OCR_COMPACT_VALUES: [[compact_json(item.get(key)) for key in keys] for item in data],
+        }
+    if isinstance(data, dict):
+        return {key: compact_json(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [compact_json(value) for value in data]
+    return data
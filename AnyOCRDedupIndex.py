@@ -0,0 +1,153 @@
+"""
+AnyOCRDedupIndex.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Index of previously recognized images, so the stored result is reused instead of sending an image
+to GPT-4V again. Perceptual hashes only find candidates: two documents of the same layout with
+another name or NIK are a bit or two apart, so a candidate is only reused when the image content
+(SHA-256 of its bytes) is the same too.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from AnyOCRImageHash import load_pil_image, dhash
+
+OCR_DEDUP_HASH_SIZE = 16
+OCR_DEDUP_DEFAULT_MAX_DISTANCE = 10
+OCR_DEDUP_DEFAULT_MAX_ENTRIES = 10000
+
+
+def compute_image_hash(img_src: str) -> int:
+    with load_pil_image(img_src) as image:
+        return dhash(image, OCR_DEDUP_HASH_SIZE)
+
+
+def compute_content_digest(img_src: str) -> str:
+    from AnyOCRDocument import load_document_bytes
+    return hashlib.sha256(load_document_bytes(img_src)).hexdigest()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes with Hamming distance,
+    so a lookup only visits the subtrees that can be within max_distance.
+    """
+
+    def __init__(self):
+        # Node: [hash, entry_id, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, entry_id):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, entry_id, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = (value ^ node[0]).bit_count()
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, entry_id, {}]
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list:
+        # Returns [(distance, entry_id)], closest first
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = (value ^ node[0]).bit_count()
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return sorted(found, key=lambda item: item[0])
+
+
+class AnyOCRNearDuplicateIndex:
+    """
+    Bounded, thread-safe near-duplicate index of recognition results, scoped by prompt template.
+    Least recently used entries are evicted beyond max_entries.
+    """
+
+    def __init__(self, max_distance: int = OCR_DEDUP_DEFAULT_MAX_DISTANCE, max_entries: int = OCR_DEDUP_DEFAULT_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._trees = {}
+        # entry_id -> (scope, hash, content digest, result), in least recently used order
+        self._entries = OrderedDict()
+        self._next_entry_id = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.saved_tokens = 0
+        self.saved_cost = 0.0
+
+    def lookup(self, scope: str, image_hash: int, content_digest: str | None = None) -> tuple | None:
+        """
+        Returns (result, distance) of the closest stored image within max_distance, or None.
+        With content_digest, only images stored with the same digest are returned.
+        """
+        with self._lock:
+            self.lookups += 1
+            tree = self._trees.get(scope)
+            matches = tree.search(image_hash, self.max_distance) if tree is not None else []
+
+            # Evicted entries stay in the tree until it's rebuilt, skip them
+            for distance, entry_id in matches:
+                if entry_id in self._entries:
+                    if content_digest is not None and self._entries[entry_id][2] != content_digest:
+                        continue
+                    self._entries.move_to_end(entry_id)
+                    result = self._entries[entry_id][3]
+
+                    self.hits += 1
+                    usage = result.get("usage") or {}
+                    self.saved_tokens += usage.get("total_tokens", 0)
+                    self.saved_cost += usage.get("est_cost", 0.0)
+                    return result, distance
+            return None
+
+    def store(self, scope: str, image_hash: int, result: dict, content_digest: str | None = None):
+        with self._lock:
+            entry_id = self._next_entry_id
+            self._next_entry_id += 1
+
+            self._entries[entry_id] = (scope, image_hash, content_digest, result)
+            self._trees.setdefault(scope, BKTree()).add(image_hash, entry_id)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            # BK-trees can't delete nodes: rebuild once evicted entries outnumber the live ones
+            if sum(tree.size for tree in self._trees.values()) > 2 * max(1, len(self._entries)):
+                self._rebuild()
+
+    def _rebuild(self):
+        self._trees = {}
+        for entry_id, (scope, image_hash, _, _) in self._entries.items():
+            self._trees.setdefault(scope, BKTree()).add(image_hash, entry_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "saved_calls": self.hits,
+                "saved_tokens": self.saved_tokens,
+                "saved_cost": self.saved_cost,
+            }
+
+    def __repr__(self):
+        return f"<AnyOCRNearDuplicateIndex entries={len(self._entries)}>"
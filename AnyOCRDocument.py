@@ -0,0 +1,398 @@
+"""
+AnyOCRDocument.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Helpers for multi-page document (PDF/TIFF) input: rasterizing pages into
+base64 image data URLs and merging per-page JSON results.
+"""
+
+import os
+import io
+import base64
+import logging
+import mimetypes
+import urllib.parse
+
+DOCUMENT_MIME_TYPES = ("application/pdf", "image/tiff")
+
+# GPT-4V scales images down before tokenizing them: "low" is 512x512, "high" fits the
+# shortest side to 768 px. Rendering pages with more pixels than that is wasted upload.
+DOCUMENT_TARGET_SHORT_SIDE = {
+    "low": 512,
+    "high": 768,
+    "auto": 768,
+}
+DOCUMENT_MIN_DPI = 72
+DOCUMENT_MAX_DPI = 300
+DOCUMENT_JPEG_QUALITY = 90
+# Seconds to download a remote document/image, when the caller has no deadline of its own
+DOCUMENT_DOWNLOAD_TIMEOUT = 30.0
+
+# In high detail, GPT-4V fits an image into 2048x2048 and then its shortest side to 768 px.
+# A strip with this aspect ratio (width / height) keeps the most of its original resolution.
+TILE_ASPECT_RATIO = 2048 / 768
+# Wider images lose resolution in high detail whatever their height
+TILE_MAX_WIDTH = 2048
+
+# Scalar values treated as "not recognized" when merging pages
+EMPTY_VALUES = (None, "", "-")
+
+
+def guess_document_mime_type(doc_src: str) -> str | None:
+    if doc_src.startswith("data:"):
+        return doc_src[5:].split(";", 1)[0]
+
+    path = urllib.parse.urlparse(doc_src).path if "://" in doc_src else doc_src
+    mime_type, _ = mimetypes.guess_type(path)
+    return mime_type
+
+
+def is_document(doc_src: str) -> bool:
+    return guess_document_mime_type(doc_src) in DOCUMENT_MIME_TYPES
+
+
+def is_remote(doc_src: str) -> bool:
+    result = urllib.parse.urlparse(doc_src)
+    return all([result.scheme, result.netloc])
+
+
+def load_document_bytes(doc_src: str, timeout: float = DOCUMENT_DOWNLOAD_TIMEOUT) -> bytes:
+    if doc_src.startswith("data:"):
+        return base64.b64decode(doc_src.split(",", 1)[1])
+
+    if is_remote(doc_src):
+        import requests
+        response = requests.get(doc_src, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    if not os.path.exists(doc_src):
+        raise FileNotFoundError(f"Document file {doc_src} does not exist.")
+    with open(doc_src, 'rb') as f:
+        return f.read()
+
+
+def guess_bytes_mime_type(doc_bytes: bytes) -> str | None:
+    # From the content itself: remote URLs are often download links without a file extension
+    if doc_bytes.startswith(b"%PDF"):
+        return "application/pdf"
+    if doc_bytes[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    try:
+        from PIL import Image
+
+        with Image.open(io.BytesIO(doc_bytes)) as image:
+            return Image.MIME.get(image.format)
+    except Exception:
+        return None
+
+
+def fetch_data_url(doc_src: str, timeout: float = DOCUMENT_DOWNLOAD_TIMEOUT) -> str:
+    """
+    Download a remote document/image once and return it as a base64 data URL, so the later steps
+    (routing, hashing, estimates, rasterizing, and the upstream call) use these bytes instead of
+    downloading it again.
+    """
+    doc_bytes = load_document_bytes(doc_src, timeout)
+    mime_type = guess_bytes_mime_type(doc_bytes) or guess_document_mime_type(doc_src) or "image/jpeg"
+    return f"data:{mime_type};base64,{base64.b64encode(doc_bytes).decode('ascii')}"
+
+
+def dpi_for_detail_level(page_width_pt: float, page_height_pt: float, detail_level: str = "auto") -> int:
+    # Pick the DPI that renders the page's shortest side at the size GPT-4V will actually look at
+    target_px = DOCUMENT_TARGET_SHORT_SIDE.get(detail_level, DOCUMENT_TARGET_SHORT_SIDE["auto"])
+    short_side_inch = min(page_width_pt, page_height_pt) / 72.0
+    if short_side_inch <= 0:
+        return DOCUMENT_MIN_DPI
+    return int(max(DOCUMENT_MIN_DPI, min(DOCUMENT_MAX_DPI, round(target_px / short_side_inch))))
+
+
+def encode_page_image(page_image) -> str:
+    buffer = io.BytesIO()
+    page_image.convert("RGB").save(buffer, format="JPEG", quality=DOCUMENT_JPEG_QUALITY)
+    encoded_image = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"data:image/jpeg;base64,{encoded_image}"
+
+
+def rasterize_pdf(doc_bytes: bytes, detail_level: str = "auto") -> list:
+    import pypdfium2 as pdfium
+
+    pages = []
+    pdf = pdfium.PdfDocument(doc_bytes)
+    try:
+        for page_index in range(len(pdf)):
+            page = pdf[page_index]
+            width_pt, height_pt = page.get_size()
+            dpi = dpi_for_detail_level(width_pt, height_pt, detail_level)
+            logging.getLogger("rich").debug(f"Rendering PDF page {page_index + 1} at [bold green]{dpi}[/] DPI", extra={"markup": True})
+            pages.append(encode_page_image(page.render(scale=dpi / 72.0).to_pil()))
+            page.close()
+    finally:
+        pdf.close()
+    return pages
+
+
+def rasterize_tiff(doc_bytes: bytes, detail_level: str = "auto") -> list:
+    from PIL import Image, ImageSequence
+
+    target_px = DOCUMENT_TARGET_SHORT_SIDE.get(detail_level, DOCUMENT_TARGET_SHORT_SIDE["auto"])
+    pages = []
+    with Image.open(io.BytesIO(doc_bytes)) as tiff:
+        for frame in ImageSequence.Iterator(tiff):
+            page_image = frame.copy()
+            # TIFF pages are already raster, only downscale them to the useful size
+            scale = target_px / min(page_image.size)
+            if scale < 1:
+                page_image = page_image.resize(
+                    (round(page_image.width * scale), round(page_image.height * scale)), Image.LANCZOS
+                )
+            pages.append(encode_page_image(page_image))
+    return pages
+
+
+def rasterize_document(doc_src: str, detail_level: str = "auto", timeout: float = DOCUMENT_DOWNLOAD_TIMEOUT) -> list:
+    """
+    Rasterize every page of a PDF/TIFF document into base64 image data URLs,
+    sized for the given GPT-4V detail level ("low", "high", or "auto").
+    """
+    mime_type = guess_document_mime_type(doc_src)
+    doc_bytes = load_document_bytes(doc_src, timeout)
+
+    if mime_type == "application/pdf" or doc_bytes.startswith(b"%PDF"):
+        return rasterize_pdf(doc_bytes, detail_level)
+    if mime_type == "image/tiff" or doc_bytes[:4] in (b"II*\x00", b"MM\x00*"):
+        return rasterize_tiff(doc_bytes, detail_level)
+
+    raise ValueError(f"Document {doc_src} is not a PDF or TIFF file.")
+
+
+def split_image_tiles(img_src: str, overlap_ratio: float = 0.1, max_tiles: int = 6, key_column_ratio: float = 0.15) -> tuple:
+    """
+    Split an image into overlapping tiles, each sized so GPT-4V's high detail downscaling keeps as much
+    resolution as possible. Returns (layout, tiles), where tiles is a list of base64 image data URLs:
+    - "rows": a tall image, split into horizontal strips (full width, top to bottom);
+    - "columns": a wide image, split into vertical slices (full height, left to right). The leftmost
+      key_column_ratio of the image, which usually holds the row labels (e.g. "ID Kolam"), is put in
+      front of every slice, so the rows of all slices can be matched up again;
+    - None: the image doesn't need tiling, and tiles is [img_src].
+    Tiles span the full width (or height) of the image, so an image that is both very wide and very
+    tall is still downscaled by GPT-4V, only less than as a whole.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(load_document_bytes(img_src))) as image:
+        image.load()
+        width, height = image.size
+
+        if width > TILE_MAX_WIDTH and width / height > TILE_ASPECT_RATIO:
+            return "columns", split_image_columns(image, overlap_ratio, max_tiles, key_column_ratio)
+
+        tile_height = max(1, round(width / TILE_ASPECT_RATIO))
+        if height <= tile_height:
+            return None, [img_src]
+
+        tiles = [
+            encode_page_image(image.crop((0, top, width, bottom)))
+            for top, bottom in tile_spans(height, tile_height, overlap_ratio, max_tiles)
+        ]
+        return "rows", tiles
+
+
+def split_image_columns(image, overlap_ratio: float, max_tiles: int, key_column_ratio: float) -> list:
+    # Vertical slices of a wide image, each with the key (leftmost) column in front of it
+    from PIL import Image
+
+    width, height = image.size
+    full_tile_width = round(height * TILE_ASPECT_RATIO)
+    # The key column is part of every tile, so only the rest of the width is split
+    key_width = min(round(width * key_column_ratio), full_tile_width // 3)
+    key_column = image.crop((0, 0, key_width, height))
+    tile_width = full_tile_width - key_width
+    tiles = []
+    for left, right in tile_spans(width - key_width, tile_width, overlap_ratio, max_tiles):
+        tile = Image.new(image.mode, (key_width + right - left, height))
+        tile.paste(key_column, (0, 0))
+        tile.paste(image.crop((key_width + left, 0, key_width + right, height)), (key_width, 0))
+        tiles.append(encode_page_image(tile))
+    return tiles
+
+
+def tile_spans(length: int, tile_length: int, overlap_ratio: float, max_tiles: int) -> list:
+    # (start, end) of overlapping tiles covering length, stretched evenly if more than max_tiles are needed
+    if length <= tile_length:
+        return [(0, length)]
+
+    overlap = round(tile_length * overlap_ratio)
+    tile_count = -(-(length - overlap) // (tile_length - overlap))
+    if tile_count > max_tiles:
+        tile_count = max_tiles
+        tile_length = -(-(length + overlap * (tile_count - 1)) // tile_count)
+
+    step = (length - tile_length) / (tile_count - 1) if tile_count > 1 else 0
+    spans = []
+    for tile_index in range(tile_count):
+        start = round(tile_index * step)
+        spans.append((start, min(length, start + tile_length)))
+    return spans
+
+
+##########################
+# Merging per-page results
+##########################
+def get_table_keys(value) -> tuple | None:
+    # Tables are emitted as {"columns": [...], "rows": [[...]]}, sometimes capitalized
+    if not isinstance(value, dict):
+        return None
+    columns_key = next((k for k in value if k.lower() == "columns"), None)
+    rows_key = next((k for k in value if k.lower() == "rows"), None)
+    if columns_key is None or rows_key is None:
+        return None
+    return columns_key, rows_key
+
+
+def normalize_item(item):
+    if isinstance(item, dict):
+        return tuple((k, normalize_item(v)) for k, v in item.items())
+    if isinstance(item, list):
+        return tuple(normalize_item(v) for v in item)
+    return str(item).strip().lower()
+
+
+def find_overlap(prev_items: list, next_items: list, max_overlap: int | None = None) -> int:
+    # Length of the longest suffix of prev_items that is also a prefix of next_items
+    limit = min(len(prev_items), len(next_items))
+    if max_overlap is not None:
+        limit = min(limit, max_overlap)
+
+    prev_norm = [normalize_item(item) for item in prev_items[-limit:]] if limit else []
+    next_norm = [normalize_item(item) for item in next_items[:limit]]
+    for k in range(limit, 0, -1):
+        if prev_norm[-k:] == next_norm[:k]:
+            return k
+    return 0
+
+
+def concat_items(prev_items: list, next_items: list, dedup_overlap: bool = False) -> list:
+    skip = find_overlap(prev_items, next_items) if dedup_overlap else 0
+    return prev_items + next_items[skip:]
+
+
+def merge_values(prev_value, next_value, dedup_overlap: bool = False):
+    if prev_value in EMPTY_VALUES:
+        return next_value
+    if next_value in EMPTY_VALUES:
+        return prev_value
+
+    prev_table_keys = get_table_keys(prev_value)
+    next_table_keys = get_table_keys(next_value)
+    if prev_table_keys and next_table_keys:
+        prev_columns = prev_value[prev_table_keys[0]]
+        next_columns = next_value[next_table_keys[0]]
+        # A table continuing on the next page keeps the same header, or repeats none at all
+        if not next_columns or normalize_item(prev_columns) == normalize_item(next_columns):
+            merged_table = dict(prev_value)
+            merged_table[prev_table_keys[1]] = concat_items(
+                prev_value[prev_table_keys[1]], next_value[next_table_keys[1]], dedup_overlap
+            )
+            return merged_table
+        return [prev_value, next_value]
+
+    if isinstance(prev_value, dict) and isinstance(next_value, dict):
+        merged = dict(prev_value)
+        for key, value in next_value.items():
+            merged[key] = merge_values(merged.get(key), value, dedup_overlap)
+        return merged
+
+    if isinstance(prev_value, list) and isinstance(next_value, list):
+        return concat_items(prev_value, next_value, dedup_overlap)
+
+    # Scalars: the first page that recognized a value wins
+    return prev_value
+
+
+def merge_json_results(results: list, dedup_overlap: bool = False):
+    """
+    Merge JSON results of consecutive pages (or tiles) into one result.
+    Tables with the same columns are concatenated, nested objects merged, and lists extended.
+    When dedup_overlap is True, rows repeated at the boundary of two results are dropped.
+    """
+    merged = None
+    for result in results:
+        merged = merge_values(merged, result, dedup_overlap)
+    return merged
+
+
+def join_table_columns(prev_table: dict, next_table: dict) -> dict:
+    """
+    Join a table with the table of the next column tile: the next tile's columns are appended, except its
+    key (first) column and the columns repeated in the overlap, and each row gets the cells of the row with
+    the same key. Rows are matched by position when the tiles don't share the key column.
+    """
+    prev_columns_key, prev_rows_key = get_table_keys(prev_table)
+    next_columns_key, next_rows_key = get_table_keys(next_table)
+    prev_columns, next_columns = prev_table[prev_columns_key], next_table[next_columns_key]
+    prev_rows, next_rows = prev_table[prev_rows_key], next_table[next_rows_key]
+
+    has_key = bool(prev_columns and next_columns) and normalize_item(prev_columns[0]) == normalize_item(next_columns[0])
+    skip = 1 if has_key else 0
+    skip += find_overlap(prev_columns[skip:], next_columns[skip:])
+
+    joined_rows = [list(row) + [None] * (len(prev_columns) - len(row)) for row in prev_rows]
+    row_by_key = {normalize_item(row[0]): row for row in joined_rows if row} if has_key else {}
+    for row_index, row in enumerate(next_rows):
+        if has_key:
+            joined_row = row_by_key.get(normalize_item(row[0])) if row else None
+            if joined_row is None:
+                # A row only this tile recognized
+                joined_row = list(row[:1]) + [None] * (len(prev_columns) - 1)
+                joined_rows.append(joined_row)
+        elif row_index < len(joined_rows):
+            joined_row = joined_rows[row_index]
+        else:
+            joined_row = [None] * len(prev_columns)
+            joined_rows.append(joined_row)
+        joined_row.extend(row[skip:])
+
+    joined_table = dict(prev_table)
+    joined_table[prev_columns_key] = prev_columns + next_columns[skip:]
+    joined_table[prev_rows_key] = joined_rows
+    return joined_table
+
+
+def merge_column_values(prev_value, next_value):
+    if prev_value in EMPTY_VALUES:
+        return next_value
+    if next_value in EMPTY_VALUES:
+        return prev_value
+
+    if get_table_keys(prev_value) and get_table_keys(next_value):
+        prev_rows = prev_value[get_table_keys(prev_value)[1]]
+        next_rows = next_value[get_table_keys(next_value)[1]]
+        if all(isinstance(row, list) for row in prev_rows + next_rows):
+            return join_table_columns(prev_value, next_value)
+
+    if isinstance(prev_value, dict) and isinstance(next_value, dict):
+        merged = dict(prev_value)
+        for key, value in next_value.items():
+            merged[key] = merge_column_values(merged.get(key), value)
+        return merged
+
+    if isinstance(prev_value, list) and isinstance(next_value, list):
+        # The same items seen side by side (e.g. row objects), or items only one of the tiles has
+        if len(prev_value) == len(next_value):
+            return [merge_column_values(prev_item, next_item) for prev_item, next_item in zip(prev_value, next_value)]
+        return concat_items(prev_value, next_value, dedup_overlap=True)
+
+    return prev_value
+
+
+def merge_column_results(results: list):
+    """
+    Merge JSON results of side-by-side column tiles (see split_image_tiles()) into one result.
+    Tables are joined column-wise on their key column, nested objects merged, and lists merged item by item.
+    """
+    merged = None
+    for result in results:
+        merged = merge_column_values(merged, result)
+    return merged
@@ -10,12 +10,20 @@ import logging
 import urllib.parse
 import mimetypes
 import base64
+import io
+import math
+import re
+import time
+import queue
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 # from pydantic import BaseModel, HttpUrl
 # from pydantic.dataclasses import dataclass
-from openai import AzureOpenAI
 from enum import Enum
-from blinker import Signal
+
+# openai and blinker are imported on first use, to keep the import of this module fast
 
 
 OCR_CLIENT_SYSTEM_MESSAGE = "\
@@ -23,37 +31,182 @@ OCR_CLIENT_SYSTEM_MESSAGE = "\
     You will explain the provided image. Extract all text within all parts from this image. \
     "
 
+OCR_CLIENT_TILE_MESSAGE = "\
+    This image is tile {index} of {count}: a horizontal strip of a larger document, cut from top to bottom. \
+    Neighbouring tiles overlap by a few rows. Extract only what is visible in this tile, using the same JSON structure. \
+    For tables, return the rows fully visible in this tile in top-to-bottom order, and skip rows cut off by the tile edge. \
+    If the table header is not visible in this tile, return an empty list of columns. \
+    "
+
+OCR_CLIENT_COLUMN_TILE_MESSAGE = "\
+    This image is tile {index} of {count}: a vertical slice of a wide document, cut from left to right. \
+    The leftmost column of the document is repeated at the left of every tile, to identify the rows. \
+    Neighbouring tiles overlap by a few columns. Extract only what is visible in this tile, using the same JSON structure. \
+    For tables, return all rows, with the repeated leftmost column first and then the columns fully visible in this tile, \
+    and skip columns cut off by the tile edge. \
+    "
+
+OCR_CLIENT_PACKED_MESSAGE = "\
+    You will receive {count} images, labelled Image 1 to Image {count}. \
+    Apply the instructions above to each image independently. \
+    Return only a JSON array with exactly {count} elements, where element i is the JSON output for Image i, in the same order. \
+    "
+
+OCR_CLIENT_TEXT_PASS_MESSAGE = "\
+    Instead of the image, you get the text extracted from it by OCR, line by line, in reading order: \
+    \n```\n{text}\n```\n"
+
+OCR_CLIENT_LOCAL_OCR_MESSAGE = "\
+    The text below was extracted from the image by local OCR, line by line, in reading order. \
+    Use it as the source of the text, and the image for the layout and to correct obvious OCR mistakes: \
+    \n```\n{text}\n```\n"
+
+# Azure OpenAI GPT-4V accepts at most 10 images per request
+OCR_PACKED_MAX_IMAGES = 10
+
+# GPT-4 Turbo with Vision pricing
+OCR_INPUT_COST_PER_TOKEN = 10.00 / 1000000  # $10.00 / 1M tokens
+OCR_OUTPUT_COST_PER_TOKEN = 30.00 / 1000000  # $30.00 / 1M tokens
+
+# Tokenizer used by GPT-4 models, for local token counting
+OCR_TOKENIZER_ENCODING = "cl100k_base"
+# Every message costs a few tokens for its role/separators, and the reply is primed with 3 more
+OCR_TOKENS_PER_MESSAGE = 3
+OCR_TOKENS_REPLY_PRIMING = 3
+
+# Lazily loaded tiktoken encoding (False if tiktoken isn't available)
+_tokenizer = None
+
+
+class LazySignal:
+    """
+    Per-instance blinker Signal, created on first access, so blinker is only imported when used.
+    Every handler gets its own Signal: a chunk is only dispatched to the receivers of its own request,
+    however many requests are in flight.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        from blinker import Signal
+        # Stored on the instance, which then shadows this (non-data) descriptor
+        signal = instance.__dict__[self.name] = Signal()
+        return signal
+
+
+class AnyOCREngineCancelled(Exception):
+    """
+    A streamed response closed before it completed, because the caller cancelled it or its deadline passed.
+    usage is the estimated usage up to that point, saved_completion_tokens what the rest would have cost.
+    """
+
+    def __init__(self, reason: str, usage, saved_completion_tokens: int):
+        super().__init__(f"Response stream closed early ({reason}), saved about {saved_completion_tokens} completion tokens.")
+        self.reason = reason
+        self.usage = usage
+        self.saved_completion_tokens = saved_completion_tokens
+
+
+class AnyOCREngineJSONCompletionDetector:
+    """
+    Stop condition for streamed responses: detects when the top-level JSON value (optionally inside
+    a ```json fence) is complete, so trailing commentary isn't generated.
+    Content that doesn't start with a JSON value (e.g. a markdown table) never completes.
+
+    Any object with the same feed() can be used as a stop condition by recognize().
+    """
+
+    def __init__(self):
+        self.prefix = ""
+        self.started = False
+        self.disabled = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> int | None:
+        # Returns the length of the chunk up to the end of the JSON value once it's complete, else None
+        if self.disabled:
+            return None
+
+        for i, char in enumerate(chunk):
+            if not self.started:
+                if char in "{[":
+                    self.started = True
+                    self.depth = 1
+                    continue
+                self.prefix += char
+                if not "```json".startswith(self.prefix.strip().lower()):
+                    self.disabled = True
+                    return None
+                continue
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return None
+
 
 # @dataclass
 class AnyOCREngineResponseHandler:
     # Define handler's name
     name: str
 
-    # Define signals
-    on_all_content_available = Signal()
-    on_chunked_content_available = Signal()
-    on_non_json_content = Signal()
-    on_error = Signal()
+    # Define signals, one set per handler instance
+    on_all_content_available = LazySignal()
+    on_chunked_content_available = LazySignal()
+    on_non_json_content = LazySignal()
+    on_usage_available = LazySignal()
+    on_error = LazySignal()
+    on_completed = LazySignal()
 
     def __init__(self, name: str):
         self.name = name
 
+    def send(self, signal_name: str, **kwargs):
+        # Signals nobody connected to are never created, so sending to them costs a dict lookup
+        signal = self.__dict__.get(signal_name)
+        if signal is not None and signal.receivers:
+            signal.send(self, **kwargs)
+
     def handle_all_content_available(self, content):
-        self.on_all_content_available.send(self, content=content)
+        self.send("on_all_content_available", content=content)
 
     def handle_chunked_content_available(self, content):
-        self.on_chunked_content_available.send(self, content=content)
+        self.send("on_chunked_content_available", content=content)
 
     def handle_non_json_content(self, content):
-        print("Not a JSON\n")
-        self.print_content(content)
-        self.on_non_json_content.send(self, content=content)
+        logging.getLogger("rich").debug(f"Not a JSON: {content}")
+        self.send("on_non_json_content", content=content)
 
     def handle_default_response(self, content):
         self.print_content(content)
 
+    def handle_usage_available(self, usage):
+        # usage has prompt_tokens, completion_tokens, total_tokens, and estimated=True when counted locally
+        self.send("on_usage_available", usage=usage)
+
     def handle_error(self, content):
-        self.on_error.send(self, content=content)
+        self.send("on_error", content=content)
+
+    def handle_completed(self):
+        # Last event of every recognize() call, also when it failed
+        self.send("on_completed")
 
     def print_content(self, content):
         print(content, end="")
@@ -62,6 +215,67 @@ class AnyOCREngineResponseHandler:
         return f"<AnyOCREngineResponseHandler {self.name}>"
 
 
+class AnyOCREngineQueueResponseHandler(AnyOCREngineResponseHandler):
+    """
+    Response handler that queues the events of one request for a consumer, instead of calling receivers
+    from the engine's thread. Events are (event, payload) tuples: ("chunk", str), ("content", str),
+    ("non_json", str), ("usage", usage), ("error", exception), and finally ("completed", None).
+
+    Iterate it from another thread, or with `async for` from an event loop (pass loop=, events are then
+    handed over with loop.call_soon_threadsafe()).
+    """
+
+    def __init__(self, name: str, loop=None):
+        super().__init__(name)
+        self.loop = loop
+        if loop is None:
+            self._queue = queue.Queue()
+        else:
+            import asyncio
+            self._queue = asyncio.Queue()
+
+    def put(self, event: str, payload=None):
+        if self.loop is None:
+            self._queue.put((event, payload))
+        else:
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, (event, payload))
+
+    def handle_all_content_available(self, content):
+        self.put("content", content)
+
+    def handle_chunked_content_available(self, content):
+        self.put("chunk", content)
+
+    def handle_non_json_content(self, content):
+        self.put("non_json", content)
+
+    def handle_usage_available(self, usage):
+        self.put("usage", usage)
+
+    def handle_error(self, content):
+        self.put("error", content)
+
+    def handle_completed(self):
+        self.put("completed")
+
+    def __iter__(self):
+        while True:
+            event = self._queue.get()
+            yield event
+            if event[0] == "completed":
+                return
+
+    async def __aiter__(self):
+        while True:
+            event = await self._queue.get()
+            yield event
+            if event[0] == "completed":
+                return
+
+    def __repr__(self):
+        return f"<AnyOCREngineQueueResponseHandler {self.name}>"
+
+
 class AnyOCREngineImageDetailLevel(Enum):
     DetailAuto = "auto"
     DetailLow = "low"
@@ -84,12 +298,32 @@ class AnyOCREngine:
     azure_vision_endpoint: str | None = None
     azure_vision_api_version: str | None = None
     system_message: str = OCR_CLIENT_SYSTEM_MESSAGE
+    # Ask for the final usage chunk of streamed responses (stream_options), on the plain route only
+    stream_include_usage: bool = False
+    # httpx.Client used by the upstream client instead of its own, e.g. to record or replay traffic (see AnyOCRCassette)
+    http_client = None
+    # AnyOCRTextCache of OCR/grounding output, so prompting an image again is a text-only pass
+    text_cache = None
+    # Cached OCR text is only reused within the same scope (e.g. the API tenant), set on per-request copies
+    text_cache_scope: str | None = None
+    # Circuit breakers per upstream route ({"vision", "plain"}, see AnyOCRCircuitBreaker), shared between engine copies
+    circuit_breakers = None
 
     response_handler: AnyOCREngineResponseHandler = None
 
-    openai_base_url: str
-
     last_all_content: str = ""
+    # The answer as generated when compact output was asked for, before it was expanded
+    last_compact_content: str = ""
+    # OCR/grounding output sent by Azure AI Vision enhancements, when active: the text of all lines, and the whole output
+    last_grounding_content: str = ""
+    last_grounding: dict | None = None
+    # Whether the last call was a text-only pass over cached OCR text
+    last_ocr_text_reused: bool = False
+    # Whether the last call went to the plain route because the vision route's circuit was open
+    last_route_fallback: bool = False
+    last_usage = None
+    # Whether the last streamed response was closed by its stop condition
+    last_stopped_early: bool = False
 
     def __init__(
         self,
@@ -104,6 +338,10 @@ class AnyOCREngine:
         azure_vision_api_version: str | None = None,
         system_message: str | None = OCR_CLIENT_SYSTEM_MESSAGE,
         response_handler=None,
+        stream_include_usage: bool = False,
+        http_client=None,
+        text_cache=None,
+        circuit_breakers=None,
     ):
 
         # super().__init__(api_key = api_key,
@@ -143,6 +381,10 @@ class AnyOCREngine:
         self.azure_vision_api_version = azure_vision_api_version
         self.system_message = system_message
         self.response_handler = response_handler
+        self.stream_include_usage = stream_include_usage
+        self.http_client = http_client
+        self.text_cache = text_cache
+        self.circuit_breakers = circuit_breakers
 
 
     def recognize(
@@ -154,12 +396,704 @@ class AnyOCREngine:
         img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
         max_tokens: int = 4096,
         temperature: float = 0.2,
+        timeout: float | None = None,
+        cancel_event=None,
+        stop_condition=None,
+        reuse_ocr_text: bool = True,
+        compact_output: bool = False,
+        fallback_user_message: str | None = None,
+        wait_for_grounding: bool = False,
+    ):
+        """
+        timeout caps the whole call in seconds. When streaming, the stream is closed as soon as
+        cancel_event (a threading.Event) is set or the deadline passes, and AnyOCREngineCancelled is raised.
+        With a stop_condition (e.g. AnyOCREngineJSONCompletionDetector), the stream is also closed once
+        the answer is complete, and the response ends there.
+        The response handler gets handle_error() when the call fails, and handle_completed() last in any case.
+        With a text_cache holding the OCR output of this image (from an earlier call with Azure AI Vision
+        enhancements), and reuse_ocr_text, the call is a text-only pass over that text, without the image.
+        Only streamed vision responses fill the cache: the grounding output comes after the answer, so closing
+        the stream early loses it and the image isn't cached. With wait_for_grounding, the stream is read to its end instead: the rest of
+        the answer is dropped but still generated and billed, and counted in the estimated usage.
+        With compact_output, the template is wrapped to ask for arrays of objects in a keyless, columnar form
+        (see AnyOCRCompact), and last_all_content is the answer expanded back to the template's shape.
+        Streamed chunks are still the compact answer.
+        With circuit_breakers, the call goes to the plain route while the vision route's breaker is open,
+        with fallback_user_message (a template variant for the plain route) instead of user_message if given.
+        """
+        try:
+            return self._recognize(
+                img_src=img_src,
+                user_message=user_message,
+                streaming_response=streaming_response,
+                img_detail_level=img_detail_level,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                timeout=timeout,
+                cancel_event=cancel_event,
+                stop_condition=stop_condition,
+                reuse_ocr_text=reuse_ocr_text,
+                compact_output=compact_output,
+                fallback_user_message=fallback_user_message,
+                wait_for_grounding=wait_for_grounding,
+            )
+        except Exception as e:
+            if self.response_handler is not None:
+                self.response_handler.handle_error(e)
+            raise
+        finally:
+            if self.response_handler is not None:
+                self.response_handler.handle_completed()
+
+    def _recognize(
+        self,
+        *,
+        img_src: str,
+        user_message: str | None = None,
+        streaming_response: bool = True,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        timeout: float | None = None,
+        cancel_event=None,
+        stop_condition=None,
+        reuse_ocr_text: bool = True,
+        compact_output: bool = False,
+        fallback_user_message: str | None = None,
+        wait_for_grounding: bool = False,
     ):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        # OCR text of this image from an earlier call with enhancements, if any. Only streamed responses
+        # read to their end carry the grounding output, the key isn't needed for anything else.
+        cached_ocr = None
+        ocr_key = None
+        can_cache_grounding = self.azure_vision_active and streaming_response and (stop_condition is None or wait_for_grounding)
+        if self.text_cache is not None and (reuse_ocr_text or can_cache_grounding):
+            from AnyOCRTextCache import ocr_text_key
+            from AnyOCRDocument import is_remote, fetch_data_url
+            try:
+                # Downloaded once: the same bytes are hashed and sent upstream
+                if is_remote(img_src):
+                    img_src = fetch_data_url(img_src)
+                ocr_key = ocr_text_key(img_src, self.text_cache_scope)
+            except Exception as e:
+                # The upstream call may still be able to read the image
+                logging.getLogger("rich").warning(f"Can't read image, OCR text cache skipped: {e}")
+            if ocr_key is not None and reuse_ocr_text:
+                cached_ocr = self.text_cache.get(ocr_key)
+        # The text-only pass goes to the plain route
+        azure_vision_active = self.azure_vision_active and cached_ocr is None
+        routed_vision_active = self._choose_route(azure_vision_active)
+        route_fallback = azure_vision_active and not routed_vision_active
+        azure_vision_active = routed_vision_active
+        if route_fallback and fallback_user_message is not None:
+            user_message = fallback_user_message
+
+        if compact_output:
+            from AnyOCRCompact import wrap_compact_prompt
+            user_message = wrap_compact_prompt(user_message)
+
+        # Outcome and latency are tracked by the route's circuit breaker, if any
+        with self._track_route(azure_vision_active) as route_call:
+            # Create AzureOpenAI client and additional body parameters
+            client, extra_body = self._create_client(azure_vision_active, timeout)
+
+            # The /extensions route doesn't accept stream_options (and this openai version has no parameter for it)
+            if streaming_response and self.stream_include_usage and not azure_vision_active:
+                extra_body = {**extra_body, "stream_options": {"include_usage": True}}
+
+            # Send request to the OCR service
+            if cached_ocr is not None:
+                messages = self.build_text_messages(user_message, cached_ocr["text"])
+            else:
+                messages = self.build_messages(user_message, img_src, img_detail_level)
+            response = client.chat.completions.create(
+                model=self.azure_deployment_name,
+                messages=messages,
+                extra_body=extra_body,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=streaming_response,
+            )
+
+            # Prepare a variable to store the all content
+            self.last_all_content = ""
+            self.last_compact_content = ""
+            self.last_grounding_content = cached_ocr["text"] if cached_ocr is not None else ""
+            self.last_grounding = cached_ocr["grounding"] if cached_ocr is not None else None
+            self.last_ocr_text_reused = cached_ocr is not None
+            self.last_route_fallback = route_fallback
+            self.last_usage = None
+            self.last_stopped_early = False
+
+            # Process the response
+            if not streaming_response:
+                # print(response.model_dump_json())
+                self.last_all_content = response.choices[0].message.content
+                self.last_usage = response.usage
+                if compact_output:
+                    self.last_compact_content = self.last_all_content
+                    self.last_all_content = AnyOCREngine.expand_compact_content(self.last_all_content)
+                if self.response_handler is not None and self.last_all_content != "":
+                    self.response_handler.handle_all_content_available(self.last_all_content)
+
+            else:
+                # If streaming response is enabled
+                answer_complete = False
+                # Generated after the answer was complete, read only to get to the grounding output
+                discarded_content = ""
+                for response_chunk in response:
+                    if route_call is not None:
+                        route_call.first_response()
+
+                    if cancel_event is not None and cancel_event.is_set():
+                        self._close_stream(response, messages, user_message, "cancelled")
+                    if deadline is not None and time.monotonic() > deadline:
+                        self._close_stream(response, messages, user_message, "timeout")
+
+                    # The final usage chunk (if requested and supported) has no choices
+                    if getattr(response_chunk, "usage", None) is not None:
+                        self.last_usage = response_chunk.usage
+
+                    if not response_chunk.choices:
+                        continue
+
+                    # print(response_chunk.model_dump_json())
+                    if azure_vision_active:
+                        # Deltas without content (e.g. only a role) are skipped
+                        delta_content = response_chunk.choices[0].messages[0]["delta"].get("content")
+                        if delta_content is not None:
+                            if "grounding" in delta_content:
+                                # Handle all content response
+                                try:
+                                    parsed_content = json.loads(
+                                        delta_content
+                                    )
+                                    from AnyOCRTextCache import grounding_text
+                                    self.last_grounding = parsed_content["grounding"]
+                                    self.last_grounding_content = grounding_text(self.last_grounding)
+                                    if self.response_handler is not None:
+                                        self.response_handler.handle_all_content_available(
+                                            self.last_grounding_content
+                                        )
+
+                                except json.JSONDecodeError:
+                                    logging.getLogger("rich").warning("Grounding content is not JSON")
+                                    if self.response_handler is not None:
+                                        self.response_handler.handle_non_json_content(
+                                            delta_content
+                                        )
+
+                            elif answer_complete:
+                                discarded_content += delta_content
+
+                            else:
+                                # Handle chunked response
+                                chunk_content = delta_content
+                                stop_at = stop_condition.feed(chunk_content) if stop_condition is not None else None
+                                if stop_at is not None:
+                                    chunk_content = chunk_content[:stop_at]
+                                    discarded_content = delta_content[stop_at:]
+
+                                # Dispatched once per chunk, not per character
+                                self.last_all_content += chunk_content
+                                if self.response_handler is not None:
+                                    self.response_handler.handle_chunked_content_available(
+                                        chunk_content
+                                    )
+
+                                if stop_at is not None:
+                                    # The grounding output comes last: only read on to it when asked to
+                                    if wait_for_grounding and self.text_cache is not None:
+                                        answer_complete = True
+                                        continue
+                                    self._stop_stream(response)
+                                    break
+                    else:
+                        if response_chunk.choices[0].delta.content is not None:
+                            # Handle chunked response
+                            chunk_content = response_chunk.choices[0].delta.content
+                            stop_at = stop_condition.feed(chunk_content) if stop_condition is not None else None
+                            if stop_at is not None:
+                                chunk_content = chunk_content[:stop_at]
+
+                            self.last_all_content += chunk_content
+
+                            if self.response_handler is not None:
+                                self.response_handler.handle_chunked_content_available(
+                                    chunk_content
+                                )
+
+                            if stop_at is not None:
+                                self._stop_stream(response)
+                                break
+
+                # Usage is counted over what the model generated, i.e. the compact answer
+                completion_content = self.last_all_content
+                if compact_output:
+                    self.last_compact_content = self.last_all_content
+                    self.last_all_content = AnyOCREngine.expand_compact_content(self.last_all_content)
+
+                # Handle the all content response only if azure_vision_active is False
+                if not azure_vision_active:
+                    if self.response_handler is not None and self.last_all_content != "":
+                        self.response_handler.handle_all_content_available(self.last_all_content)
+
+                if self.last_usage is None:
+                    # The dropped rest of the answer was generated and billed too
+                    self.last_usage = AnyOCREngine.estimate_stream_usage(messages, completion_content + discarded_content)
+
+        # Kept for text-only passes over this image with other prompts
+        if ocr_key is not None and self.last_grounding is not None and not self.last_ocr_text_reused:
+            self.text_cache.put(ocr_key, self.last_grounding)
+
+        if self.response_handler is not None and self.last_usage is not None:
+            self.response_handler.handle_usage_available(self.last_usage)
+
+        return response
+
+    def _stop_stream(self, response):
+        # The answer is complete: closing the connection stops whatever the model would generate after it
+        response.close()
+        self.last_stopped_early = True
+        logging.getLogger("rich").debug("Response stream closed once the answer was complete")
+
+    def _close_stream(self, response, messages: list, user_message: str | None, reason: str):
+        # Closing the connection stops the generation upstream, so the remaining completion tokens aren't billed
+        response.close()
+        self.last_usage = AnyOCREngine.estimate_stream_usage(messages, self.last_all_content)
+        saved_completion_tokens = max(0, AnyOCREngine.estimate_completion_tokens(user_message) - self.last_usage.completion_tokens)
+        logging.getLogger("rich").info(f"Response stream closed early ({reason}), saved about [bold green]{saved_completion_tokens}[/] completion tokens", extra={"markup": True})
+        raise AnyOCREngineCancelled(reason, self.last_usage, saved_completion_tokens)
+
+    def recognize_document(
+        self,
+        *,
+        doc_src: str,
+        user_message: str | None = None,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        max_workers: int = 4,
+        convert_idr: bool = False,
+        timeout: float | None = None,
+    ) -> dict:
+        """
+        Recognize a multi-page document (PDF/TIFF). Pages are rasterized for the given detail level,
+        recognized concurrently, and the per-page JSON results are merged into one.
+        """
+        from AnyOCRDocument import DOCUMENT_DOWNLOAD_TIMEOUT, rasterize_document
+
+        # A remote document is downloaded within the same timeout as the calls
+        pages = rasterize_document(doc_src, img_detail_level.value, timeout or DOCUMENT_DOWNLOAD_TIMEOUT)
+        logging.getLogger("rich").info(f"Document has [bold green]{len(pages)}[/] page(s)", extra={"markup": True})
+
+        return self._recognize_parts(
+            [self.build_messages(user_message, page_img_src, img_detail_level) for page_img_src in pages],
+            part_name="page",
+            max_tokens=max_tokens,
+            temperature=temperature,
+            max_workers=max_workers,
+            convert_idr=convert_idr,
+            timeout=timeout,
+        )
+
+    def recognize_tiled(
+        self,
+        *,
+        img_src: str,
+        user_message: str | None = None,
+        overlap_ratio: float = 0.1,
+        max_tiles: int = 6,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        max_workers: int = 4,
+        convert_idr: bool = False,
+        timeout: float | None = None,
+    ) -> dict:
+        """
+        Recognize an oversized table image by splitting it into overlapping tiles (see split_image_tiles()):
+        horizontal strips for a tall image, vertical slices with the leftmost column repeated for a wide one.
+        Tiles are recognized concurrently in high detail with a tile-aware prompt. The rows of strips are
+        stitched back together, dropping rows repeated in the overlap; the columns of slices are joined
+        row by row on the repeated column, dropping columns repeated in the overlap.
+        """
+        from AnyOCRDocument import split_image_tiles
+
+        layout, tiles = split_image_tiles(img_src, overlap_ratio=overlap_ratio, max_tiles=max_tiles)
+        logging.getLogger("rich").info(f"Image is split into [bold green]{len(tiles)}[/] tile(s){f' by {layout}' if layout else ''}", extra={"markup": True})
+
+        tile_template = OCR_CLIENT_COLUMN_TILE_MESSAGE if layout == "columns" else OCR_CLIENT_TILE_MESSAGE
+        part_messages = []
+        for tile_no, tile_img_src in enumerate(tiles, start=1):
+            tile_message = user_message
+            if len(tiles) > 1:
+                tile_message = f"{user_message}\n\n{tile_template.format(index=tile_no, count=len(tiles))}"
+            part_messages.append(
+                self.build_messages(tile_message, tile_img_src, AnyOCREngineImageDetailLevel.DetailHigh)
+            )
+
+        return self._recognize_parts(
+            part_messages,
+            part_name="tile",
+            dedup_overlap=True,
+            side_by_side=layout == "columns",
+            max_tokens=max_tokens,
+            temperature=temperature,
+            max_workers=max_workers,
+            convert_idr=convert_idr,
+            timeout=timeout,
+        )
+
+    def recognize_packed(
+        self,
+        *,
+        img_srcs: list,
+        user_message: str | None = None,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailLow,
+        pack_size: int | None = None,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        max_workers: int = 4,
+        convert_idr: bool = False,
+        timeout: float | None = None,
+    ) -> dict:
+        """
+        Recognize several small images (e.g. toll receipts, KTP front/back) with the same prompt,
+        packing N images into one chat completion so the system message and template are sent once per pack.
+        N is chosen from the token budgets unless pack_size is given. Images whose result can't be split
+        out of the model's JSON array are recognized again one by one.
+        """
+        if pack_size is None:
+            pack_size = AnyOCREngine.choose_pack_size(user_message, len(img_srcs), img_detail_level, max_tokens)
+        pack_size = max(1, min(pack_size, OCR_PACKED_MAX_IMAGES))
+        packs = [list(range(i, min(i + pack_size, len(img_srcs)))) for i in range(0, len(img_srcs), pack_size)]
+        logging.getLogger("rich").info(f"Packing [bold green]{len(img_srcs)}[/] image(s) into {len(packs)} request(s)", extra={"markup": True})
+
+        def recognize_pack(indices: list):
+            start_time = time.time()
+            messages = self.build_packed_messages(user_message, [img_srcs[i] for i in indices], img_detail_level)
+            # Azure Vision enhancements only work on a single image, so packs use the plain GPT-4V route
+            response = self._complete(
+                messages, max_tokens=max_tokens, temperature=temperature, azure_vision_active=False, timeout=timeout
+            )
+            return response, time.time() - start_time
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(packs)))) as executor:
+            pack_responses = list(executor.map(recognize_pack, packs))
+
+        results = [None] * len(img_srcs)
+        pack_results = []
+        usages = []
+        for indices, (response, latency) in zip(packs, pack_responses):
+            usages.append(response.usage)
+            pack_results.append({
+                "images": indices,
+                "latency": latency,
+                "usage": AnyOCREngine.process_token_usage(response.usage),
+            })
+
+            content = response.choices[0].message.content or ""
+            try:
+                parsed_items = AnyOCREngine.parse_json_content(content)
+            except json.JSONDecodeError:
+                parsed_items = None
+            if not isinstance(parsed_items, list) or len(parsed_items) != len(indices):
+                logging.getLogger("rich").warning(f"Packed response for images {indices} can't be split, retrying one by one")
+                continue
+
+            for i, parsed_item in zip(indices, parsed_items):
+                results[i] = {"index": i, "status": "OK", "data": parsed_item}
+
+        # Fallback for images whose result couldn't be split out of their pack
+        for i, result in enumerate(results):
+            if result is not None:
+                continue
+            start_time = time.time()
+            response = self._complete(
+                self.build_messages(user_message, img_srcs[i], img_detail_level),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                timeout=timeout,
+            )
+            usages.append(response.usage)
+            pack_results.append({
+                "images": [i],
+                "latency": time.time() - start_time,
+                "usage": AnyOCREngine.process_token_usage(response.usage),
+            })
+
+            content = response.choices[0].message.content or ""
+            try:
+                results[i] = {"index": i, "status": "OK", "data": AnyOCREngine.parse_json_content(content)}
+            except json.JSONDecodeError:
+                results[i] = {"index": i, "status": "NOT_JSON", "content": content}
+
+        return {
+            "status": "OK",
+            "results": results,
+            "packs": pack_results,
+            "usage": AnyOCREngine.process_token_usage(AnyOCREngine.sum_token_usage(usages), convert_idr),
+        }
+
+    def recognize_hybrid(
+        self,
+        *,
+        img_src: str,
+        user_message: str | None = None,
+        min_confidence: float | None = None,
+        min_words: int | None = None,
+        lang: str | None = None,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        convert_idr: bool = False,
+        timeout: float | None = None,
+        stats=None,
+    ) -> dict:
+        """
+        Recognize a clean printed document (e.g. toll receipt, fuel slip) with a local OCR pre-pass.
+        Tesseract reads the image first; if its mean word confidence is at least min_confidence, its text
+        is sent with a low-detail image on the plain route, for GPT-4V to structure. Otherwise (or when
+        local OCR isn't available) the image is recognized in high detail as usual. The path taken is
+        recorded to stats (AnyOCRHybridStats), if given.
+        """
+        from AnyOCRLocalOCR import (
+            run_local_ocr,
+            OCR_LOCAL_OCR_DEFAULT_LANG,
+            OCR_LOCAL_OCR_DEFAULT_MIN_CONFIDENCE,
+            OCR_LOCAL_OCR_DEFAULT_MIN_WORDS,
+        )
+
+        if min_confidence is None:
+            min_confidence = OCR_LOCAL_OCR_DEFAULT_MIN_CONFIDENCE
+        if min_words is None:
+            min_words = OCR_LOCAL_OCR_DEFAULT_MIN_WORDS
+
+        start_time = time.time()
+        try:
+            local_ocr = run_local_ocr(img_src, lang or OCR_LOCAL_OCR_DEFAULT_LANG)
+        except Exception as e:
+            # pytesseract or the tesseract binary missing, or an image Tesseract can't read
+            logging.getLogger("rich").warning(f"Local OCR failed, recognizing in high detail: {e}")
+            local_ocr = None
+        local_ocr_latency = time.time() - start_time
+
+        if local_ocr is not None and local_ocr["confidence"] >= min_confidence and local_ocr["words"] >= min_words:
+            path = "hybrid"
+            messages = self.build_hybrid_messages(user_message, img_src, local_ocr["text"])
+            # The local OCR text stands in for Azure Vision enhancements
+            azure_vision_active = False
+        else:
+            path = "high_detail"
+            messages = self.build_messages(user_message, img_src, AnyOCREngineImageDetailLevel.DetailHigh)
+            azure_vision_active = None
+        logging.getLogger("rich").info(
+            f"Local OCR confidence [bold green]{local_ocr['confidence'] if local_ocr else 0:.2f}[/], taking the {path} path",
+            extra={"markup": True},
+        )
+
+        response = self._complete(
+            messages, max_tokens=max_tokens, temperature=temperature, azure_vision_active=azure_vision_active, timeout=timeout
+        )
+        latency = time.time() - start_time
+        usage = AnyOCREngine.process_token_usage(response.usage, convert_idr)
+        if stats is not None:
+            stats.record(path, usage, latency)
+
+        result = {
+            "path": path,
+            "local_ocr": None if local_ocr is None else {
+                "confidence": local_ocr["confidence"],
+                "words": local_ocr["words"],
+                "latency": local_ocr_latency,
+            },
+            "latency": latency,
+            "usage": usage,
+        }
+        content = response.choices[0].message.content or ""
+        try:
+            result.update({"status": "OK", "data": AnyOCREngine.parse_json_content(content)})
+        except json.JSONDecodeError:
+            result.update({"status": "NOT_JSON", "content": content})
+        return result
+
+    def recognize_multi(
+        self,
+        *,
+        img_src: str,
+        user_messages: list,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        max_workers: int = 4,
+        convert_idr: bool = False,
+        timeout: float | None = None,
+    ) -> dict:
+        """
+        Run several prompts (e.g. document type check, field extraction, clarity judgement) against one image,
+        loaded and encoded once by the caller. Prompts are sent concurrently as separate requests, and the
+        results come back in prompt order with their own usage and latency.
+        """
+        def recognize_prompt(user_message: str | None):
+            start_time = time.time()
+            response = self._complete(
+                self.build_messages(user_message, img_src, img_detail_level),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                timeout=timeout,
+            )
+            return response, time.time() - start_time
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(user_messages)))) as executor:
+            prompt_responses = list(executor.map(recognize_prompt, user_messages))
+
+        results = []
+        for i, (response, latency) in enumerate(prompt_responses):
+            content = response.choices[0].message.content or ""
+            result = {
+                "index": i,
+                "latency": latency,
+                "usage": AnyOCREngine.process_token_usage(response.usage, convert_idr),
+            }
+            try:
+                result.update({"status": "OK", "data": AnyOCREngine.parse_json_content(content)})
+            except json.JSONDecodeError:
+                # e.g. a free-text judgement
+                result.update({"status": "NOT_JSON", "content": content})
+            results.append(result)
+
+        return {
+            "status": "OK",
+            "results": results,
+            "usage": AnyOCREngine.process_token_usage(
+                AnyOCREngine.sum_token_usage([response.usage for response, _ in prompt_responses]), convert_idr
+            ),
+        }
 
+    def build_packed_messages(
+        self,
+        user_message: str | None,
+        img_srcs: list,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailLow,
+    ) -> list:
+        user_content = [
+            {"type": "text", "text": f"{user_message}\n\n{OCR_CLIENT_PACKED_MESSAGE.format(count=len(img_srcs))}"}
+        ]
+        for img_no, img_src in enumerate(img_srcs, start=1):
+            user_content.append({"type": "text", "text": f"Image {img_no}:"})
+            user_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": img_src,
+                    "detail": img_detail_level.value,
+                },
+            })
+
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": user_content},
+        ]
+
+    def _recognize_parts(
+        self,
+        part_messages: list,
+        *,
+        part_name: str,
+        dedup_overlap: bool = False,
+        side_by_side: bool = False,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        max_workers: int = 4,
+        convert_idr: bool = False,
+        timeout: float | None = None,
+    ) -> dict:
+        # Recognize parts (pages/tiles) of one document concurrently and merge their JSON results,
+        # side_by_side for column tiles
+        from AnyOCRDocument import merge_column_results, merge_json_results
+
+        def recognize_part(messages: list):
+            start_time = time.time()
+            response = self._complete(messages, max_tokens=max_tokens, temperature=temperature, timeout=timeout)
+            return response, time.time() - start_time
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(part_messages)))) as executor:
+            part_responses = list(executor.map(recognize_part, part_messages))
+
+        part_results = []
+        parsed_parts = []
+        for part_no, (response, latency) in enumerate(part_responses, start=1):
+            content = response.choices[0].message.content or ""
+            part_result = {
+                part_name: part_no,
+                "latency": latency,
+                "usage": AnyOCREngine.process_token_usage(response.usage),
+            }
+            try:
+                parsed_parts.append(AnyOCREngine.parse_json_content(content))
+                part_result["status"] = "OK"
+            except json.JSONDecodeError:
+                part_result["status"] = "NOT_JSON"
+                part_result["content"] = content
+            part_results.append(part_result)
+
+        return {
+            "status": "OK" if parsed_parts else "NOT_JSON",
+            "data": merge_column_results(parsed_parts) if side_by_side else merge_json_results(parsed_parts, dedup_overlap),
+            f"{part_name}s": part_results,
+            "usage": AnyOCREngine.process_token_usage(
+                AnyOCREngine.sum_token_usage([response.usage for response, _ in part_responses]), convert_idr
+            ),
+        }
+
+    def build_messages(
+        self,
+        user_message: str | None,
+        img_src: str,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+    ) -> list:
+        return [
+            {"role": "system", "content": self.system_message},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": user_message},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": img_src,
+                            "detail": img_detail_level.value,
+                        },
+                    },
+                ],
+            },
+        ]
+
+    def build_text_messages(self, user_message: str | None, ocr_text: str) -> list:
+        # Text-only pass: the OCR text of the image stands in for the image
+        return [
+            {"role": "system", "content": self.system_message},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": user_message},
+                    {"type": "text", "text": OCR_CLIENT_TEXT_PASS_MESSAGE.format(text=ocr_text)},
+                ],
+            },
+        ]
+
+    def build_hybrid_messages(self, user_message: str | None, img_src: str, local_ocr_text: str) -> list:
+        # Local OCR text with a low-detail image, for the hybrid pre-pass
+        messages = self.build_messages(user_message, img_src, AnyOCREngineImageDetailLevel.DetailLow)
+        messages[1]["content"].insert(1, {"type": "text", "text": OCR_CLIENT_LOCAL_OCR_MESSAGE.format(text=local_ocr_text)})
+        return messages
+
+    def _create_client(self, azure_vision_active: bool, timeout: float | None = None):
+        # Pages/tiles call this concurrently on the same engine, so the route's base URL stays local
         # Check if Azure Vision is used
-        if self.azure_vision_active:
-            self.api_version = self.azure_vision_api_version
-            self.openai_base_url = f"{self.azure_base_url}/openai/deployments/{self.azure_deployment_name}/extensions"
+        if azure_vision_active:
+            api_version = self.azure_vision_api_version
+            base_url = f"{self.azure_base_url}/openai/deployments/{self.azure_deployment_name}/extensions"
 
             # Set additional body parameters for Azure Computer Vision
             extra_body = {
@@ -178,109 +1112,74 @@ class AnyOCREngine:
                 },
             }
         else:
-            # api_version = self.api_version
-            self.openai_base_url = (
-                f"{self.azure_base_url}/openai/deployments/{self.azure_deployment_name}"
-            )
+            api_version = self.api_version
+            base_url = f"{self.azure_base_url}/openai/deployments/{self.azure_deployment_name}"
             extra_body = {}
 
         # Create AzureOpenAI client
+        from openai import AzureOpenAI
+        client_options = {}
+        if timeout is not None:
+            # A retry would run past the deadline
+            client_options = {"timeout": timeout, "max_retries": 0}
+        if self.http_client is not None:
+            client_options["http_client"] = self.http_client
         client = AzureOpenAI(
             api_key=self.api_key,
-            api_version=self.api_version,
-            base_url=self.openai_base_url,
+            api_version=api_version,
+            base_url=base_url,
+            **client_options,
         )
+        return client, extra_body
 
-        # Send request to the OCR service
-        response = client.chat.completions.create(
-            model=self.azure_deployment_name,
-            messages=[
-                {"role": "system", "content": self.system_message},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_message},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": img_src,
-                                "detail": img_detail_level.value,
-                            },
-                        },
-                    ],
-                },
-            ],
-            extra_body=extra_body,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            stream=streaming_response,
-        )
-
-        # Prepare a variable to store the all content
-        self.last_all_content = ""
-
-        # Process the response
-        if not streaming_response:
-            # print(response.model_dump_json())
-            self.last_all_content = response.choices[0].message.content
-            if self.response_handler is not None and self.last_all_content != "":
-                self.response_handler.handle_all_content_available(self.last_all_content)
-
-        else:
-            # If streaming response is enabled
-            for response_chunk in response:
-
-                if not response_chunk.choices:
-                    continue
-
-                # print(response_chunk.model_dump_json())
-                if self.azure_vision_active:
-                    if response_chunk.choices[0].messages[0]["delta"]["content"] is not None:
-                        if "grounding" in response_chunk.choices[0].messages[0]["delta"]["content"]:
-                            # Handle all content response
-                            try:
-                                if self.response_handler is not None:
-                                    parsed_content = json.loads(
-                                        response_chunk.choices[0].messages[0]["delta"]["content"]
-                                    )
-                                    self.last_all_content = parsed_content["grounding"]["lines"][0]["text"]
-                                    self.response_handler.handle_all_content_available(
-                                        self.last_all_content
-                                    )
-
-                            except json.JSONDecodeError:
-                                print("Not a JSON\n")
-                                if self.response_handler is not None:
-                                    self.response_handler.handle_non_json_content(
-                                        response_chunk.choices[0].messages[0]["delta"]["content"]
-                                    )
-
-                        else:
-                            # Handle chunked response
-                            for item in response_chunk.choices[0].messages[0]["delta"]["content"]:
-                                self.last_all_content += item
-                                
-                                if self.response_handler is not None:
-                                    self.response_handler.handle_chunked_content_available(
-                                        item
-                                    )
-                else:
-                    if response_chunk.choices[0].delta.content is not None:
-                        # Handle chunked response
-                        chunk_content = response_chunk.choices[0].delta.content
-                        self.last_all_content += chunk_content
-
-                        if self.response_handler is not None:
-                            self.response_handler.handle_chunked_content_available(
-                                chunk_content
-                            )
-
-            # Handle the all content response only if azure_vision_active is False
-            if not self.azure_vision_active:
-                if self.response_handler is not None and self.last_all_content != "":
-                    self.response_handler.handle_all_content_available(self.last_all_content)
+    def _complete(
+        self,
+        messages: list,
+        *,
+        max_tokens: int = 4096,
+        temperature: float = 0.2,
+        azure_vision_active: bool | None = None,
+        timeout: float | None = None,
+    ):
+        # Non-streaming call that leaves last_all_content and the response handler untouched,
+        # so it's safe to run concurrently from worker threads
+        if azure_vision_active is None:
+            azure_vision_active = self.azure_vision_active
+        azure_vision_active = self._choose_route(azure_vision_active)
+        with self._track_route(azure_vision_active):
+            client, extra_body = self._create_client(azure_vision_active, timeout)
+            return client.chat.completions.create(
+                model=self.azure_deployment_name,
+                messages=messages,
+                extra_body=extra_body,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=False,
+            )
 
-        return response
+    def _choose_route(self, azure_vision_active: bool) -> bool:
+        """
+        Route for the next call, given the circuit breakers: the vision route falls back to the plain one
+        while its breaker is open, and AnyOCRCircuitOpen is raised when the plain route's breaker is open too.
+        Every call routed here must be tracked with _track_route().
+        """
+        if self.circuit_breakers is None:
+            return azure_vision_active
+
+        if azure_vision_active:
+            if self.circuit_breakers["vision"].allow():
+                return True
+            logging.getLogger("rich").warning("Vision route circuit is open, falling back to the plain route")
+
+        if not self.circuit_breakers["plain"].allow():
+            from AnyOCRCircuitBreaker import AnyOCRCircuitOpen
+            raise AnyOCRCircuitOpen("plain", self.circuit_breakers["plain"].retry_after())
+        return False
+
+    def _track_route(self, azure_vision_active: bool):
+        if self.circuit_breakers is None:
+            return contextlib.nullcontext()
+        return self.circuit_breakers["vision" if azure_vision_active else "plain"].track()
 
     ########################## 
     # Helper static methods
@@ -360,9 +1259,199 @@ class AnyOCREngine:
                         return img_base64                        
                 except IOError:
                     raise ValueError(f"File {img_url} is not a valid image file.")
+
+            if AnyOCREngine.is_document(img_url):
+                raise ValueError(f"File {img_url} is a multi-page document. Use recognize_document() instead.")
+            raise ValueError(f"File {img_url} is not a valid image file.")
         else:
             raise FileNotFoundError(f"Image file {img_url} does not exist.")
 
+    def is_document(img_url: str) -> bool:
+        from AnyOCRDocument import is_document
+        return is_document(img_url)
+
+    def parse_json_content(content: str):
+        # Remove markdown code fences (```json ... ```) before parsing
+        cleaned_content = re.sub(r"```(?:json)?", "", content)
+        return json.loads(cleaned_content)
+
+    def expand_compact_content(content: str) -> str:
+        # A compact JSON answer expanded to the template's shape; anything that isn't JSON is kept as is
+        from AnyOCRCompact import expand_compact_json
+        try:
+            data = AnyOCREngine.parse_json_content(content)
+        except json.JSONDecodeError:
+            return content
+        return json.dumps(expand_compact_json(data), ensure_ascii=False, indent=2)
+
+    def estimate_text_tokens(text: str | None) -> int:
+        # Count with the local tokenizer if tiktoken is installed, otherwise ~4 characters per token
+        encoding = AnyOCREngine.get_tokenizer()
+        if encoding is not None:
+            return len(encoding.encode(text or "", disallowed_special=()))
+        return -(-len(text or "") // 4)
+
+    def get_tokenizer():
+        global _tokenizer
+        if _tokenizer is None:
+            try:
+                import tiktoken
+                _tokenizer = tiktoken.get_encoding(OCR_TOKENIZER_ENCODING)
+            except Exception as e:
+                # Not installed, or the encoding file can't be downloaded
+                logging.getLogger("rich").debug(f"Local tokenizer is not available: {e}")
+                _tokenizer = False
+        return _tokenizer or None
+
+    def estimate_image_tokens(
+        width: int | None,
+        height: int | None,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+    ) -> int:
+        # https://platform.openai.com/docs/guides/vision/calculating-costs
+        if img_detail_level == AnyOCREngineImageDetailLevel.DetailLow:
+            return 85
+        if not width or not height:
+            # Unknown size: reserve the worst case of high detail (2048x768 -> 4x2 tiles)
+            return 170 * 8 + 85
+
+        # Fit into 2048x2048, then scale the shortest side down to 768
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        width, height = width * scale, height * scale
+
+        tiles = math.ceil(width / 512) * math.ceil(height / 512)
+        return 170 * tiles + 85
+
+    def get_image_size(img_src: str) -> tuple | None:
+        # Returns (width, height), or None if the image can't be measured (e.g. Pillow isn't installed)
+        try:
+            from PIL import Image
+            from AnyOCRDocument import load_document_bytes
+
+            with Image.open(io.BytesIO(load_document_bytes(img_src))) as image:
+                return image.size
+        except Exception as e:
+            logging.getLogger("rich").debug(f"Can't get image size: {e}")
+            return None
+
+    def estimate_token_usage(
+        user_message: str | None,
+        img_srcs: list,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+        max_tokens: int = 4096,
+        system_message: str | None = OCR_CLIENT_SYSTEM_MESSAGE,
+        separate_requests: bool = False,
+        convert_idr: bool = False,
+    ) -> dict:
+        """
+        Pre-flight estimate of tokens and cost, before anything is sent.
+        Text is counted with the local tokenizer, images from their dimensions and detail level.
+        The completion is estimated from the template's example output, and max_tokens is the reserved upper bound.
+        With separate_requests=True, each image is sent in its own request (e.g. document pages).
+        Tokens added by Azure AI Vision enhancements (OCR/grounding text) are not included.
+        """
+        request_count = len(img_srcs) if separate_requests else 1
+        text_tokens = (
+            AnyOCREngine.estimate_text_tokens(system_message)
+            + AnyOCREngine.estimate_text_tokens(user_message)
+            + OCR_TOKENS_PER_MESSAGE * 2
+            + OCR_TOKENS_REPLY_PRIMING
+        ) * request_count
+
+        images = []
+        for img_src in img_srcs:
+            size = AnyOCREngine.get_image_size(img_src) or (None, None)
+            images.append({
+                "width": size[0],
+                "height": size[1],
+                "tokens": AnyOCREngine.estimate_image_tokens(size[0], size[1], img_detail_level),
+            })
+        image_tokens = sum(image["tokens"] for image in images)
+
+        prompt_tokens = text_tokens + image_tokens
+        expected_completion_tokens = min(max_tokens, AnyOCREngine.estimate_completion_tokens(user_message)) * request_count
+        max_completion_tokens = max_tokens * request_count
+
+        conversion_rate = AnyOCREngine.get_idr_conversion_rate(convert_idr)
+        est_cost = AnyOCREngine.estimate_cost(prompt_tokens, expected_completion_tokens)
+        max_est_cost = AnyOCREngine.estimate_cost(prompt_tokens, max_completion_tokens)
+
+        return {
+            "requests": request_count,
+            "text_tokens": text_tokens,
+            "image_tokens": image_tokens,
+            "images": images,
+            "prompt_tokens": prompt_tokens,
+            "expected_completion_tokens": expected_completion_tokens,
+            "max_completion_tokens": max_completion_tokens,
+            "max_total_tokens": prompt_tokens + max_completion_tokens,
+            "est_cost": est_cost,
+            "max_est_cost": max_est_cost,
+            "usd_to_idr": conversion_rate,
+            "est_cost_idr": est_cost * conversion_rate,
+            "max_est_cost_idr": max_est_cost * conversion_rate,
+        }
+
+    def estimate_stream_usage(messages: list, content: str):
+        """
+        Usage of a streamed response without a usage chunk, counted with the local tokenizer.
+        Tokens added by Azure AI Vision enhancements (OCR/grounding text) are not included.
+        """
+        user_content = messages[-1]["content"]
+        user_message = "\n".join(part["text"] for part in user_content if part["type"] == "text" and part["text"])
+        images = [part["image_url"] for part in user_content if part["type"] == "image_url"]
+
+        estimate = AnyOCREngine.estimate_token_usage(
+            user_message,
+            [image["url"] for image in images],
+            img_detail_level=AnyOCREngineImageDetailLevel(images[0]["detail"]) if images else AnyOCREngineImageDetailLevel.DetailAuto,
+            system_message=messages[0]["content"],
+        )
+        completion_tokens = AnyOCREngine.estimate_text_tokens(content)
+        return SimpleNamespace(
+            prompt_tokens=estimate["prompt_tokens"],
+            completion_tokens=completion_tokens,
+            total_tokens=estimate["prompt_tokens"] + completion_tokens,
+            estimated=True,
+        )
+
+    def estimate_completion_tokens(user_message: str | None) -> int:
+        # Templates carry an example of the expected output; use the largest ```json block as its size
+        example_blocks = re.findall(r"```(?:json)?(.*?)```", user_message or "", re.DOTALL)
+        if not example_blocks:
+            return 512
+        # Leave some headroom for documents with more entries than the example
+        return int(AnyOCREngine.estimate_text_tokens(max(example_blocks, key=len)) * 1.5)
+
+    def choose_pack_size(
+        user_message: str | None,
+        image_count: int,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailLow,
+        max_tokens: int = 4096,
+        max_prompt_tokens: int = 32000,
+    ) -> int:
+        # All packed outputs must fit in max_tokens, and all images plus the template in the prompt budget
+        completion_per_image = max(1, AnyOCREngine.estimate_completion_tokens(user_message))
+        image_tokens = AnyOCREngine.estimate_image_tokens(None, None, img_detail_level)
+        template_tokens = AnyOCREngine.estimate_text_tokens(user_message)
+
+        by_completion = max_tokens // completion_per_image
+        by_prompt = max(0, max_prompt_tokens - template_tokens) // image_tokens
+        return max(1, min(OCR_PACKED_MAX_IMAGES, image_count, by_completion, by_prompt))
+
+    def sum_token_usage(token_infos: list):
+        token_infos = [t for t in token_infos if t is not None]
+        if not token_infos:
+            return None
+
+        return SimpleNamespace(
+            completion_tokens=sum(t.completion_tokens for t in token_infos),
+            prompt_tokens=sum(t.prompt_tokens for t in token_infos),
+            total_tokens=sum(t.total_tokens for t in token_infos),
+        )
+
     def process_token_usage(token_info, convert_idr: bool = False):
         if token_info is None:
             return None
@@ -373,23 +1462,15 @@ class AnyOCREngine:
             "prompt_tokens": token_info.prompt_tokens,
             "total_tokens": token_info.total_tokens,
         }
+        # Usage counted locally (e.g. of a streamed response) is marked as such
+        if getattr(token_info, "estimated", False):
+            out_token_info["estimated"] = True
 
         # Estimate cost based on open ai token usage
-        # https://openai.com/pricing
-        input_cost_per_token = 10.00 / 1000000  # $10.00 / 1M tokens
-        input_token_used = token_info.prompt_tokens
-        output_cost_per_token = 30.00 / 1000000  # $30.00 / 1M tokens
-        output_token_used = token_info.completion_tokens
-        estimated_cost = (input_cost_per_token * input_token_used) + (output_cost_per_token * output_token_used)
+        estimated_cost = AnyOCREngine.estimate_cost(token_info.prompt_tokens, token_info.completion_tokens)
 
         # Convert cost to rupiah
-        conversion_rate = None
-
-        if convert_idr:
-            conversion_rate = AnyOCREngine.get_currency_conversion_rate()
-        # If still None, use default conversion rate
-        if conversion_rate is None:
-            conversion_rate = 16000
+        conversion_rate = AnyOCREngine.get_idr_conversion_rate(convert_idr)
 
         #print("1 USD = Rp", conversion_rate)
         out_token_info["est_cost"] = estimated_cost
@@ -404,6 +1485,20 @@ class AnyOCREngine:
 
         return out_token_info
 
+    def estimate_cost(prompt_tokens: int, completion_tokens: int) -> float:
+        # https://openai.com/pricing
+        return (OCR_INPUT_COST_PER_TOKEN * prompt_tokens) + (OCR_OUTPUT_COST_PER_TOKEN * completion_tokens)
+
+    def get_idr_conversion_rate(convert_idr: bool = False) -> float:
+        conversion_rate = None
+
+        if convert_idr:
+            conversion_rate = AnyOCREngine.get_currency_conversion_rate()
+        # If still None, use default conversion rate
+        if conversion_rate is None:
+            conversion_rate = 16000
+        return conversion_rate
+
     def get_currency_conversion_rate() -> float:
         import requests
         conversion_url = "https://api.exchangerate-api.com/v4/latest/USD"
@@ -415,10 +1510,10 @@ class AnyOCREngine:
                 response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
                 currency_data = response.json()
         except requests.HTTPError as e:
-            print(f"HTTPError occurred: {e}")
+            logging.getLogger("rich").warning(f"Can't get currency conversion rate: {e}")
             return None
         except requests.RequestException as e:
-            print(f"RequestException occurred: {e}")
+            logging.getLogger("rich").warning(f"Can't get currency conversion rate: {e}")
             return None
 
         # Make API call to get USD to IDR conversion rate
@@ -0,0 +1,62 @@
+"""
+AnyOCRImageHash.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Perceptual hashing and small image features, computed locally (no GPT-4V call).
+"""
+
+import io
+
+# dHash of 8x8 bits = 64-bit hash
+IMAGE_HASH_SIZE = 8
+IMAGE_HASH_BITS = IMAGE_HASH_SIZE * IMAGE_HASH_SIZE
+
+
+def load_pil_image(img_src: str):
+    from PIL import Image
+    from AnyOCRDocument import load_document_bytes
+
+    image = Image.open(io.BytesIO(load_document_bytes(img_src)))
+    image.load()
+    return image
+
+
+def dhash(image, hash_size: int = IMAGE_HASH_SIZE) -> int:
+    # Difference hash: compare each pixel to its right neighbour on a tiny grayscale thumbnail
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return (hash_a ^ hash_b).bit_count()
+
+
+def image_features(image) -> dict:
+    """
+    Small feature set of an image: 64-bit dHash, aspect ratio (long side / short side,
+    so rotated photos still match), and mean RGB color.
+    """
+    width, height = image.size
+    mean_color = image.convert("RGB").resize((1, 1)).getpixel((0, 0))
+    return {
+        "dhash": dhash(image),
+        "aspect": max(width, height) / max(1, min(width, height)),
+        "color": list(mean_color),
+    }
+
+
+def features_similarity(features_a: dict, features_b: dict) -> float:
+    # Weighted similarity in [0, 1]: layout (dHash) matters most, shape and color break ties
+    hash_similarity = 1 - hamming_distance(features_a["dhash"], features_b["dhash"]) / IMAGE_HASH_BITS
+    aspect_similarity = min(features_a["aspect"], features_b["aspect"]) / max(features_a["aspect"], features_b["aspect"])
+    color_similarity = 1 - sum(abs(a - b) for a, b in zip(features_a["color"], features_b["color"])) / (3 * 255)
+    return 0.7 * hash_similarity + 0.15 * aspect_similarity + 0.15 * color_similarity
@@ -0,0 +1,271 @@
+"""
+AnyOCRLedger.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Per-tenant token ledger (SQLite): records the usage of every call by tenant, enforces rolling
+per-minute and per-day token quotas with pre-flight estimates, and reports usage and cost.
+
+Usage:
+    python AnyOCRLedger.py report --days 7
+"""
+
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+OCR_LEDGER_MINUTE_SECONDS = 60
+OCR_LEDGER_DAY_SECONDS = 24 * 60 * 60
+OCR_LEDGER_DEFAULT_RETENTION_DAYS = 90
+# Usage older than the retention is deleted on record, at most this often
+OCR_LEDGER_DEFAULT_PURGE_INTERVAL_SECONDS = 60 * 60
+OCR_LEDGER_ANONYMOUS_TENANT = "anonymous"
+
+
+class AnyOCRQuotaExceeded(Exception):
+    def __init__(self, tenant: str, window: str, used: int, limit: int, retry_after: int | None):
+        if retry_after is None:
+            message = f"Request of tenant {tenant} is larger than its {window} quota of {limit} tokens."
+        else:
+            message = f"Tenant {tenant} used {used} of {limit} tokens per {window}, retry after {retry_after} seconds."
+        super().__init__(message)
+        self.tenant = tenant
+        self.window = window
+        self.used = used
+        self.limit = limit
+        # None when the request can never fit in the quota
+        self.retry_after = retry_after
+
+
+def load_tenants(tenants_file: str) -> dict:
+    """
+    Load tenants from a JSON file mapping API key -> {"name", "tokens_per_minute", "tokens_per_day", "priority", "admin"}.
+    Limits left out (or null) use the defaults; priority is the admission lane of the key's calls (API service),
+    and admin keys may read the usage of all tenants.
+    """
+    with open(tenants_file, "r") as f:
+        return json.load(f)
+
+
+class AnyOCRTenantLedger:
+    db_path: str
+    tokens_per_minute: int | None
+    tokens_per_day: int | None
+    # API key -> tenant settings
+    tenants: dict
+
+    def __init__(
+        self,
+        db_path: str,
+        tokens_per_minute: int | None = None,
+        tokens_per_day: int | None = None,
+        tenants: dict | None = None,
+        retention_days: int = OCR_LEDGER_DEFAULT_RETENTION_DAYS,
+        purge_interval_seconds: float = OCR_LEDGER_DEFAULT_PURGE_INTERVAL_SECONDS,
+    ):
+        self.db_path = db_path
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens_per_day = tokens_per_day
+        self.tenants = tenants or {}
+        self.retention_days = retention_days
+        self.purge_interval_seconds = purge_interval_seconds
+        self._last_purge_at = 0.0
+
+        self._lock = threading.Lock()
+        # reservation_id -> (tenant, timestamp, tokens) of calls in flight
+        self._reservations = {}
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " tenant TEXT NOT NULL,"
+            " ts REAL NOT NULL,"
+            " endpoint TEXT,"
+            " prompt_tokens INTEGER NOT NULL,"
+            " completion_tokens INTEGER NOT NULL,"
+            " total_tokens INTEGER NOT NULL,"
+            " est_cost REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS usage_tenant_ts ON usage (tenant, ts)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts)")
+
+    def tenant_for_key(self, api_key: str | None) -> str:
+        # Unknown keys share the anonymous tenant and its quotas: a new key doesn't get a quota of its own
+        if api_key not in self.tenants:
+            return OCR_LEDGER_ANONYMOUS_TENANT
+        return self.owner_for_key(api_key)
+
+    def owner_for_key(self, api_key: str | None) -> str:
+        # Whose stored results a request may reuse: its tenant's, or those of its own unknown key
+        # (by a digest, never in plain text)
+        if not api_key:
+            return OCR_LEDGER_ANONYMOUS_TENANT
+        settings = self.tenants.get(api_key) or {}
+        return settings.get("name") or f"key-{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+
+    def is_admin_key(self, api_key: str | None) -> bool:
+        return bool(api_key) and bool((self.tenants.get(api_key) or {}).get("admin"))
+
+    def limits(self, tenant: str) -> dict:
+        limits = {"minute": self.tokens_per_minute, "day": self.tokens_per_day}
+        for api_key, settings in self.tenants.items():
+            if self.tenant_for_key(api_key) == tenant:
+                # null in the tenants file means the default, like a limit left out
+                if settings.get("tokens_per_minute") is not None:
+                    limits["minute"] = settings["tokens_per_minute"]
+                if settings.get("tokens_per_day") is not None:
+                    limits["day"] = settings["tokens_per_day"]
+                break
+        return limits
+
+    def reserve(self, tenant: str, estimated_tokens: int) -> str:
+        """
+        Check the pre-flight estimate against the tenant's rolling quotas, and hold it until the call is settled.
+        Returns a reservation id, or raises AnyOCRQuotaExceeded.
+        """
+        now = time.time()
+        limits = self.limits(tenant)
+        with self._lock:
+            for window, window_seconds in (("minute", OCR_LEDGER_MINUTE_SECONDS), ("day", OCR_LEDGER_DAY_SECONDS)):
+                limit = limits[window]
+                if not limit:
+                    continue
+
+                entries = self._window_entries(tenant, now - window_seconds)
+                used = sum(tokens for _, tokens in entries)
+                if used + estimated_tokens > limit:
+                    raise AnyOCRQuotaExceeded(tenant, window, used, limit, self._retry_after(entries, used, estimated_tokens, limit, window_seconds, now))
+
+            reservation_id = uuid.uuid4().hex
+            self._reservations[reservation_id] = (tenant, now, estimated_tokens)
+        return reservation_id
+
+    def settle(self, reservation_id: str, usage: dict | None, endpoint: str | None = None):
+        """
+        Replace the reservation with the actual usage (process_token_usage() format).
+        Without usage (e.g. the call failed, or the result was reused) nothing is recorded.
+        """
+        with self._lock:
+            tenant, _, _ = self._reservations.pop(reservation_id)
+        if usage:
+            self.record(tenant, usage, endpoint)
+
+    def record(self, tenant: str, usage: dict, endpoint: str | None = None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO usage (tenant, ts, endpoint, prompt_tokens, completion_tokens, total_tokens, est_cost) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    tenant,
+                    now,
+                    endpoint,
+                    usage.get("prompt_tokens") or 0,
+                    usage.get("completion_tokens") or 0,
+                    usage.get("total_tokens") or 0,
+                    usage.get("est_cost") or 0.0,
+                ),
+            )
+            if now - self._last_purge_at >= self.purge_interval_seconds:
+                self._purge_expired(now)
+
+    def _window_entries(self, tenant: str, since: float) -> list:
+        # [(timestamp, tokens)] of recorded calls and reservations in the window, oldest first
+        entries = self._conn.execute(
+            "SELECT ts, total_tokens FROM usage WHERE tenant = ? AND ts >= ? ORDER BY ts", (tenant, since)
+        ).fetchall()
+        entries += [(ts, tokens) for reserved_tenant, ts, tokens in self._reservations.values() if reserved_tenant == tenant and ts >= since]
+        return sorted(entries)
+
+    def _retry_after(self, entries: list, used: int, estimated_tokens: int, limit: int, window_seconds: int, now: float) -> int | None:
+        # Wait until enough of the oldest usage rolls out of the window
+        if estimated_tokens > limit:
+            return None
+        for ts, tokens in entries:
+            used -= tokens
+            if used + estimated_tokens <= limit:
+                return max(1, int(ts + window_seconds - now) + 1)
+        return window_seconds
+
+    def quota_status(self, tenant: str) -> dict:
+        now = time.time()
+        limits = self.limits(tenant)
+        with self._lock:
+            return {
+                window: {
+                    "used": sum(tokens for _, tokens in self._window_entries(tenant, now - window_seconds)),
+                    "limit": limits[window],
+                }
+                for window, window_seconds in (("minute", OCR_LEDGER_MINUTE_SECONDS), ("day", OCR_LEDGER_DAY_SECONDS))
+            }
+
+    def report(self, since: float | None = None, tenant: str | None = None, daily: bool = False) -> list:
+        """
+        Usage and cost per tenant (and per UTC day with daily=True) since the given timestamp.
+        """
+        group_columns = "tenant, date(ts, 'unixepoch') AS day" if daily else "tenant"
+        query = (
+            f"SELECT {group_columns}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), SUM(est_cost)"
+            " FROM usage WHERE ts >= ?"
+        )
+        params = [since or 0]
+        if tenant is not None:
+            query += " AND tenant = ?"
+            params.append(tenant)
+        query += " GROUP BY tenant, day ORDER BY tenant, day" if daily else " GROUP BY tenant ORDER BY tenant"
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        report = []
+        for row in rows:
+            entry = {"tenant": row[0]}
+            if daily:
+                entry["day"] = row[1]
+                row = row[1:]
+            entry.update({
+                "calls": row[1],
+                "prompt_tokens": row[2],
+                "completion_tokens": row[3],
+                "total_tokens": row[4],
+                "est_cost": row[5],
+            })
+            report.append(entry)
+        return report
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge_expired(time.time())
+
+    def _purge_expired(self, now: float) -> int:
+        self._last_purge_at = now
+        cursor = self._conn.execute("DELETE FROM usage WHERE ts < ?", (now - self.retention_days * OCR_LEDGER_DAY_SECONDS,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __repr__(self):
+        return f"<AnyOCRTenantLedger {self.db_path} reservations={len(self._reservations)}>"
+
+
+if __name__ == "__main__":
+    from _constants import OCR_LEDGER_DB_FILEPATH
+
+    parser = argparse.ArgumentParser(description="AnyOCR Ledger - Token usage and cost per tenant", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="Usage and cost per tenant")
+    report_parser.add_argument('-d', '--days', help='Number of days to report', type=int, default=30)
+    report_parser.add_argument('-t', '--tenant', help='Only report this tenant')
+    report_parser.add_argument('--daily', help='Break down per day', action='store_true')
+    report_parser.add_argument('--db', help='Ledger database', default=OCR_LEDGER_DB_FILEPATH)
+    args = parser.parse_args()
+
+    ledger = AnyOCRTenantLedger(args.db)
+    for entry in ledger.report(time.time() - args.days * OCR_LEDGER_DAY_SECONDS, args.tenant, args.daily):
+        print(json.dumps(entry))
@@ -0,0 +1,86 @@
+"""
+AnyOCRLocalOCR.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Local OCR (Tesseract, via pytesseract) for the hybrid mode of AnyOCREngine: clean printed documents
+such as toll receipts and fuel slips are read locally for free, and GPT-4V only structures the text
+with a low-detail image. Also keeps per-path statistics of the hybrid mode.
+"""
+
+import threading
+
+OCR_LOCAL_OCR_DEFAULT_LANG = "eng"
+OCR_LOCAL_OCR_DEFAULT_MIN_CONFIDENCE = 0.8
+# Fewer words than this is not a document worth trusting local OCR for
+OCR_LOCAL_OCR_DEFAULT_MIN_WORDS = 5
+
+
+def local_ocr_from_data(data: dict) -> dict:
+    """
+    Turn pytesseract.image_to_data() output (dict) into {"text", "confidence", "words"}: the words joined
+    line by line in reading order, and their mean confidence (0..1).
+    """
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        if not word.strip() or confidence < 0:
+            continue
+        line_key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(line_key, []).append(word.strip())
+        confidences.append(confidence)
+
+    return {
+        "text": "\n".join(" ".join(words) for _, words in sorted(lines.items())),
+        "confidence": sum(confidences) / len(confidences) / 100 if confidences else 0.0,
+        "words": len(confidences),
+    }
+
+
+def run_local_ocr(img_src: str, lang: str = OCR_LOCAL_OCR_DEFAULT_LANG) -> dict:
+    # pytesseract (and the tesseract binary) are only needed for the hybrid mode
+    import pytesseract
+    from AnyOCRImageHash import load_pil_image
+
+    image = load_pil_image(img_src).convert("L")
+    return local_ocr_from_data(pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT))
+
+
+class AnyOCRHybridStats:
+    """
+    Calls, tokens, and latency per hybrid path ("hybrid": local OCR text with a low-detail image,
+    "high_detail": the fallback), to see how the mix of paths affects cost and latency.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = {}
+
+    def record(self, path: str, usage: dict | None, latency: float):
+        usage = usage or {}
+        with self._lock:
+            entry = self._paths.setdefault(path, {"calls": 0, "prompt_tokens": 0, "total_tokens": 0, "est_cost": 0.0, "latency": 0.0})
+            entry["calls"] += 1
+            entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            entry["total_tokens"] += usage.get("total_tokens", 0)
+            entry["est_cost"] += usage.get("est_cost", 0.0)
+            entry["latency"] += latency
+
+    def report(self) -> dict:
+        with self._lock:
+            total_calls = sum(entry["calls"] for entry in self._paths.values())
+            return {
+                path: {
+                    "calls": entry["calls"],
+                    "share": entry["calls"] / total_calls,
+                    "avg_prompt_tokens": entry["prompt_tokens"] / entry["calls"],
+                    "avg_total_tokens": entry["total_tokens"] / entry["calls"],
+                    "avg_est_cost": entry["est_cost"] / entry["calls"],
+                    "avg_latency": entry["latency"] / entry["calls"],
+                }
+                for path, entry in self._paths.items()
+            }
+
+    def __repr__(self):
+        return f"<AnyOCRHybridStats {self.report()}>"
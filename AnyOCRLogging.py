@@ -0,0 +1,153 @@
+"""
+AnyOCRLogging.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Logging modes: "rich" for the console, and "json" for production, where records are handed to a
+queue and written as compact JSON lines by a background thread, so the request path never renders
+or writes logs itself. Response payloads are only logged for a sample of the requests.
+"""
+
+import re
+import sys
+import copy
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+
+OCR_LOG_FORMATS = ("rich", "json")
+OCR_LOG_DEFAULT_PAYLOAD_MAX_CHARS = 4096
+
+# rich markup in messages, e.g. [bold green]...[/]
+OCR_LOG_MARKUP_PATTERN = re.compile(r"\[(?!\])/?(?:(?:bold|italic|underline|dim|red|green|yellow|blue|magenta|cyan|white) ?)*\]")
+
+# Attributes every LogRecord has, anything else was passed as extra=
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "markup", "highlighter", "taskName"}
+
+_listener: logging.handlers.QueueListener | None = None
+_queue_handler: logging.handlers.QueueHandler | None = None
+_log_format = None
+_payload_sample_rate = 1.0
+# Renders tracebacks on the logging thread, before records are queued
+_exception_formatter = logging.Formatter()
+
+
+class AnyOCRJSONFormatter(logging.Formatter):
+    """
+    One compact JSON object per line: ts, level, logger, msg (without rich markup), the extra fields,
+    and the payload (truncated to payload_max_chars once serialized).
+    """
+
+    def __init__(self, payload_max_chars: int = OCR_LOG_DEFAULT_PAYLOAD_MAX_CHARS):
+        super().__init__()
+        self.payload_max_chars = payload_max_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": OCR_LOG_MARKUP_PATTERN.sub("", record.getMessage()),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Rendered by AnyOCRQueueHandler before the record was queued
+            entry["exc"] = record.exc_text
+
+        for key, value in record.__dict__.items():
+            if key in _RECORD_ATTRIBUTES or key == "payload":
+                continue
+            entry[key] = value
+
+        if "payload" in record.__dict__:
+            payload = json.dumps(record.payload, ensure_ascii=False, separators=(",", ":"), default=str)
+            if len(payload) > self.payload_max_chars:
+                entry["payload"] = payload[:self.payload_max_chars]
+                entry["payload_truncated"] = True
+            else:
+                entry["payload"] = record.payload
+
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class AnyOCRQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler.prepare() formats the record with a plain formatter, appending the traceback to msg and
+    clearing exc_info, so the JSON formatter would never see it. This one renders the message and keeps
+    the traceback apart in exc_text; extra fields and the payload are queued as they are.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks hold references to frames, they are rendered before they leave this thread
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(log_format: str = "rich", level: int = logging.INFO, payload_sample_rate: float = 1.0, stream=None):
+    """
+    Configure the root logger once. With "json", the root logger only gets a QueueHandler and a
+    QueueListener writes the JSON lines to stream (stderr by default); call stop_logging() to flush it.
+    """
+    global _listener, _queue_handler, _log_format, _payload_sample_rate
+
+    if log_format not in OCR_LOG_FORMATS:
+        raise ValueError(f"Unsupported log format {log_format}, use one of {', '.join(OCR_LOG_FORMATS)}")
+    if _log_format is not None:
+        return
+    _log_format = log_format
+    _payload_sample_rate = payload_sample_rate
+
+    if log_format == "rich":
+        from rich.logging import RichHandler
+        logging.basicConfig(level=level, format="%(message)s", datefmt="[%X]", handlers=[RichHandler()])
+        return
+
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    stream_handler.setFormatter(AnyOCRJSONFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    _queue_handler = AnyOCRQueueHandler(log_queue)
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Writes what's still queued, then stops the background thread
+    global _listener, _queue_handler, _log_format
+    if _listener is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener.stop()
+        _listener = None
+        _queue_handler = None
+    _log_format = None
+
+
+def log_payload(logger: logging.Logger, message: str, payload, level: int = logging.INFO, **fields):
+    """
+    Log a message with a (possibly big) payload, e.g. a full response. The payload is only included for
+    a sample of the calls (payload_sample_rate); in json mode it's serialized later by the background
+    thread, so it isn't copied: the caller must not mutate the payload after logging it.
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    if random.random() >= _payload_sample_rate:
+        logger.log(level, message, extra=fields)
+    elif _log_format == "json":
+        logger.log(level, message, extra={**fields, "payload": payload})
+    else:
+        logger.log(level, f"{message}\n{json.dumps(payload, ensure_ascii=False, indent=2, default=str)}", extra=fields)
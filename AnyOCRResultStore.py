@@ -0,0 +1,123 @@
+"""
+AnyOCRResultStore.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Durable store of responses by idempotency key (SQLite), so a retried request returns the stored
+response, or waits for the call still in progress, instead of triggering a new billable call.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from enum import Enum
+
+OCR_STORE_DEFAULT_RETENTION_SECONDS = 24 * 60 * 60
+# An in-progress entry not updated for this long is considered abandoned (e.g. the worker crashed)
+OCR_STORE_DEFAULT_IN_PROGRESS_TIMEOUT = 10 * 60
+
+
+class AnyOCRIdempotencyState(Enum):
+    New = "new"
+    InProgress = "in_progress"
+    Done = "done"
+    Mismatch = "mismatch"
+
+
+class AnyOCRResultStore:
+    db_path: str
+    retention_seconds: float
+    in_progress_timeout: float
+
+    def __init__(
+        self,
+        db_path: str,
+        retention_seconds: float = OCR_STORE_DEFAULT_RETENTION_SECONDS,
+        in_progress_timeout: float = OCR_STORE_DEFAULT_IN_PROGRESS_TIMEOUT,
+    ):
+        self.db_path = db_path
+        self.retention_seconds = retention_seconds
+        self.in_progress_timeout = in_progress_timeout
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency ("
+            " key TEXT PRIMARY KEY,"
+            " fingerprint TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " response TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idempotency_created_at ON idempotency (created_at)")
+
+    def begin(self, key: str, fingerprint: str) -> tuple:
+        """
+        Claim an idempotency key for a request. Returns (state, stored response):
+        New if the caller should run the request, InProgress if another call with this key is running,
+        Done with the stored response, or Mismatch if the key was used for a different request.
+        """
+        now = time.time()
+        with self._lock:
+            self.purge_expired(now)
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT fingerprint, state, response, updated_at FROM idempotency WHERE key = ?", (key,)
+                ).fetchone()
+
+                if row is None or (row[1] == AnyOCRIdempotencyState.InProgress.value and now - row[3] > self.in_progress_timeout):
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO idempotency (key, fingerprint, state, response, created_at, updated_at) VALUES (?, ?, ?, NULL, ?, ?)",
+                        (key, fingerprint, AnyOCRIdempotencyState.InProgress.value, now, now),
+                    )
+                    result = (AnyOCRIdempotencyState.New, None)
+                elif row[0] != fingerprint:
+                    result = (AnyOCRIdempotencyState.Mismatch, None)
+                elif row[1] == AnyOCRIdempotencyState.Done.value:
+                    result = (AnyOCRIdempotencyState.Done, json.loads(row[2]))
+                else:
+                    result = (AnyOCRIdempotencyState.InProgress, None)
+
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def complete(self, key: str, response):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE idempotency SET state = ?, response = ?, updated_at = ? WHERE key = ?",
+                (AnyOCRIdempotencyState.Done.value, json.dumps(response), time.time(), key),
+            )
+
+    def fail(self, key: str):
+        # Failed calls aren't stored, so a retry runs the request again
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM idempotency WHERE key = ? AND state = ?", (key, AnyOCRIdempotencyState.InProgress.value)
+            )
+
+    def get(self, key: str) -> tuple:
+        with self._lock:
+            row = self._conn.execute("SELECT state, response FROM idempotency WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, None
+        return AnyOCRIdempotencyState(row[0]), json.loads(row[1]) if row[1] is not None else None
+
+    def purge_expired(self, now: float | None = None) -> int:
+        now = now or time.time()
+        cursor = self._conn.execute("DELETE FROM idempotency WHERE created_at < ?", (now - self.retention_seconds,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __repr__(self):
+        return f"<AnyOCRResultStore {self.db_path}>"
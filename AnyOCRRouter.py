@@ -0,0 +1,151 @@
+"""
+AnyOCRRouter.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Route an image to the best matching prompt template before any GPT-4V call, using a local
+index of perceptual hashes and small features of reference images for each template.
+
+Reference images live in one sub-directory per template, named after the prompt file:
+    prompts/references/prompt_json_ktp/*.jpg
+    prompts/references/prompt_json_toll/*.jpg
+
+Usage:
+    python AnyOCRRouter.py build
+    python AnyOCRRouter.py route path/to/image.jpg
+"""
+
+import os
+import json
+import logging
+import argparse
+import mimetypes
+
+from AnyOCRImageHash import load_pil_image, image_features, features_similarity
+
+OCR_ROUTER_DEFAULT_MIN_CONFIDENCE = 0.8
+
+
+class AnyOCRTemplateRouter:
+    # Template name (prompt file) -> list of reference image features
+    index: dict
+    min_confidence: float
+    fallback_prompt_file: str
+
+    def __init__(self, fallback_prompt_file: str, min_confidence: float = OCR_ROUTER_DEFAULT_MIN_CONFIDENCE, index: dict | None = None):
+        self.fallback_prompt_file = fallback_prompt_file
+        self.min_confidence = min_confidence
+        self.index = index or {}
+
+    def add_reference(self, prompt_file: str, img_src: str):
+        with load_pil_image(img_src) as image:
+            self.index.setdefault(prompt_file, []).append(image_features(image))
+
+    def build_index(self, reference_dir: str) -> int:
+        """
+        Index all reference images found in reference_dir/<template name>/.
+        Returns the number of indexed images.
+        """
+        count = 0
+        for template_name in sorted(os.listdir(reference_dir)):
+            template_dir = os.path.join(reference_dir, template_name)
+            if not os.path.isdir(template_dir):
+                continue
+
+            for file_name in sorted(os.listdir(template_dir)):
+                mime_type, _ = mimetypes.guess_type(file_name)
+                if not (mime_type and mime_type.startswith("image/")):
+                    continue
+                self.add_reference(f"{template_name}.md", os.path.join(template_dir, file_name))
+                count += 1
+
+        logging.getLogger("rich").info(f"Indexed [bold green]{count}[/] reference image(s) for {len(self.index)} template(s)", extra={"markup": True})
+        return count
+
+    def scores(self, img_src: str) -> dict:
+        # Best similarity of the image to each template's reference images
+        with load_pil_image(img_src) as image:
+            features = image_features(image)
+
+        return {
+            prompt_file: max(features_similarity(features, ref_features) for ref_features in references)
+            for prompt_file, references in self.index.items() if references
+        }
+
+    def route(self, img_src: str) -> tuple:
+        """
+        Returns (prompt_file, confidence). Falls back to the generic prompt when the best
+        template scores below min_confidence, or the image can't be read.
+        """
+        try:
+            template_scores = self.scores(img_src)
+        except Exception as e:
+            logging.getLogger("rich").warning(f"Can't route image, using fallback prompt: {e}")
+            return self.fallback_prompt_file, 0.0
+
+        if not template_scores:
+            return self.fallback_prompt_file, 0.0
+
+        prompt_file, confidence = max(template_scores.items(), key=lambda item: item[1])
+        logging.getLogger("rich").debug(f"Template scores: {template_scores}")
+        if confidence < self.min_confidence:
+            logging.getLogger("rich").info(f"Best template [bold yellow]{prompt_file}[/] ({confidence:.2f}) is below threshold, using fallback prompt", extra={"markup": True})
+            return self.fallback_prompt_file, confidence
+
+        logging.getLogger("rich").info(f"Routed image to template [bold green]{prompt_file}[/] ({confidence:.2f})", extra={"markup": True})
+        return prompt_file, confidence
+
+    def save(self, index_file: str):
+        # Hashes are saved as hex strings to keep the JSON readable
+        serialized_index = {
+            prompt_file: [{**features, "dhash": f"{features['dhash']:016x}"} for features in references]
+            for prompt_file, references in self.index.items()
+        }
+        with open(index_file, "w") as f:
+            json.dump(serialized_index, f, indent=2)
+
+    def load(self, index_file: str):
+        with open(index_file, "r") as f:
+            serialized_index = json.load(f)
+        self.index = {
+            prompt_file: [{**features, "dhash": int(features["dhash"], 16)} for features in references]
+            for prompt_file, references in serialized_index.items()
+        }
+        return self
+
+    def __repr__(self):
+        return f"<AnyOCRTemplateRouter templates={len(self.index)}>"
+
+
+def create_router(index_file: str, fallback_prompt_file: str, min_confidence: float = OCR_ROUTER_DEFAULT_MIN_CONFIDENCE) -> AnyOCRTemplateRouter:
+    router = AnyOCRTemplateRouter(fallback_prompt_file, min_confidence)
+    if os.path.exists(index_file):
+        router.load(index_file)
+    else:
+        logging.getLogger("rich").warning(f"Router index {index_file} does not exist, every image uses the fallback prompt.")
+    return router
+
+
+if __name__ == "__main__":
+    from rich.logging import RichHandler
+    from _constants import OCR_ROUTER_REFERENCE_DIR, OCR_ROUTER_INDEX_FILEPATH, OCR_ROUTER_MIN_CONFIDENCE, OCR_ROUTER_FALLBACK_PROMPT
+
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s", datefmt="[%X]", handlers=[RichHandler()])
+
+    parser = argparse.ArgumentParser(description="AnyOCR Router - Route images to prompt templates", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Build the index from reference images")
+    build_parser.add_argument('-r', '--references', help='Directory of reference images', default=OCR_ROUTER_REFERENCE_DIR)
+    build_parser.add_argument('-o', '--output', help='Index file', default=OCR_ROUTER_INDEX_FILEPATH)
+    route_parser = subparsers.add_parser("route", help="Route an image to a template")
+    route_parser.add_argument('image', help='URL or file path of the image')
+    route_parser.add_argument('-i', '--index', help='Index file', default=OCR_ROUTER_INDEX_FILEPATH)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        router = AnyOCRTemplateRouter(OCR_ROUTER_FALLBACK_PROMPT, OCR_ROUTER_MIN_CONFIDENCE)
+        router.build_index(args.references)
+        router.save(args.output)
+    else:
+        router = create_router(args.index, OCR_ROUTER_FALLBACK_PROMPT, OCR_ROUTER_MIN_CONFIDENCE)
+        print(router.route(args.image))
@@ -0,0 +1,208 @@
+"""
+AnyOCRSinks.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Columnar result sinks (Parquet, CSV, JSONL) for bulk analytics. Results are flattened to one
+record per scalar field, and tables ({"columns": [...], "rows": [[...]]}) are exploded to one
+record per cell. Records are buffered in record batches of bounded size and written incrementally.
+
+Usage:
+    with create_sink("results.parquet") as sink:
+        sink.write(data, source="pond_report_1.jpg", prompt_file="prompts/prompt_json_pond.md")
+"""
+
+import os
+import csv
+import json
+import threading
+
+from AnyOCRDocument import get_table_keys
+
+OCR_SINK_DEFAULT_BATCH_SIZE = 1024
+
+# Long format: one record per scalar field or table cell
+OCR_SINK_COLUMNS = ("source", "prompt_file", "status", "path", "row", "column", "value")
+
+
+def sink_value(value) -> str | None:
+    # Values are kept as text, so every batch has the same schema whatever the model emitted
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def flatten_data(data, path: str = ""):
+    """
+    Yield (path, row, column, value) for every scalar in the recognized data. Nested fields get dotted
+    paths (e.g. "pond.water.ph"), list items an index (e.g. "samples[2]"), and table cells the table path
+    with their row index and column name.
+    """
+    table_keys = get_table_keys(data)
+    if table_keys is not None:
+        columns_key, rows_key = table_keys
+        columns = [str(column) for column in data[columns_key] or []]
+        for row_index, row in enumerate(data[rows_key] or []):
+            if isinstance(row, dict):
+                cells = [(str(column), value) for column, value in row.items()]
+            else:
+                # Cells past the known columns are still kept, by position
+                cells = [(columns[i] if i < len(columns) else str(i), value) for i, value in enumerate(row)]
+            for column, value in cells:
+                yield path, row_index, column, sink_value(value)
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            yield from flatten_data(value, f"{path}.{key}" if path else str(key))
+    elif isinstance(data, list):
+        for i, value in enumerate(data):
+            yield from flatten_data(value, f"{path}[{i}]")
+    else:
+        yield path, None, None, sink_value(data)
+
+
+class AnyOCRResultSink:
+    """
+    Base sink: buffers flattened records as a columnar batch (column name -> values) and hands
+    full batches to _write_batch(). Safe to share between threads.
+    """
+    file_path: str
+    batch_size: int
+
+    def __init__(self, file_path: str, batch_size: int = OCR_SINK_DEFAULT_BATCH_SIZE):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        self.records_written = 0
+
+        self._lock = threading.Lock()
+        self._batch = self._new_batch()
+        self._closed = False
+
+    @staticmethod
+    def _new_batch() -> dict:
+        return {name: [] for name in OCR_SINK_COLUMNS}
+
+    def write(self, data, source: str | None = None, prompt_file: str | None = None, status: str = "OK"):
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"Sink {self.file_path} is closed.")
+
+            for path, row, column, value in flatten_data(data):
+                for name, item in zip(OCR_SINK_COLUMNS, (source, prompt_file, status, path, row, column, value)):
+                    self._batch[name].append(item)
+                if len(self._batch["path"]) >= self.batch_size:
+                    self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        num_records = len(self._batch["path"])
+        if num_records == 0:
+            return
+        batch, self._batch = self._batch, self._new_batch()
+        self._write_batch(batch)
+        self.records_written += num_records
+
+    def _write_batch(self, batch: dict):
+        raise NotImplementedError
+
+    def _close_file(self):
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._flush()
+            self._close_file()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.file_path} records={self.records_written}>"
+
+
+class AnyOCRJSONLSink(AnyOCRResultSink):
+    # Appends to an existing file
+
+    def __init__(self, file_path: str, batch_size: int = OCR_SINK_DEFAULT_BATCH_SIZE):
+        super().__init__(file_path, batch_size)
+        self._file = open(file_path, "a", encoding="utf-8")
+
+    def _write_batch(self, batch: dict):
+        for values in zip(*batch.values()):
+            self._file.write(json.dumps(dict(zip(batch.keys(), values)), ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def _close_file(self):
+        self._file.close()
+
+
+class AnyOCRCSVSink(AnyOCRResultSink):
+    # Appends to an existing file, the header is only written to a new one
+
+    def __init__(self, file_path: str, batch_size: int = OCR_SINK_DEFAULT_BATCH_SIZE):
+        super().__init__(file_path, batch_size)
+        is_new_file = not os.path.exists(file_path) or os.path.getsize(file_path) == 0
+        self._file = open(file_path, "a", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+        if is_new_file:
+            self._writer.writerow(OCR_SINK_COLUMNS)
+
+    def _write_batch(self, batch: dict):
+        self._writer.writerows(zip(*batch.values()))
+        self._file.flush()
+
+    def _close_file(self):
+        self._file.close()
+
+
+class AnyOCRParquetSink(AnyOCRResultSink):
+    # Each batch becomes a row group. Parquet files can't be appended to, so an existing file is replaced.
+
+    def __init__(self, file_path: str, batch_size: int = OCR_SINK_DEFAULT_BATCH_SIZE):
+        super().__init__(file_path, batch_size)
+        # pyarrow is only needed for Parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ("source", pa.string()),
+            ("prompt_file", pa.string()),
+            ("status", pa.string()),
+            ("path", pa.string()),
+            ("row", pa.int64()),
+            ("column", pa.string()),
+            ("value", pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(file_path, self._schema)
+
+    def _write_batch(self, batch: dict):
+        self._writer.write_batch(self._pa.RecordBatch.from_pydict(batch, schema=self._schema))
+
+    def _close_file(self):
+        self._writer.close()
+
+
+OCR_SINK_TYPES = {
+    ".jsonl": AnyOCRJSONLSink,
+    ".ndjson": AnyOCRJSONLSink,
+    ".csv": AnyOCRCSVSink,
+    ".parquet": AnyOCRParquetSink,
+    ".pq": AnyOCRParquetSink,
+}
+
+
+def create_sink(file_path: str, batch_size: int = OCR_SINK_DEFAULT_BATCH_SIZE) -> AnyOCRResultSink:
+    # The format is picked from the file extension
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in OCR_SINK_TYPES:
+        raise ValueError(f"Unsupported sink {file_path}, use one of {', '.join(OCR_SINK_TYPES)}")
+    return OCR_SINK_TYPES[extension](file_path, batch_size)
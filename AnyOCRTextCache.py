@@ -0,0 +1,115 @@
+"""
+AnyOCRTextCache.py
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Cache (SQLite) of the OCR/grounding output of Azure AI Vision enhancements per image. Once an image
+was recognized with enhancements, prompting it again with another template (or recognizing it after
+creating a template from it) is a text-only pass over the cached OCR text, without the image.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+OCR_TEXT_CACHE_DEFAULT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+# Expired entries are deleted on put, at most this often
+OCR_TEXT_CACHE_DEFAULT_PURGE_INTERVAL_SECONDS = 60 * 60
+
+
+def ocr_text_key(img_src: str, scope: str | None = None) -> str:
+    """
+    By the image bytes, not its URL: the content behind a URL can change. Within a scope (e.g. a tenant),
+    so OCR text is never reused across scopes. Pass remote images as data URLs (see fetch_data_url), so the
+    bytes hashed are the ones sent upstream instead of a second download.
+    """
+    from AnyOCRDocument import load_document_bytes
+
+    digest = hashlib.sha256(f"{scope or ''}\n".encode())
+    digest.update(load_document_bytes(img_src))
+    return digest.hexdigest()
+
+
+def grounding_text(grounding: dict) -> str:
+    # Text of all grounding lines, in reading order
+    return "\n".join(line.get("text", "") for line in grounding.get("lines") or [])
+
+
+class AnyOCRTextCache:
+    db_path: str
+    retention_seconds: float
+    purge_interval_seconds: float
+
+    def __init__(
+        self,
+        db_path: str,
+        retention_seconds: float = OCR_TEXT_CACHE_DEFAULT_RETENTION_SECONDS,
+        purge_interval_seconds: float = OCR_TEXT_CACHE_DEFAULT_PURGE_INTERVAL_SECONDS,
+    ):
+        self.db_path = db_path
+        self.retention_seconds = retention_seconds
+        self.purge_interval_seconds = purge_interval_seconds
+        self.hits = 0
+        self.misses = 0
+        self._last_purge_at = 0.0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # The full grounding output (lines with their spans and polygons) is kept, not only the text
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_text ("
+            " key TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " grounding TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_text_created_at ON ocr_text (created_at)")
+
+    def get(self, key: str) -> dict | None:
+        # Returns {"text", "grounding"}, or None if the image wasn't recognized with enhancements (recently)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, grounding FROM ocr_text WHERE key = ? AND created_at >= ?", (key, time.time() - self.retention_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {"text": row[0], "grounding": json.loads(row[1])}
+
+    def put(self, key: str, grounding: dict):
+        text = grounding_text(grounding)
+        if not text.strip():
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_text (key, text, grounding, created_at) VALUES (?, ?, ?, ?)",
+                (key, text, json.dumps(grounding, ensure_ascii=False), now),
+            )
+            if now - self._last_purge_at >= self.purge_interval_seconds:
+                self._purge_expired(now)
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge_expired(time.time())
+
+    def _purge_expired(self, now: float) -> int:
+        self._last_purge_at = now
+        cursor = self._conn.execute("DELETE FROM ocr_text WHERE created_at < ?", (now - self.retention_seconds,))
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM ocr_text").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __repr__(self):
+        return f"<AnyOCRTextCache {self.db_path}>"
@@ -4,12 +4,91 @@ OCR_OAI_DEFAULT_TEMPERATURE: float = 0.0
 OCR_OAI_DEFAULT_MAX_TOKEN: int = 4096
 
 OCR_USE_AZURE_VISION: bool = True
-OCR_USE_STREAMING_RESPONSE: bool = False
+OCR_USE_STREAMING_RESPONSE: bool = True
+OCR_STREAM_INCLUDE_USAGE: bool = False      # final usage chunk of streamed responses, needs a newer API version than OCR_API_VERSION_DEFAULT (otherwise usage is estimated locally)
+OCR_STREAM_EARLY_STOP: bool = True         # close streamed responses as soon as the JSON answer is complete
 OCR_API_VERSION_DEFAULT: str = "2024-02-15-preview"     # this might change in the future
 OCR_API_VERSION_AI_VISION: str = "2023-12-01-preview"   # this might change in the future
 
 OCR_PROMPT_GENERATOR_FILEPATH = "prompts/prompt_generator.md"
 
+# Template router: pass this as prompt file to pick the template from the image itself
+OCR_ROUTER_AUTO_PROMPT: str = "auto"
+OCR_ROUTER_REFERENCE_DIR = "prompts/references"
+OCR_ROUTER_INDEX_FILEPATH = "prompts/router_index.json"
+OCR_ROUTER_MIN_CONFIDENCE: float = 0.8
+OCR_ROUTER_FALLBACK_PROMPT = "prompts/prompt_sample.md"
+
+# Result reuse in the API service, opt-in per request with "reuse_near_duplicate": images within the Hamming distance
+# (over a 256-bit image hash) are only candidates, a result is reused when the image bytes are the same too, since
+# documents of the same layout with other text are only a bit or two apart
+OCR_DEDUP_ENABLED: bool = True
+OCR_DEDUP_MAX_DISTANCE: int = 10
+OCR_DEDUP_MAX_ENTRIES: int = 10000
+
+# Idempotency-Key support in the API service (SQLite store, path can be overridden by ANYOCR_STORE_PATH)
+OCR_IDEMPOTENCY_DB_FILEPATH = "anyocr_store.db"
+OCR_IDEMPOTENCY_RETENTION_SECONDS: int = 24 * 60 * 60
+OCR_IDEMPOTENCY_POLL_SECONDS: float = 0.25
+
+# Admission control in the API service: upstream calls in flight, and requests waiting for a slot
+OCR_API_MAX_IN_FLIGHT: int = 8
+OCR_API_MAX_QUEUE: int = 32
+# Concurrent upstream calls of one tiled, document, packed or multi-prompt request, each takes an in-flight slot
+OCR_API_FAN_OUT_WORKERS: int = 4
+# Priority lanes of waiting calls, highest first, with their dequeue weights (0: only served when no weighted lane
+# waits). Set per request with the X-Priority header, or per API key with "priority" in the tenants file.
+OCR_API_PRIORITY_LANES: dict = {"interactive": 1, "bulk": 0}
+OCR_API_MAX_STARVATION_SECONDS: float = 30.0    # a waiting call of a lower lane goes first after this long
+
+# Deadline of upstream calls in the API service, can be set per request (up to the max) with the X-Request-Timeout header
+OCR_API_REQUEST_TIMEOUT_SECONDS: float = 120.0
+OCR_API_MAX_REQUEST_TIMEOUT_SECONDS: float = 600.0
+OCR_API_DISCONNECT_POLL_SECONDS: float = 0.5
+
+# Cache of Azure AI Vision OCR/grounding output per image, so prompting an image again is a text-only pass
+# (path can be overridden by ANYOCR_TEXT_CACHE_PATH). Off by default: filling it costs the early stop of streams.
+OCR_TEXT_CACHE_ENABLED: bool = False
+OCR_TEXT_CACHE_DB_FILEPATH = "anyocr_text_cache.db"
+OCR_TEXT_CACHE_RETENTION_SECONDS: int = 7 * 24 * 60 * 60
+# The grounding output comes after the answer: with early stop, the image is only cached if the stream is read
+# to its end anyway, where the rest of the answer is dropped but still billed. Only applies with the cache enabled.
+OCR_TEXT_CACHE_WAIT_FOR_GROUNDING: bool = True
+
+# Circuit breakers around the upstream routes in the API service ("vision": with Azure AI Vision enhancements,
+# "plain": GPT-4V only). While the vision route's circuit is open, requests go to the plain route, with the
+# template variant prompts/<name>.plain.md instead of prompts/<name>.md when there is one.
+OCR_CIRCUIT_BREAKER_ENABLED: bool = True
+OCR_CIRCUIT_MAX_ERROR_RATE: float = 0.5
+OCR_CIRCUIT_MAX_P95_LATENCY_SECONDS: dict = {"vision": 20.0, "plain": 15.0}     # to the first streamed chunk
+OCR_CIRCUIT_OPEN_SECONDS: float = 30.0      # before probing the route again
+OCR_CIRCUIT_FALLBACK_PROMPT_SUFFIX = ".plain"
+
+# Hybrid mode: local OCR (Tesseract) pre-pass, its text is sent with a low-detail image when it's confident enough
+OCR_HYBRID_MIN_CONFIDENCE: float = 0.8     # mean word confidence (0..1), below it the image is recognized in high detail
+OCR_HYBRID_TESSERACT_LANG = "eng"          # e.g. "ind+eng" with the Indonesian traineddata installed
+
+# Logging of the API service: "rich" for the console, or "json" for compact JSON lines written by a background thread
+# (can be overridden by ANYOCR_LOG_FORMAT and ANYOCR_LOG_PAYLOAD_SAMPLE_RATE)
+OCR_LOG_FORMAT = "rich"
+OCR_LOG_PAYLOAD_SAMPLE_RATE: float = 0.01     # share of the requests whose full response is logged
+
+# Per-tenant token ledger in the API service, tenants are identified by X-API-Key (requests without
+# a key, or with a key not in the tenants file, share the "anonymous" tenant and its quotas)
+# (paths can be overridden by ANYOCR_LEDGER_PATH and ANYOCR_TENANTS_PATH)
+OCR_LEDGER_DB_FILEPATH = "anyocr_ledger.db"
+OCR_TENANTS_FILEPATH = "tenants.json"     # API key -> {"name", "tokens_per_minute", "tokens_per_day", "priority", "admin"}
+OCR_TENANT_TOKENS_PER_MINUTE: int | None = 40000    # default rolling quotas, None for no quota
+OCR_TENANT_TOKENS_PER_DAY: int | None = 2000000
+
+# Watch mode (anyocr_watch.py)
+OCR_WATCH_CHECKPOINT_FILEPATH = "anyocr_watch.db"
+OCR_WATCH_WORKERS: int = 4
+OCR_WATCH_QUEUE_SIZE: int = 16
+OCR_WATCH_POLL_SECONDS: float = 5.0
+OCR_WATCH_SETTLE_SECONDS: float = 2.0       # files modified more recently are still being copied
+OCR_WATCH_MAX_ATTEMPTS: int = 3
+
 # OCR_USER_MESSAGE = "Explain the image. Extract all text from this image and turn into table format if possible. If you find person face photo, give me coordinate of bounding box."
 OCR_USER_MESSAGE: str = " \
     Extract title, number, and date from the image. Turn all information into table format, if possible. \
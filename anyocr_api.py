@@ -4,23 +4,123 @@ Copyright (c) 2024 Andri Yadi (an.dri@me.com)
 DycodeX, eFishery
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
-import re
+import copy
+import base64
 import logging
 import json
-from rich.console import Console
-from rich.logging import RichHandler
+import time
+import anyio
+import asyncio
+import hashlib
+import importlib
+import threading
+from contextlib import asynccontextmanager
 from enum import Enum
 
-from AnyOCREngine import AnyOCREngine, AnyOCREngineResponseHandler, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode
+from AnyOCREngine import AnyOCREngine, AnyOCREngineResponseHandler, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode, AnyOCREngineCancelled, AnyOCREngineJSONCompletionDetector
+from AnyOCRDedupIndex import AnyOCRNearDuplicateIndex, compute_image_hash, compute_content_digest
+from AnyOCRResultStore import AnyOCRResultStore, AnyOCRIdempotencyState
+from AnyOCRAdmission import AnyOCRAdmissionController, AnyOCRAdmissionRejected
+from AnyOCRLedger import AnyOCRTenantLedger, AnyOCRQuotaExceeded, OCR_LEDGER_DAY_SECONDS, load_tenants
+from AnyOCRLogging import setup_logging, stop_logging, log_payload
+from AnyOCRTextCache import AnyOCRTextCache
+from AnyOCRLocalOCR import AnyOCRHybridStats
+from AnyOCRCircuitBreaker import AnyOCRCircuitOpen, create_circuit_breakers
+from AnyOCRDocument import DOCUMENT_DOWNLOAD_TIMEOUT, is_remote, fetch_data_url
 from _constants import *
 load_dotenv()
 
-console = Console()
-app = FastAPI()
+# The engine is created in the app lifespan (or on first use), not at import time
+engine: AnyOCREngine | None = None
+
+def get_engine() -> AnyOCREngine:
+    global engine
+    if engine is None:
+        engine = AnyOCREngine(
+            azure_deployment_name=os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            api_version=OCR_API_VERSION_DEFAULT,
+            azure_vision_key=os.environ.get("AZURE_AI_VISION_API_KEY"),
+            azure_vision_api_version=OCR_API_VERSION_AI_VISION,
+            azure_vision_endpoint=os.environ.get("AZURE_AI_VISION_ENDPOINT"),
+            azure_vision_active=True,
+            stream_include_usage=OCR_STREAM_INCLUDE_USAGE,
+            http_client=get_http_client(),
+            text_cache=get_text_cache() if OCR_TEXT_CACHE_ENABLED else None,
+            circuit_breakers=circuit_breakers,
+        )
+    return engine
+
+# Per upstream route, shared by all per-request engine copies
+circuit_breakers = create_circuit_breakers(
+    OCR_CIRCUIT_MAX_P95_LATENCY_SECONDS,
+    max_error_rate=OCR_CIRCUIT_MAX_ERROR_RATE,
+    open_seconds=OCR_CIRCUIT_OPEN_SECONDS,
+) if OCR_CIRCUIT_BREAKER_ENABLED else None
+
+# Template variants for the plain route by prompt file (None if there's none), loaded once
+fallback_prompts = {}
+
+def load_fallback_prompt(prompt_file: str) -> str | None:
+    # prompts/prompt_json_ktp.md -> prompts/prompt_json_ktp.plain.md
+    if prompt_file not in fallback_prompts:
+        root, ext = os.path.splitext(prompt_file)
+        variant_file = f"{root}{OCR_CIRCUIT_FALLBACK_PROMPT_SUFFIX}{ext}"
+        base_dir = os.path.dirname(__file__)
+        if any(os.path.exists(os.path.join(base_dir, prompts_dir, variant_file)) for prompts_dir in ("", "prompts", "prompts_efi")):
+            fallback_prompts[prompt_file] = AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, variant_file, OCR_PROMPT_GENERATOR_FILEPATH)
+        else:
+            fallback_prompts[prompt_file] = None
+    return fallback_prompts[prompt_file]
+
+# OCR/grounding output per image, for text-only passes when an image is prompted again
+text_cache = None
+
+def get_text_cache() -> AnyOCRTextCache:
+    global text_cache
+    if text_cache is None:
+        text_cache = AnyOCRTextCache(
+            os.environ.get("ANYOCR_TEXT_CACHE_PATH", os.path.join(os.path.dirname(__file__), OCR_TEXT_CACHE_DB_FILEPATH)),
+            retention_seconds=OCR_TEXT_CACHE_RETENTION_SECONDS,
+        )
+    return text_cache
+
+def get_http_client():
+    # Record upstream traffic to a cassette, or replay one offline (e.g. for load tests), see AnyOCRCassette
+    if os.environ.get("ANYOCR_REPLAY_CASSETTE"):
+        from AnyOCRCassette import create_replay_client
+        return create_replay_client(os.environ["ANYOCR_REPLAY_CASSETTE"], float(os.environ.get("ANYOCR_REPLAY_SPEED", 1.0)), loop=True)
+    if os.environ.get("ANYOCR_RECORD_CASSETTE"):
+        from AnyOCRCassette import create_recording_client
+        return create_recording_client(os.environ["ANYOCR_RECORD_CASSETTE"])
+    return None
+
+def preload_modules():
+    # Import the heavy upstream client in the background, so the first request doesn't pay for it
+    importlib.import_module("openai")
+
+def configure_logging():
+    # Does nothing if logging is already set up (e.g. in __main__)
+    setup_logging(
+        os.environ.get("ANYOCR_LOG_FORMAT", OCR_LOG_FORMAT),
+        logging.INFO,
+        float(os.environ.get("ANYOCR_LOG_PAYLOAD_SAMPLE_RATE", OCR_LOG_PAYLOAD_SAMPLE_RATE)),
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.environ.get("ANYOCR_LOG_FORMAT", OCR_LOG_FORMAT) == "json":
+        configure_logging()
+    get_engine()
+    threading.Thread(target=preload_modules, name="anyocr-preload", daemon=True).start()
+    yield
+    stop_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 class OCRRequest(BaseModel):
     img_url: str = ""
@@ -29,80 +129,426 @@ class OCRRequest(BaseModel):
     prompt_file: str = ""
     temperature: float = 0.1 #0.2
     use_ai_vision: bool = True
+    tile: bool = False
+    hybrid: bool = False
+    compact: bool = False
+    reuse_near_duplicate: bool = False
+    reuse_ocr_text: bool = True
+    early_stop: bool = OCR_STREAM_EARLY_STOP
+    wait_for_grounding: bool = OCR_TEXT_CACHE_WAIT_FOR_GROUNDING
     img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto
 
-# Create an instance of AnyOCREngine
-engine = AnyOCREngine(
-    azure_deployment_name=os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"),
-    api_version=OCR_API_VERSION_DEFAULT,
-    azure_vision_key=os.environ.get("AZURE_AI_VISION_API_KEY"),
-    azure_vision_api_version=OCR_API_VERSION_AI_VISION,
-    azure_vision_endpoint=os.environ.get("AZURE_AI_VISION_ENDPOINT"),
-    azure_vision_active=True
-)
-
-async def do_recognize(req_mode: AnyOCREngineOpMode, request: OCRRequest):
+class OCRMultiRequest(BaseModel):
+    img_url: str = ""
+    prompts: list[str] = []
+    prompt_files: list[str] = []
+    temperature: float = 0.1
+    img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto
+
+class OCRPackedRequest(BaseModel):
+    img_urls: list[str] = []
+    prompt: str = ""
+    prompt_file: str = ""
+    temperature: float = 0.1
+    pack_size: int | None = None
+    img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailLow
+
+# Bounded in-flight upstream calls and wait queue, with fair share per client
+admission = AnyOCRAdmissionController(OCR_API_MAX_IN_FLIGHT, OCR_API_MAX_QUEUE, OCR_API_PRIORITY_LANES, OCR_API_MAX_STARVATION_SECONDS)
+
+# Durable store of responses by Idempotency-Key, opened on first use
+result_store = None
+
+def get_result_store() -> AnyOCRResultStore:
+    global result_store
+    if result_store is None:
+        result_store = AnyOCRResultStore(
+            os.environ.get("ANYOCR_STORE_PATH", os.path.join(os.path.dirname(__file__), OCR_IDEMPOTENCY_DB_FILEPATH)),
+            retention_seconds=OCR_IDEMPOTENCY_RETENTION_SECONDS,
+        )
+    return result_store
+
+# Token usage per tenant (API key) with rolling quotas, opened on first use
+ledger = None
+
+def get_ledger() -> AnyOCRTenantLedger:
+    global ledger
+    if ledger is None:
+        tenants_file = os.environ.get("ANYOCR_TENANTS_PATH", os.path.join(os.path.dirname(__file__), OCR_TENANTS_FILEPATH))
+        ledger = AnyOCRTenantLedger(
+            os.environ.get("ANYOCR_LEDGER_PATH", os.path.join(os.path.dirname(__file__), OCR_LEDGER_DB_FILEPATH)),
+            tokens_per_minute=OCR_TENANT_TOKENS_PER_MINUTE,
+            tokens_per_day=OCR_TENANT_TOKENS_PER_DAY,
+            tenants=load_tenants(tenants_file) if os.path.exists(tenants_file) else None,
+        )
+    return ledger
+
+def get_tenant(http_request: Request) -> str:
+    return get_ledger().tenant_for_key(http_request.headers.get("X-API-Key"))
+
+def get_owner(http_request: Request) -> str:
+    # Stored results (near-duplicates, idempotent responses, cached OCR text) are never reused across owners
+    return get_ledger().owner_for_key(http_request.headers.get("X-API-Key"))
+
+def estimate_request_tokens(user_message: str, img_srcs: list, img_detail_level: AnyOCREngineImageDetailLevel, separate_requests: bool = False) -> int:
+    # Quotas are checked against the expected usage, not the max_tokens upper bound
+    estimate = AnyOCREngine.estimate_token_usage(
+        user_message,
+        img_srcs,
+        img_detail_level=img_detail_level,
+        system_message=get_engine().system_message,
+        separate_requests=separate_requests,
+    )
+    return estimate["prompt_tokens"] + estimate["expected_completion_tokens"]
+
+async def run_store_call(func, *args):
+    # SQLite calls (ledger, idempotency store) block, so they run in the threadpool. Shielded: bookkeeping
+    # after a call must happen even while the request is being cancelled, e.g. when the client went away.
+    with anyio.CancelScope(shield=True):
+        return await run_in_threadpool(func, *args)
+
+@asynccontextmanager
+async def metered(tenant: str, endpoint: str, estimated_tokens: int):
+    # Reserve the estimate against the tenant's quotas, and record the actual usage set in meter["usage"]
+    try:
+        reservation_id = await run_store_call(get_ledger().reserve, tenant, estimated_tokens)
+    except AnyOCRQuotaExceeded as e:
+        headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else None
+        raise HTTPException(status_code=429, detail=str(e), headers=headers)
+
+    meter = {"usage": None}
+    try:
+        yield meter
+    finally:
+        await run_store_call(get_ledger().settle, reservation_id, meter["usage"], endpoint)
+
+# Near-duplicate index of previous results, to skip re-photographed documents
+dedup_index = AnyOCRNearDuplicateIndex(OCR_DEDUP_MAX_DISTANCE, OCR_DEDUP_MAX_ENTRIES)
+
+def get_dedup_scope(request: OCRRequest, owner: str) -> str:
+    # Results are only reused by the same owner, for the same prompt template
+    return f"{owner}:{request.prompt_file or hashlib.sha1(request.prompt.encode('utf-8')).hexdigest()}"
+
+# Template router, loaded on first use of prompt_file "auto"
+router = None
+
+def route_prompt_file(img_src: str) -> dict:
+    global router
+    if router is None:
+        from AnyOCRRouter import create_router
+        router = create_router(os.path.join(os.path.dirname(__file__), OCR_ROUTER_INDEX_FILEPATH), OCR_ROUTER_FALLBACK_PROMPT, OCR_ROUTER_MIN_CONFIDENCE)
+
+    prompt_file, confidence = router.route(img_src)
+    return {"prompt_file": prompt_file, "confidence": confidence}
+
+def get_client_id(http_request: Request) -> str:
+    # Fair share is per client: explicit client id, API key, or remote address
+    return (
+        http_request.headers.get("X-Client-Id")
+        or http_request.headers.get("X-API-Key")
+        or (http_request.client.host if http_request.client else "unknown")
+    )
+
+def get_priority_lane(http_request: Request) -> str:
+    # The API key's lane (or the highest), which X-Priority can lower but not raise
+    lanes = list(admission.lanes)
+    api_key = http_request.headers.get("X-API-Key")
+    lane = (get_ledger().tenants.get(api_key) or {}).get("priority", lanes[0]) if api_key else lanes[0]
+    if lane not in admission.lanes:
+        logging.getLogger("rich").warning(f"Unknown priority lane {lane} of tenant {get_tenant(http_request)}, using {lanes[-1]}")
+        lane = lanes[-1]
+
+    requested_lane = http_request.headers.get("X-Priority")
+    if requested_lane is not None:
+        if requested_lane not in admission.lanes:
+            raise HTTPException(status_code=400, detail=f"X-Priority must be one of {', '.join(lanes)}.")
+        lane = lanes[max(lanes.index(lane), lanes.index(requested_lane))]
+    return lane
+
+@asynccontextmanager
+async def admitted(http_request: Request, slots: int = 1):
+    # Yields the number of in-flight slots held, the upstream calls the request may run concurrently
+    lane = get_priority_lane(http_request)
+    try:
+        async with admission.admit(get_client_id(http_request), lane, slots) as held_slots:
+            yield held_slots
+    except AnyOCRAdmissionRejected as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def get_deadline(http_request: Request) -> float:
+    # Deadline of the upstream call (time.monotonic()), from X-Request-Timeout in seconds or the default
+    timeout = OCR_API_REQUEST_TIMEOUT_SECONDS
+    if "X-Request-Timeout" in http_request.headers:
+        try:
+            timeout = float(http_request.headers["X-Request-Timeout"])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout must be a number of seconds.")
+        if timeout <= 0:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout must be positive.")
+    return time.monotonic() + min(timeout, OCR_API_MAX_REQUEST_TIMEOUT_SECONDS)
+
+def remaining_seconds(deadline: float) -> float:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise HTTPException(status_code=504, detail="Request deadline exceeded.")
+    return remaining
+
+@asynccontextmanager
+async def cancel_on_disconnect(http_request: Request):
+    # Yields a threading.Event that is set when the client disconnects, to close the upstream stream
+    cancel_event = threading.Event()
+
+    async def watch_disconnect():
+        while not cancel_event.is_set():
+            if await http_request.is_disconnected():
+                logging.getLogger("rich").info("Client disconnected, cancelling upstream call")
+                cancel_event.set()
+                return
+            await asyncio.sleep(OCR_API_DISCONNECT_POLL_SECONDS)
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        yield cancel_event
+    finally:
+        watcher.cancel()
+
+# Upstream calls closed early, and the completion tokens that saved
+cancellation_stats = {"cancelled": 0, "timeout": 0, "saved_completion_tokens": 0, "saved_cost": 0.0}
+
+# Streams closed as soon as the JSON answer was complete
+early_stop_stats = {"streams": 0}
+
+# Calls, tokens, and latency per path of the hybrid mode (local OCR text with a low-detail image, or high detail)
+hybrid_stats = AnyOCRHybridStats()
+
+def record_cancellation(e: AnyOCREngineCancelled):
+    cancellation_stats[e.reason] += 1
+    cancellation_stats["saved_completion_tokens"] += e.saved_completion_tokens
+    cancellation_stats["saved_cost"] += AnyOCREngine.estimate_cost(0, e.saved_completion_tokens)
+
+def upstream_http_exception(e: Exception) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, AnyOCRCircuitOpen):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    logging.getLogger("rich").error(f"Exception: [bold red]{str(e)}[/]", extra={"markup": True})
+    import requests
+    from openai import APITimeoutError
+    if isinstance(e, (APITimeoutError, requests.Timeout)):
+        return HTTPException(status_code=504, detail="Request deadline exceeded.")
+    # The image/document at img_url couldn't be downloaded
+    if isinstance(e, requests.RequestException):
+        return HTTPException(status_code=400, detail=f"Can't download image: {e}")
+    # Upstream rate limiting is back-pressure too, not an internal error
+    if getattr(e, "status_code", None) == 429:
+        retry_after = getattr(getattr(e, "response", None), "headers", {}).get("retry-after", str(admission.retry_after()))
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": retry_after})
+    return HTTPException(status_code=500, detail=str(e))
+
+def get_request_slots(request: OCRRequest) -> int:
+    # Tiles and pages are recognized concurrently. Documents are told by their URL here, before downloading:
+    # one without a known extension gets a single slot, and its pages are recognized one at a time.
+    if request.tile or (request.img_url and AnyOCREngine.is_document(request.img_url)):
+        return OCR_API_FAN_OUT_WORKERS
+    return 1
+
+def load_request_image(img_url: str, timeout: float) -> str:
+    # A remote image/document is downloaded once, within the request deadline, and every later step
+    # (routing, hashing, estimates, rasterizing, the upstream call) uses the same bytes
+    if is_remote(img_url):
+        return fetch_data_url(img_url, timeout)
+    # Local documents are rasterized from their path
+    return img_url if AnyOCREngine.is_document(img_url) else AnyOCREngine.load_image(img_url)
+
+async def do_recognize(req_mode: AnyOCREngineOpMode, request: OCRRequest, http_request: Request, max_workers: int = 1):
     # Check if either img_url or img_file is provided
     if not request.img_url and not request.img_file:
         raise HTTPException(status_code=400, detail="Either img_url or img_file must be provided.")
 
-    if not request.prompt and request.prompt_file:
-        request.prompt = AnyOCREngine.load_prompt_from_file(req_mode, request.prompt_file, OCR_PROMPT_GENERATOR_FILEPATH)
+    deadline = get_deadline(http_request)
+    tenant = get_tenant(http_request)
+    owner = get_owner(http_request)
 
-    # Override the default AnyOCREngine settings
-    engine.azure_vision_active = request.use_ai_vision
-
-    # Send request to the OCR service
     try:
         if request.img_url:
-            img_src = AnyOCREngine.load_image(request.img_url)
+            img_src = await run_in_threadpool(load_request_image, request.img_url, remaining_seconds(deadline))
         else: # Using file upload is not yet working
             img_bytes = await request.img_file.read()
             encoded_image = base64.b64encode(img_bytes).decode("ascii")
             mime_type = "image/jpg"
             img_src = f"data:{mime_type};base64,{encoded_image}"
+    except Exception as e:
+        raise upstream_http_exception(e)
 
-        response = engine.recognize(
-            img_src=img_src,
-            user_message=request.prompt,
-            temperature=request.temperature,
-            streaming_response=False,
-            img_detail_level=request.img_detail_level,
-        )
+    # Pick the template from the image itself
+    routing = None
+    if req_mode == AnyOCREngineOpMode.Recognition and request.prompt_file == OCR_ROUTER_AUTO_PROMPT and request.img_url:
+        routing = await run_in_threadpool(route_prompt_file, img_src)
+        request.prompt_file = routing["prompt_file"]
+
+    if not request.prompt and request.prompt_file:
+        request.prompt = AnyOCREngine.load_prompt_from_file(req_mode, request.prompt_file, OCR_PROMPT_GENERATOR_FILEPATH)
+
+    # Override the default AnyOCREngine settings on a per-request copy, as requests run concurrently
+    engine = copy.copy(get_engine())
+    engine.azure_vision_active = request.use_ai_vision
+    engine.text_cache_scope = owner
+    # Used if the vision route's circuit is open
+    fallback_prompt = None
+    if circuit_breakers is not None and request.use_ai_vision and req_mode == AnyOCREngineOpMode.Recognition and request.prompt_file:
+        fallback_prompt = load_fallback_prompt(request.prompt_file)
+    endpoint = "recognize" if req_mode == AnyOCREngineOpMode.Recognition else "create-template"
+
+    # Multi-page documents (PDF/TIFF) are rasterized and recognized page by page
+    if AnyOCREngine.is_document(img_src):
+        try:
+            # Pages aren't known before rasterizing: reserve one page, the usage of all pages is recorded after
+            estimated_tokens = estimate_request_tokens(request.prompt, [], request.img_detail_level) + AnyOCREngine.estimate_image_tokens(None, None, request.img_detail_level)
+            async with metered(tenant, endpoint, estimated_tokens) as meter:
+                result = await run_in_threadpool(
+                    engine.recognize_document,
+                    doc_src=img_src,
+                    user_message=request.prompt,
+                    temperature=request.temperature,
+                    img_detail_level=request.img_detail_level,
+                    convert_idr=True,
+                    timeout=remaining_seconds(deadline),
+                    max_workers=max_workers,
+                )
+                meter["usage"] = result.get("usage")
+            return result
+        except Exception as e:
+            raise upstream_http_exception(e)
+
+    # Send request to the OCR service
+    try:
+        # Reuse the result of the same image recognized before with the same template (opt-in)
+        image_hash = None
+        content_digest = None
+        if OCR_DEDUP_ENABLED and request.reuse_near_duplicate and req_mode == AnyOCREngineOpMode.Recognition and not request.tile and not request.hybrid:
+            try:
+                image_hash = await run_in_threadpool(compute_image_hash, img_src)
+                content_digest = await run_in_threadpool(compute_content_digest, img_src)
+            except Exception as e:
+                image_hash = None
+                logging.getLogger("rich").warning(f"Can't hash image, near-duplicate lookup skipped: {e}")
+
+            found = dedup_index.lookup(get_dedup_scope(request, owner), image_hash, content_digest) if image_hash is not None else None
+            if found is not None:
+                stored_response, distance = found
+                logging.getLogger("rich").info(f"Reusing result of near-duplicate image (distance {distance})")
+                return {
+                    **stored_response,
+                    "usage": None,
+                    "near_duplicate": {"distance": distance, "saved_usage": stored_response["usage"]},
+                }
+
+        # Oversized/wide table images are split into overlapping tiles and stitched back
+        if request.tile:
+            estimated_tokens = await run_in_threadpool(estimate_request_tokens, request.prompt, [img_src], AnyOCREngineImageDetailLevel.DetailHigh)
+            async with metered(tenant, endpoint, estimated_tokens) as meter:
+                result = await run_in_threadpool(
+                    engine.recognize_tiled,
+                    img_src=img_src,
+                    user_message=request.prompt,
+                    temperature=request.temperature,
+                    convert_idr=True,
+                    timeout=remaining_seconds(deadline),
+                    max_workers=max_workers,
+                )
+                meter["usage"] = result.get("usage")
+            return result
+
+        # Clean printed documents: local OCR first, high detail only when its confidence is low
+        if request.hybrid:
+            estimated_tokens = await run_in_threadpool(estimate_request_tokens, request.prompt, [img_src], AnyOCREngineImageDetailLevel.DetailHigh)
+            async with metered(tenant, endpoint, estimated_tokens) as meter:
+                result = await run_in_threadpool(
+                    engine.recognize_hybrid,
+                    img_src=img_src,
+                    user_message=request.prompt,
+                    min_confidence=OCR_HYBRID_MIN_CONFIDENCE,
+                    lang=OCR_HYBRID_TESSERACT_LANG,
+                    temperature=request.temperature,
+                    convert_idr=True,
+                    timeout=remaining_seconds(deadline),
+                    stats=hybrid_stats,
+                )
+                meter["usage"] = result.get("usage")
+            return result
+
+        estimated_tokens = await run_in_threadpool(estimate_request_tokens, request.prompt, [img_src], request.img_detail_level)
+        # Streamed upstream, so the call is closed as soon as the client disconnects or the deadline passes
+        async with metered(tenant, endpoint, estimated_tokens) as meter, cancel_on_disconnect(http_request) as cancel_event:
+            try:
+                await run_in_threadpool(
+                    engine.recognize,
+                    img_src=img_src,
+                    user_message=request.prompt,
+                    temperature=request.temperature,
+                    streaming_response=True,
+                    img_detail_level=request.img_detail_level,
+                    timeout=remaining_seconds(deadline),
+                    cancel_event=cancel_event,
+                    # Templates answer in JSON, nothing after the value is used
+                    stop_condition=AnyOCREngineJSONCompletionDetector() if request.early_stop and req_mode == AnyOCREngineOpMode.Recognition else None,
+                    reuse_ocr_text=request.reuse_ocr_text,
+                    wait_for_grounding=request.wait_for_grounding,
+                    # Arrays of objects are generated without repeating their keys, and expanded back here
+                    compact_output=request.compact and req_mode == AnyOCREngineOpMode.Recognition,
+                    fallback_user_message=fallback_prompt,
+                )
+            except AnyOCREngineCancelled as e:
+                # Tokens generated before closing are still billed
+                meter["usage"] = AnyOCREngine.process_token_usage(e.usage, True)
+                record_cancellation(e)
+                if e.reason == "timeout":
+                    raise HTTPException(status_code=504, detail="Request deadline exceeded.")
+                raise HTTPException(status_code=499, detail="Client closed request.")
+
+            if engine.last_stopped_early:
+                early_stop_stats["streams"] += 1
+
+            # Process Token Usage and Estimate Cost
+            token_info = AnyOCREngine.process_token_usage(engine.last_usage, True)
+            meter["usage"] = token_info
     except Exception as e:
-        logging.getLogger("rich").error(f"Exception: [bold red]{str(e)}[/]", extra={"markup": True})
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_http_exception(e)
 
     # Handle the response
-    all_content = response.choices[0].message.content
-
-    # Process Token Usage and Estimate Cost, only if not streaming_response
-    if True:
-        token_info = AnyOCREngine.process_token_usage(response.usage, True)
+    all_content = engine.last_all_content
 
     # If req_mode == CreateTemplate, then save the template if the output file is provided
     if req_mode == AnyOCREngineOpMode.CreateTemplate and request.prompt_file:
         #await save_prompt_template(request.prompt_file, all_content)
         AnyOCREngine.save_prompt_template_to_file(request.prompt_file, all_content)
 
-    # Remove "```", "json"
-    cleaned_content = re.sub(r"```|json", "", all_content)
-
     # return response as json or plain-text
     try:
-        parsed_json = json.loads(cleaned_content)
+        parsed_json = AnyOCREngine.parse_json_content(all_content)
 
         response_json = {
             "status": "OK",
             "data": parsed_json,
             "usage": token_info
         }
+        if routing is not None:
+            response_json["routing"] = routing
+        if engine.last_ocr_text_reused:
+            response_json["ocr_text_reused"] = True
+        if engine.last_route_fallback:
+            response_json["route_fallback"] = True
+
+        if image_hash is not None:
+            dedup_index.store(get_dedup_scope(request, owner), image_hash, response_json, content_digest)
 
-        console.print(response_json)
+        # Full responses are only logged for a sample of the requests
+        log_payload(logging.getLogger("rich"), "Recognized", response_json, total_tokens=(token_info or {}).get("total_tokens"))
         return response_json
 
     except json.JSONDecodeError as e:
-        logging.getLogger("rich").warning(f"Not a JSON. Response:\n[bold green]{all_content}[/]", extra={"markup": True})
+        log_payload(logging.getLogger("rich"), "Response is not JSON", all_content, logging.WARNING, content_length=len(all_content))
         return all_content    
 
 """
@@ -116,24 +562,225 @@ Example of request body:
 }
 """
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    return {
+        "near_duplicate": dedup_index.stats(),
+        "admission": admission.stats(),
+        "cancellation": cancellation_stats,
+        "early_stop": early_stop_stats,
+        "hybrid": hybrid_stats.report(),
+        "circuit_breakers": {route: breaker.stats() for route, breaker in circuit_breakers.items()} if circuit_breakers is not None else None,
+        "ocr_text_cache": await run_in_threadpool(get_text_cache().stats) if OCR_TEXT_CACHE_ENABLED else None,
+    }
+
+"""
+Use this endpoint to report token usage and cost per tenant, with an admin API key
+Query parameters: days (default 30), tenant (optional), daily (break down per day)
+"""
+
+@app.get("/usage")
+async def usage_endpoint(http_request: Request, days: int = 30, tenant: str | None = None, daily: bool = False):
+    usage_ledger = get_ledger()
+    if not usage_ledger.is_admin_key(http_request.headers.get("X-API-Key")):
+        raise HTTPException(status_code=403, detail="Usage of all tenants needs an admin API key, see /usage/me.")
+    report = await run_in_threadpool(usage_ledger.report, time.time() - days * OCR_LEDGER_DAY_SECONDS, tenant, daily)
+    return {"days": days, "tenants": report}
+
+@app.get("/usage/me")
+async def usage_me_endpoint(http_request: Request, days: int = 30):
+    # Usage and current quota status of the caller's own API key
+    tenant = get_tenant(http_request)
+    usage_ledger = get_ledger()
+    report = await run_in_threadpool(usage_ledger.report, time.time() - days * OCR_LEDGER_DAY_SECONDS, tenant, True)
+    quota = await run_in_threadpool(usage_ledger.quota_status, tenant)
+    return {"tenant": tenant, "quota": quota, "days": days, "daily": report}
+
 @app.post("/recognize")
-async def recognize_endpoint(request: OCRRequest):
-    return await do_recognize(AnyOCREngineOpMode.Recognition, request)
+async def recognize_endpoint(request: OCRRequest, http_request: Request, response: Response, idempotency_key: str | None = Header(default=None)):
+    if not idempotency_key:
+        async with admitted(http_request, get_request_slots(request)) as slots:
+            return await do_recognize(AnyOCREngineOpMode.Recognition, request, http_request, slots)
+    return await do_idempotent_recognize(idempotency_key, request, http_request, response)
+
+async def do_idempotent_recognize(idempotency_key: str, request: OCRRequest, http_request: Request, response: Response):
+    # A retry with the same Idempotency-Key returns the stored response, or waits for the call in progress
+    store = get_result_store()
+    # Keys are chosen by clients, so two owners using the same key never see each other's responses
+    store_key = f"{get_owner(http_request)}:{idempotency_key}"
+    fingerprint = hashlib.sha256(
+        json.dumps(request.model_dump(mode="json", exclude={"img_file"}), sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    # The call in progress may run up to the longest deadline a request can ask for
+    wait_deadline = time.monotonic() + OCR_API_MAX_REQUEST_TIMEOUT_SECONDS
+    while True:
+        state, stored_response = await run_store_call(store.begin, store_key, fingerprint)
+        if state == AnyOCRIdempotencyState.New:
+            break
+        if state == AnyOCRIdempotencyState.Mismatch:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+        if state == AnyOCRIdempotencyState.Done:
+            response.headers["Idempotent-Replayed"] = "true"
+            return stored_response
+        if time.monotonic() > wait_deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress.", headers={"Retry-After": str(admission.retry_after())})
+        await asyncio.sleep(OCR_IDEMPOTENCY_POLL_SECONDS)
+
+    try:
+        async with admitted(http_request, get_request_slots(request)) as slots:
+            result = await do_recognize(AnyOCREngineOpMode.Recognition, request, http_request, slots)
+    except BaseException:
+        await run_store_call(store.fail, store_key)
+        raise
+
+    await run_store_call(store.complete, store_key, result)
+    return result
 
 @app.post("/create-template")
-async def create_template_endpoint(request: OCRRequest):
-    return await do_recognize(AnyOCREngineOpMode.CreateTemplate, request)
+async def create_template_endpoint(request: OCRRequest, http_request: Request):
+    # A template is created from one whole-image answer, the tile and hybrid paths never save it
+    if request.tile or request.hybrid:
+        raise HTTPException(status_code=400, detail="tile and hybrid can't be used to create a template.")
+    async with admitted(http_request, get_request_slots(request)) as slots:
+        return await do_recognize(AnyOCREngineOpMode.CreateTemplate, request, http_request, slots)
 
-if __name__ == "__main__":
+"""
+Use this endpoint to estimate token usage and cost of a /recognize request, without sending it
+"""
+
+def estimate_request_usage(img_url: str, user_message: str | None, img_detail_level: AnyOCREngineImageDetailLevel) -> dict:
+    img_src = load_request_image(img_url, DOCUMENT_DOWNLOAD_TIMEOUT)
+    is_document = AnyOCREngine.is_document(img_src)
+    if is_document:
+        from AnyOCRDocument import rasterize_document
+        img_srcs = rasterize_document(img_src, img_detail_level.value)
+    else:
+        img_srcs = [img_src]
+
+    return AnyOCREngine.estimate_token_usage(
+        user_message,
+        img_srcs,
+        img_detail_level=img_detail_level,
+        system_message=get_engine().system_message,
+        separate_requests=is_document,
+        convert_idr=True,
+    )
+
+@app.post("/estimate")
+async def estimate_endpoint(request: OCRRequest):
+    if not request.img_url:
+        raise HTTPException(status_code=400, detail="img_url must be provided.")
 
+    if not request.prompt and request.prompt_file:
+        request.prompt = AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, request.prompt_file, OCR_PROMPT_GENERATOR_FILEPATH)
+
+    try:
+        # Downloading, rasterizing and measuring the image all block
+        return await run_in_threadpool(estimate_request_usage, request.img_url, request.prompt, request.img_detail_level)
+    except Exception as e:
+        logging.getLogger("rich").error(f"Exception: [bold red]{str(e)}[/]", extra={"markup": True})
+        raise HTTPException(status_code=500, detail=str(e))
+
+"""
+Use this endpoint to recognize several small images with the same prompt, packed into fewer requests
+Example of request body:
+{
+  "img_urls": ["https://example.com/toll_1.jpg", "https://example.com/toll_2.jpg"],
+  "prompt_file": "prompt_json_toll.md",
+  "img_detail_level": "low"
+}
+"""
+
+@app.post("/recognize-packed")
+async def recognize_packed_endpoint(request: OCRPackedRequest, http_request: Request):
+    if not request.img_urls:
+        raise HTTPException(status_code=400, detail="img_urls must be provided.")
+
+    if not request.prompt and request.prompt_file:
+        request.prompt = AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, request.prompt_file, OCR_PROMPT_GENERATOR_FILEPATH)
+
+    deadline = get_deadline(http_request)
+    try:
+        # Packs are never more than the images
+        async with admitted(http_request, min(OCR_API_FAN_OUT_WORKERS, len(request.img_urls))) as slots:
+            img_srcs = [await run_in_threadpool(load_request_image, img_url, remaining_seconds(deadline)) for img_url in request.img_urls]
+            estimated_tokens = await run_in_threadpool(estimate_request_tokens, request.prompt, img_srcs, request.img_detail_level)
+            async with metered(get_tenant(http_request), "recognize-packed", estimated_tokens) as meter:
+                result = await run_in_threadpool(
+                    get_engine().recognize_packed,
+                    img_srcs=img_srcs,
+                    user_message=request.prompt,
+                    temperature=request.temperature,
+                    pack_size=request.pack_size,
+                    img_detail_level=request.img_detail_level,
+                    convert_idr=True,
+                    timeout=remaining_seconds(deadline),
+                    max_workers=slots,
+                )
+                meter["usage"] = result.get("usage")
+            return result
+    except Exception as e:
+        raise upstream_http_exception(e)
+
+"""
+Use this endpoint to run several prompts against one image, e.g. a document type check and field extraction
+Example of request body:
+{
+  "img_url": "your-image-url",
+  "prompt_files": ["prompts/prompt_json_ktp.md", "prompts/prompt_sample.md"]
+}
+"""
+
+@app.post("/recognize-multi")
+async def recognize_multi_endpoint(request: OCRMultiRequest, http_request: Request):
+    if not request.img_url:
+        raise HTTPException(status_code=400, detail="img_url must be provided.")
+    if not request.prompts and not request.prompt_files:
+        raise HTTPException(status_code=400, detail="prompts or prompt_files must be provided.")
+
+    # Inline prompts first, then the prompt files, in the order given
+    user_messages = list(request.prompts)
+    for prompt_file in request.prompt_files:
+        user_messages.append(AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, prompt_file, OCR_PROMPT_GENERATOR_FILEPATH))
+    prompt_names = [None] * len(request.prompts) + list(request.prompt_files)
+
+    deadline = get_deadline(http_request)
+    try:
+        async with admitted(http_request, min(OCR_API_FAN_OUT_WORKERS, len(user_messages))) as slots:
+            # Loaded and encoded once for all prompts
+            img_src = await run_in_threadpool(load_request_image, request.img_url, remaining_seconds(deadline))
+            estimated_tokens = sum([
+                await run_in_threadpool(estimate_request_tokens, user_message, [img_src], request.img_detail_level)
+                for user_message in user_messages
+            ])
+            async with metered(get_tenant(http_request), "recognize-multi", estimated_tokens) as meter:
+                result = await run_in_threadpool(
+                    get_engine().recognize_multi,
+                    img_src=img_src,
+                    user_messages=user_messages,
+                    temperature=request.temperature,
+                    img_detail_level=request.img_detail_level,
+                    convert_idr=True,
+                    timeout=remaining_seconds(deadline),
+                    max_workers=slots,
+                )
+                meter["usage"] = result.get("usage")
+    except Exception as e:
+        raise upstream_http_exception(e)
+
+    for prompt_result in result["results"]:
+        prompt_result["prompt_file"] = prompt_names[prompt_result["index"]]
+    return result
+
+if __name__ == "__main__":
     # Configure logging
-    log_level = logging.INFO
-    FORMAT = "%(message)s"
-    # FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
-    logging.basicConfig(level=log_level, format=FORMAT, datefmt="[%X]", handlers=[RichHandler()])
+    configure_logging()
     logging.getLogger("rich").info("[bold green]AnyOCR API Service[/] is starting...", extra={"markup": True})
 
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # In json mode uvicorn's own loggers go through the same queue
+    uvicorn_options = {"log_config": None} if os.environ.get("ANYOCR_LOG_FORMAT", OCR_LOG_FORMAT) == "json" else {}
+    uvicorn.run(app, host="0.0.0.0", port=8000, **uvicorn_options)
 
     logging.getLogger("rich").info("[bold green]AnyOCR API Service[/] is STOPPED", extra={"markup": True})
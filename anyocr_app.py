@@ -5,6 +5,7 @@ DycodeX, eFishery
 """
 
 import os
+import json
 import argparse
 import time
 import base64
@@ -12,27 +13,15 @@ import urllib.parse
 import mimetypes
 import logging
 
-from rich.console import Console
-from rich.markdown import Markdown
-from rich.progress import (
-    BarColumn,
-    SpinnerColumn,
-    Progress,
-    TaskID,
-    TextColumn,
-    TimeRemainingColumn,
-    TimeElapsedColumn
-)
-from rich.logging import RichHandler
+# rich (console, markdown, progress, logging) is imported where it's used, to keep startup fast
 from dotenv import load_dotenv
 from enum import Enum
 
 from _constants import *
-from AnyOCREngine import AnyOCREngine, AnyOCREngineResponseHandler, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode
+from AnyOCREngine import AnyOCREngine, AnyOCREngineResponseHandler, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode, AnyOCREngineJSONCompletionDetector
 
 class AnyOCRConsoleApp:
     def __init__(self, args):
-        self.console = Console()
         self.args = args
 
         # self.api_key = os.environ.get("OPENAI_API_KEY")
@@ -42,17 +31,37 @@ class AnyOCRConsoleApp:
         self.azure_vision_key = os.environ.get("AZURE_AI_VISION_API_KEY")
 
         self.img_src = args.url if args.url else OCR_DEFAULT_IMG_SRC
-        self.use_azure_vision = args.vision if args.vision else OCR_USE_AZURE_VISION
-        self.streaming_response = args.stream if args.stream else OCR_USE_STREAMING_RESPONSE
+        # The argparse defaults are OCR_USE_AZURE_VISION and OCR_USE_STREAMING_RESPONSE already; falling back to
+        # them when the flag is falsy would turn an explicit "-s False" or "-v False" back into the default
+        self.use_azure_vision = args.vision
+        self.streaming_response = args.stream
         self.user_message = OCR_USER_MESSAGE
 
         self.last_response_content: str = ""
+        self._console = None
 
         self.resp_handler = AnyOCREngineResponseHandler(name="Default Handler")
 
         self.app_mode: AnyOCREngineOpMode = AnyOCREngineOpMode.CreateTemplate if args.create else AnyOCREngineOpMode.Recognition
 
+    @property
+    def console(self):
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console()
+        return self._console
+
+    def print_markdown(self, markdown_text: str):
+        from rich.markdown import Markdown
+        self.console.print(Markdown(markdown_text))
+
     def run(self):
+        # Pick the template from the image itself
+        if self.app_mode == AnyOCREngineOpMode.Recognition and self.args.prompt == OCR_ROUTER_AUTO_PROMPT:
+            from AnyOCRRouter import create_router
+            router = create_router(os.path.join(os.path.dirname(__file__), OCR_ROUTER_INDEX_FILEPATH), OCR_ROUTER_FALLBACK_PROMPT, OCR_ROUTER_MIN_CONFIDENCE)
+            self.args.prompt, _ = router.route(self.img_src)
+
         # Load user_message from file if provided in prompt argument
         # self.load_prompt()
         self.user_message = AnyOCREngine.load_prompt_from_file(self.app_mode, self.args.prompt, OCR_PROMPT_GENERATOR_FILEPATH)
@@ -62,13 +71,21 @@ class AnyOCRConsoleApp:
         logging.getLogger("rich").debug(f"Prompt: \n{self.user_message}", extra={"markup": True})
         # print()
 
+        self.is_document = AnyOCREngine.is_document(self.img_src)
+
         try:
             # self.load_image()
-            self.img_src = AnyOCREngine.load_image(self.img_src)
+            if not self.is_document:
+                self.img_src = AnyOCREngine.load_image(self.img_src)
         except Exception as e:
             logging.getLogger("rich").error(f"[bold red]Image URL Error:[/] {e}", extra={"markup": True})
             return
 
+        # Only estimate tokens and cost, nothing is sent
+        if self.args.dry_run:
+            self.do_dry_run()
+            return
+
         # Check if the instance is created successfully
         assert isinstance(self.resp_handler, AnyOCREngineResponseHandler)
 
@@ -79,6 +96,9 @@ class AnyOCRConsoleApp:
         self.resp_handler.on_all_content_available.connect(
             self.on_ocrengine_all_content_available, self.resp_handler
         )
+        self.resp_handler.on_usage_available.connect(
+            self.on_ocrengine_usage_available, self.resp_handler
+        )
 
         # Create an instance of AnyOCREngine
         try:
@@ -92,6 +112,9 @@ class AnyOCRConsoleApp:
                 azure_vision_endpoint=self.azure_vision_endpoint,
                 azure_vision_active=self.use_azure_vision,
                 response_handler=self.resp_handler,
+                stream_include_usage=OCR_STREAM_INCLUDE_USAGE,
+                http_client=self.create_http_client(),
+                text_cache=self.create_text_cache(),
             )
         except Exception as e:
             logging.getLogger("rich").error(f"[bold red]OCR Client Error:[/] {e}", extra={"markup": True})
@@ -101,11 +124,12 @@ class AnyOCRConsoleApp:
         start_time = time.time()
 
         # Perform OCR recognition
-        # self.console.print(Markdown(f"**Recognizing...**"))
+        # self.print_markdown(f"**Recognizing...**")
         # with self.console.status("Recognizing...", spinner='bouncingBall'):
         #     self.do_recognition(client)
         # print("\n")
 
+        from rich.progress import Progress, SpinnerColumn, TimeElapsedColumn
         with Progress(
             SpinnerColumn('bouncingBall'),
             *Progress.get_default_columns(),
@@ -118,16 +142,33 @@ class AnyOCRConsoleApp:
 
         end_time = time.time()
         elapsed_time = end_time - start_time
-        self.console.print(Markdown(f"Elapsed time: **{elapsed_time:.2f} seconds**"))
+        self.print_markdown(f"Elapsed time: **{elapsed_time:.2f} seconds**")
         print("\n")
 
+    def create_http_client(self):
+        # Record the upstream traffic to a cassette, or replay one offline
+        if self.args.replay:
+            from AnyOCRCassette import create_replay_client
+            return create_replay_client(self.args.replay, self.args.replay_speed)
+        if self.args.record:
+            from AnyOCRCassette import create_recording_client
+            return create_recording_client(self.args.record)
+        return None
+
+    def create_text_cache(self):
+        # OCR text of images recognized with Azure AI Vision, so prompting them again is a text-only pass
+        if not OCR_TEXT_CACHE_ENABLED or not self.args.reuse_ocr_text:
+            return None
+        from AnyOCRTextCache import AnyOCRTextCache
+        return AnyOCRTextCache(os.path.join(os.path.dirname(__file__), OCR_TEXT_CACHE_DB_FILEPATH), OCR_TEXT_CACHE_RETENTION_SECONDS)
+
     def on_ocrengine_all_content_available(self, sender, **kwargs):
         self.last_response_content = kwargs.get("content", "")
         if self.last_response_content != "":
             print("\n\n")
-            self.console.print(Markdown("**All Content:** "))
+            self.print_markdown("**All Content:** ")
             # render self.last_response_content as markdown on terminal
-            self.console.print(Markdown(self.last_response_content))
+            self.print_markdown(self.last_response_content)
 
         print("\n")
 
@@ -136,35 +177,166 @@ class AnyOCRConsoleApp:
         chunked_content = kwargs.get("content", "")
         print(chunked_content, end="")
 
+    def on_ocrengine_usage_available(self, sender, **kwargs):
+        # Token usage arrives after the content, in both streaming and non-streaming mode
+        self.display_token_usage(kwargs.get("usage"))
+
     def do_recognition(self, client: AnyOCREngine):
-        # Send request to the OCR service
+        if self.is_document or self.args.tile:
+            self.do_document_recognition(client)
+            return
+        if self.args.hybrid and self.app_mode == AnyOCREngineOpMode.Recognition:
+            self.do_hybrid_recognition(client)
+            return
+
+        # Send request to the OCR service, token usage is displayed by on_ocrengine_usage_available
         try:
-            response = client.recognize(
+            client.recognize(
                 img_src=self.img_src,
                 user_message=self.user_message,
                 temperature=0.2,
                 streaming_response=self.streaming_response,
                 img_detail_level=AnyOCREngineImageDetailLevel.DetailLow,
+                stop_condition=AnyOCREngineJSONCompletionDetector() if self.args.early_stop and self.app_mode == AnyOCREngineOpMode.Recognition else None,
+                compact_output=self.args.compact and self.app_mode == AnyOCREngineOpMode.Recognition,
+                wait_for_grounding=self.args.wait_for_grounding,
             )
         except Exception as e:
             logging.getLogger("rich").error(f"[bold red]OCR Client Error:[/] {e}", extra={"markup": True})
             return
 
-        # Display Token Usage and Cost, only if not streaming_response
-        if not self.streaming_response:
-            token_info = response.usage
-            self.display_token_usage(token_info)
+        if client.last_ocr_text_reused:
+            logging.getLogger("rich").info("Reused the OCR text of this image, [bold green]without sending the image[/]", extra={"markup": True})
+        elif client.last_stopped_early and client.azure_vision_active and not client.last_route_fallback:
+            # The OCR text of Azure AI Vision (All Content) comes after the answer
+            logging.getLogger("rich").info("Stream closed once the JSON answer was complete, the OCR text after it was skipped (use [bold]--early-stop false[/] to see it)", extra={"markup": True})
 
         # If app_mode == CreateTemplate, then save the template if the output file is provided
         if self.app_mode == AnyOCREngineOpMode.CreateTemplate:
             #self.save_prompt_template()
             AnyOCREngine.save_prompt_template_to_file(self.args.output, self.last_response_content)
+        elif self.args.sink:
+            try:
+                self.write_to_sink(AnyOCREngine.parse_json_content(client.last_all_content))
+            except json.JSONDecodeError:
+                logging.getLogger("rich").warning(f"Response is not JSON, nothing is written to [bold]{self.args.sink}[/]", extra={"markup": True})
+
+    def do_document_recognition(self, client: AnyOCREngine):
+        # Pages/tiles are recognized concurrently, so there is no streaming for them
+        try:
+            if self.is_document:
+                result = client.recognize_document(
+                    doc_src=self.img_src,
+                    user_message=self.user_message,
+                    temperature=0.2,
+                    img_detail_level=AnyOCREngineImageDetailLevel.DetailLow,
+                    convert_idr=True,
+                )
+            else:
+                result = client.recognize_tiled(
+                    img_src=self.img_src,
+                    user_message=self.user_message,
+                    temperature=0.2,
+                    convert_idr=True,
+                )
+        except Exception as e:
+            logging.getLogger("rich").error(f"[bold red]OCR Client Error:[/] {e}", extra={"markup": True})
+            return
+
+        self.print_markdown("**All Content:** ")
+        self.console.print_json(data=result["data"])
+        print("\n")
+
+        if self.args.sink:
+            self.write_to_sink(result["data"])
+
+        part_name = "page" if self.is_document else "tile"
+        md_pages_info = f"**{part_name.capitalize()}s:**\n\n"
+        for part in result[f"{part_name}s"]:
+            part_usage = part["usage"] or {}
+            md_pages_info += f"* {part_name.capitalize()} {part[part_name]}: {part['status']}, **{part_usage.get('total_tokens', 0)}** tokens, **{part['latency']:.2f}** seconds\n"
+        self.print_markdown(md_pages_info)
+        print("\n")
+
+        if result["usage"] is not None:
+            self.display_token_usage(result["usage"])
+
+    def do_hybrid_recognition(self, client: AnyOCREngine):
+        # Local OCR pre-pass, then one non-streamed call (low detail with the local text, or high detail)
+        try:
+            result = client.recognize_hybrid(
+                img_src=self.img_src,
+                user_message=self.user_message,
+                min_confidence=OCR_HYBRID_MIN_CONFIDENCE,
+                lang=OCR_HYBRID_TESSERACT_LANG,
+                temperature=0.2,
+                convert_idr=True,
+            )
+        except Exception as e:
+            logging.getLogger("rich").error(f"[bold red]OCR Client Error:[/] {e}", extra={"markup": True})
+            return
+
+        self.print_markdown("**All Content:** ")
+        if result["status"] == "OK":
+            self.console.print_json(data=result["data"])
+            if self.args.sink:
+                self.write_to_sink(result["data"])
+        else:
+            self.print_markdown(result["content"])
+        print("\n")
+
+        local_ocr = result["local_ocr"]
+        md_hybrid_info = f"**Hybrid:**\n\n* Path: **{result['path']}**\n"
+        if local_ocr is not None:
+            md_hybrid_info += f"* Local OCR: **{local_ocr['confidence']:.2f}** confidence, {local_ocr['words']} words, **{local_ocr['latency']:.2f}** seconds\n"
+        md_hybrid_info += f"* Latency: **{result['latency']:.2f}** seconds\n"
+        self.print_markdown(md_hybrid_info)
+        print("\n")
+
+        if result["usage"] is not None:
+            self.display_token_usage(result["usage"])
+
+    def write_to_sink(self, data):
+        # Flattened fields and table cells are appended to the .parquet, .csv or .jsonl sink
+        from AnyOCRSinks import create_sink
+        with create_sink(self.args.sink) as sink:
+            sink.write(data, source=self.args.url, prompt_file=self.args.prompt)
+        logging.getLogger("rich").info(f"Wrote [bold green]{sink.records_written}[/] records to {self.args.sink}", extra={"markup": True})
+
+    def do_dry_run(self):
+        img_srcs = [self.img_src]
+        if self.is_document:
+            from AnyOCRDocument import rasterize_document
+            img_srcs = rasterize_document(self.img_src, AnyOCREngineImageDetailLevel.DetailLow.value)
+
+        est_info = AnyOCREngine.estimate_token_usage(
+            self.user_message,
+            img_srcs,
+            img_detail_level=AnyOCREngineImageDetailLevel.DetailLow,
+            separate_requests=self.is_document,
+            convert_idr=True,
+        )
+
+        md_est_info = f"**Estimated Token Usage & Cost (dry run):**\n\n\
+* Requests: **{est_info['requests']}**\n\
+* Prompt tokens: **{est_info['prompt_tokens']}** (text: {est_info['text_tokens']}, images: {est_info['image_tokens']})\n\
+* Expected completion tokens: **{est_info['expected_completion_tokens']}**\n\
+* Reserved completion tokens (max_tokens): **{est_info['max_completion_tokens']}**\n\
+* 1 USD = **Rp {est_info['usd_to_idr']:.2f}**\n\
+* Estimated cost: **$ {est_info['est_cost']:.4f}** = **Rp {est_info['est_cost_idr']:.2f}**\n\
+* Maximum cost: **$ {est_info['max_est_cost']:.4f}** = **Rp {est_info['max_est_cost_idr']:.2f}**\n\
+"
+        self.print_markdown(md_est_info)
+        print("\n")
 
     def display_token_usage(self, token_info):
 
-        ret_tok_info = AnyOCREngine.process_token_usage(token_info, True)
+        # Already processed token usage (e.g. from recognize_document) is displayed as is
+        ret_tok_info = token_info if isinstance(token_info, dict) else AnyOCREngine.process_token_usage(token_info, True)
 
-        md_token_info = f"**Token Usage & Cost:**\n\n\
+        # Streamed responses without a usage chunk are counted locally
+        md_title = "Token Usage & Cost (estimated)" if ret_tok_info.get("estimated") else "Token Usage & Cost"
+        md_token_info = f"**{md_title}:**\n\n\
 * Prompt tokens: **{ret_tok_info['prompt_tokens']}**\n\
 * Completion tokens: **{ret_tok_info['completion_tokens']}**\n\
 * Total tokens: **{ret_tok_info['total_tokens']}**\n\
@@ -176,7 +348,7 @@ class AnyOCRConsoleApp:
         #print(f"Estimated cost: $ {ret_tok_info['est_cost']} = Rp {ret_tok_info['est_cost_idr']}")
         md_token_info += f"* Estimated cost: **$ {ret_tok_info['est_cost']:.4f}** = **Rp {ret_tok_info['est_cost_idr']:.2f}**\n"
 
-        self.console.print(Markdown(md_token_info))
+        self.print_markdown(md_token_info)
         print("\n")
 
 
@@ -192,13 +364,27 @@ def str_to_bool(value):
 def parse_arguments():
     parser = argparse.ArgumentParser(description="AnyOCR Console App - Recognize text from any images", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-u', '--url', help='URL or file path of the image', default=OCR_DEFAULT_IMG_SRC)
-    parser.add_argument('-p', '--prompt', help='Path to the prompt file to read')
+    parser.add_argument('-p', '--prompt', help='Path to the prompt file to read, or "auto" to pick the template from the image')
     parser.add_argument('-n', '--create', help='Create a new prompt template', type=str_to_bool, nargs='?', const=True, default=False)
     parser.add_argument('-o', '--output', help='Output file path of created prompt template')
     parser.add_argument('-s', '--stream', help='Streaming the response or not', type=str_to_bool, nargs='?', const=True, default=OCR_USE_STREAMING_RESPONSE)
     parser.add_argument('-v', '--vision', help='Use Azure AI vision or not', type=str_to_bool, nargs='?', const=True, default=OCR_USE_AZURE_VISION)
+    parser.add_argument('-t', '--tile', help='Split oversized/wide table image into overlapping tiles', type=str_to_bool, nargs='?', const=True, default=False)
+    parser.add_argument('--hybrid', help='Run local OCR (Tesseract) first, and send its text with a low-detail image when confident', type=str_to_bool, nargs='?', const=True, default=False)
+    parser.add_argument('--compact', help='Ask for arrays of objects without repeated keys to save completion tokens, expanded back afterwards', type=str_to_bool, nargs='?', const=True, default=False)
+    parser.add_argument('--early-stop', help='Close the streamed response as soon as the JSON answer is complete', type=str_to_bool, nargs='?', const=True, default=OCR_STREAM_EARLY_STOP)
+    parser.add_argument('--wait-for-grounding', help='With --early-stop on Azure AI Vision, still read the stream to its end to cache the OCR text', type=str_to_bool, nargs='?', const=True, default=OCR_TEXT_CACHE_WAIT_FOR_GROUNDING)
+    parser.add_argument('--reuse-ocr-text', help='Prompt an image recognized with Azure AI Vision before with its cached OCR text only', type=str_to_bool, nargs='?', const=True, default=True)
+    parser.add_argument('--sink', help='Write flattened results to this .parquet, .csv or .jsonl file (CSV and JSONL are appended to)')
+    parser.add_argument('--record', help='Record the upstream requests and responses to this cassette file')
+    parser.add_argument('--replay', help='Replay the responses recorded in this cassette file, without calling upstream')
+    parser.add_argument('--replay-speed', help='Replay speed relative to the recorded timing, 0 for no delays', type=float, default=1.0)
+    parser.add_argument('--dry-run', help='Only estimate token usage and cost, without sending the request', type=str_to_bool, nargs='?', const=True, default=False)
     parser.add_argument('-d', '--debug', help='Show debugging messages', type=str_to_bool, nargs='?', const=True, default=False)
     _args = parser.parse_args()
+    # A template is created from one whole-image answer, the tile and hybrid paths never save it
+    if _args.create and (_args.tile or _args.hybrid):
+        parser.error("--tile and --hybrid can't be used with --create")
     # print(vars(_args))
     return _args
 
@@ -213,6 +399,7 @@ if __name__ == "__main__":
     log_level = logging.DEBUG if args.debug else logging.INFO
     FORMAT = "%(message)s"
     # FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+    from rich.logging import RichHandler
     logging.basicConfig(level=log_level, format=FORMAT, datefmt="[%X]", handlers=[RichHandler()])
 
     logging.getLogger("rich").info("[bold green]AnyOCR Console App[/] is starting...", extra={"markup": True})
@@ -0,0 +1,382 @@
+"""
+AnyOCR Watch
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Long-running watch mode: polls folders where scanning stations drop images and documents,
+recognizes new files with a bounded worker pool sharing one engine, and writes the results
+next to the files (or to an output directory). Processed files are recorded in a checkpoint
+database, so a restart never sends a file to GPT-4V again once its result is written.
+
+Usage:
+    python anyocr_watch.py -w /mnt/scans/ktp -p prompts/prompt_json_ktp.md
+    python anyocr_watch.py -w /mnt/scans -p auto --recursive --once
+"""
+
+from dotenv import load_dotenv
+import os
+import copy
+import json
+import time
+import queue
+import signal
+import logging
+import argparse
+import mimetypes
+import threading
+
+from _constants import *
+from AnyOCREngine import AnyOCREngine, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode, AnyOCREngineJSONCompletionDetector
+from AnyOCRCheckpoint import AnyOCRCheckpoint, AnyOCRCheckpointState
+from AnyOCRSinks import AnyOCRResultSink, create_sink
+
+
+class AnyOCRWatcher:
+    def __init__(
+        self,
+        engine: AnyOCREngine,
+        watch_dirs: list,
+        prompt_file: str,
+        checkpoint: AnyOCRCheckpoint,
+        *,
+        output_dir: str | None = None,
+        recursive: bool = False,
+        workers: int = OCR_WATCH_WORKERS,
+        queue_size: int = OCR_WATCH_QUEUE_SIZE,
+        poll_interval: float = OCR_WATCH_POLL_SECONDS,
+        settle_seconds: float = OCR_WATCH_SETTLE_SECONDS,
+        max_attempts: int = OCR_WATCH_MAX_ATTEMPTS,
+        img_detail_level: AnyOCREngineImageDetailLevel = AnyOCREngineImageDetailLevel.DetailAuto,
+        sink: AnyOCRResultSink | None = None,
+    ):
+        self.engine = engine
+        self.watch_dirs = watch_dirs
+        self.prompt_file = prompt_file
+        self.checkpoint = checkpoint
+        self.output_dir = output_dir
+        self.recursive = recursive
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.settle_seconds = settle_seconds
+        self.max_attempts = max_attempts
+        self.img_detail_level = img_detail_level
+        # Flattened results are also appended to the sink (Parquet/CSV/JSONL)
+        self.sink = sink
+
+        self.stop_event = threading.Event()
+        # Bounded, so polling waits for the workers instead of queueing a whole backlog in memory
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Files queued or being processed, by content hash
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+        self._router = None
+        self._prompts = {}
+        self._prompts_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.sink_failed = 0
+        self.total_tokens = 0
+        self.total_cost = 0.0
+
+    def list_files(self) -> list:
+        file_paths = []
+        for watch_dir in self.watch_dirs:
+            for dir_path, dir_names, file_names in os.walk(watch_dir):
+                dir_names[:] = sorted(dir_name for dir_name in dir_names if not dir_name.startswith(".")) if self.recursive else []
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(dir_path, file_name)
+                    if not file_name.startswith(".") and self.is_supported(file_path):
+                        file_paths.append(file_path)
+        return file_paths
+
+    def is_supported(self, file_path: str) -> bool:
+        mime_type, _ = mimetypes.guess_type(file_path)
+        return bool(mime_type and mime_type.startswith("image/")) or AnyOCREngine.is_document(file_path)
+
+    def scan(self) -> int:
+        """
+        Queue new files that stopped changing. Returns the number of queued files.
+        """
+        queued = 0
+        for file_path in self.list_files():
+            if self.stop_event.is_set():
+                break
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+
+            # Still being copied by the scanning station
+            if time.time() - stat.st_mtime < self.settle_seconds:
+                continue
+
+            sha256 = self.checkpoint.file_hash(file_path, stat.st_size, stat.st_mtime)
+            with self._pending_lock:
+                if sha256 in self._pending:
+                    continue
+
+            entry = self.checkpoint.get(sha256)
+            if entry is not None and entry["state"] == AnyOCRCheckpointState.Done:
+                continue
+            if entry is not None and entry["state"] == AnyOCRCheckpointState.Failed and entry["attempts"] >= self.max_attempts:
+                continue
+
+            with self._pending_lock:
+                self._pending.add(sha256)
+            self._queue.put((file_path, sha256))
+            queued += 1
+        return queued
+
+    def get_prompt(self, file_path: str) -> tuple:
+        # Returns (prompt file, prompt), routing the image to a template with prompt file "auto"
+        prompt_file = self.prompt_file
+        if prompt_file == OCR_ROUTER_AUTO_PROMPT:
+            with self._prompts_lock:
+                if self._router is None:
+                    from AnyOCRRouter import create_router
+                    self._router = create_router(os.path.join(os.path.dirname(__file__), OCR_ROUTER_INDEX_FILEPATH), OCR_ROUTER_FALLBACK_PROMPT, OCR_ROUTER_MIN_CONFIDENCE)
+            prompt_file, _ = self._router.route(file_path)
+
+        with self._prompts_lock:
+            if prompt_file not in self._prompts:
+                self._prompts[prompt_file] = AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, prompt_file, OCR_PROMPT_GENERATOR_FILEPATH)
+            return prompt_file, self._prompts[prompt_file]
+
+    def recognize_file(self, file_path: str) -> dict:
+        prompt_file, user_message = self.get_prompt(file_path)
+
+        if AnyOCREngine.is_document(file_path):
+            result = self.engine.recognize_document(
+                doc_src=file_path,
+                user_message=user_message,
+                img_detail_level=self.img_detail_level,
+                convert_idr=True,
+            )
+            return {"source": file_path, "prompt_file": prompt_file, **result}
+
+        # The shared engine keeps the last response, so each call works on its own copy
+        engine = copy.copy(self.engine)
+        engine.recognize(
+            img_src=AnyOCREngine.load_image(file_path),
+            user_message=user_message,
+            streaming_response=True,
+            img_detail_level=self.img_detail_level,
+            stop_condition=AnyOCREngineJSONCompletionDetector(),
+        )
+
+        result = {
+            "source": file_path,
+            "prompt_file": prompt_file,
+            "usage": AnyOCREngine.process_token_usage(engine.last_usage, True),
+        }
+        try:
+            result["status"] = "OK"
+            result["data"] = AnyOCREngine.parse_json_content(engine.last_all_content)
+        except json.JSONDecodeError:
+            result["status"] = "NOT_JSON"
+            result["content"] = engine.last_all_content
+        return result
+
+    def result_path_for(self, file_path: str) -> str:
+        if self.output_dir is None:
+            return f"{file_path}.json"
+
+        # Mirror the layout below the watched folder
+        for watch_dir in self.watch_dirs:
+            relative_path = os.path.relpath(file_path, watch_dir)
+            if not relative_path.startswith(".."):
+                return os.path.join(self.output_dir, f"{relative_path}.json")
+        return os.path.join(self.output_dir, f"{os.path.basename(file_path)}.json")
+
+    def write_result(self, file_path: str, result: dict) -> str:
+        result_path = self.result_path_for(file_path)
+        os.makedirs(os.path.dirname(result_path) or ".", exist_ok=True)
+
+        # Written to a temporary file first, so a crash never leaves a truncated result
+        tmp_path = f"{result_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, result_path)
+        return result_path
+
+    def read_result(self, file_path: str, sha256: str) -> dict | None:
+        # A result written for this content before, e.g. by a run that crashed before updating the checkpoint
+        try:
+            with open(self.result_path_for(file_path), "r") as f:
+                result = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return result if result.get("sha256") == sha256 else None
+
+    def write_sink(self, file_path: str, result: dict):
+        # The result is already written and checkpointed: a sink failure never sends the file upstream again
+        if self.sink is None or "data" not in result:
+            return
+        try:
+            self.sink.write(result["data"], source=file_path, prompt_file=result["prompt_file"], status=result["status"])
+        except Exception as e:
+            with self._stats_lock:
+                self.sink_failed += 1
+            logging.getLogger("rich").error(f"[bold red]Sink failed[/] {file_path}: {e}", extra={"markup": True})
+
+    def process_file(self, file_path: str, sha256: str):
+        attempt = self.checkpoint.start(sha256, file_path)
+        start_time = time.time()
+
+        result = self.read_result(file_path, sha256)
+        recovered = result is not None
+        if recovered:
+            result_path = self.result_path_for(file_path)
+        else:
+            try:
+                result = self.recognize_file(file_path)
+                result["sha256"] = sha256
+                result_path = self.write_result(file_path, result)
+            except Exception as e:
+                with self._stats_lock:
+                    self.failed += 1
+                self.checkpoint.fail(sha256, str(e))
+                logging.getLogger("rich").error(f"[bold red]Failed[/] {file_path} (attempt {attempt}/{self.max_attempts}): {e}", extra={"markup": True})
+                return
+
+        usage = result.get("usage") or {}
+        self.checkpoint.complete(sha256, result_path, usage)
+        self.write_sink(file_path, result)
+
+        if recovered:
+            # Its tokens were counted by the run that wrote it
+            with self._stats_lock:
+                self.processed += 1
+            logging.getLogger("rich").info(f"[bold green]{result['status']}[/] {file_path} -> {result_path}, written before", extra={"markup": True})
+            return
+
+        with self._stats_lock:
+            self.processed += 1
+            self.total_tokens += usage.get("total_tokens", 0)
+            self.total_cost += usage.get("est_cost", 0.0)
+        logging.getLogger("rich").info(
+            f"[bold green]{result['status']}[/] {file_path} -> {result_path}, {usage.get('total_tokens', 0)} tokens, {time.time() - start_time:.2f} seconds",
+            extra={"markup": True},
+        )
+
+    def _worker(self):
+        while True:
+            try:
+                file_path, sha256 = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return
+                continue
+
+            try:
+                if not self.stop_event.is_set():
+                    self.process_file(file_path, sha256)
+            finally:
+                with self._pending_lock:
+                    self._pending.discard(sha256)
+                self._queue.task_done()
+
+    def run(self, once: bool = False):
+        workers = [threading.Thread(target=self._worker, name=f"anyocr-watch-{i}", daemon=True) for i in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        logging.getLogger("rich").info(f"Watching [bold green]{', '.join(self.watch_dirs)}[/] with {self.workers} worker(s)", extra={"markup": True})
+        try:
+            while not self.stop_event.is_set():
+                self.scan()
+                if once:
+                    self._queue.join()
+                    break
+                self.stop_event.wait(self.poll_interval)
+        finally:
+            self.stop_event.set()
+            for worker in workers:
+                worker.join()
+            if self.sink is not None:
+                self.sink.flush()
+
+        logging.getLogger("rich").info(
+            f"Processed [bold green]{self.processed}[/] file(s), {self.failed} failed, {self.sink_failed} not written to the sink, {self.total_tokens} tokens, $ {self.total_cost:.4f}",
+            extra={"markup": True},
+        )
+
+    def stop(self, *args):
+        # Files being recognized are finished, queued ones are picked up again after a restart
+        logging.getLogger("rich").info("Stopping...")
+        self.stop_event.set()
+
+    def __repr__(self):
+        return f"<AnyOCRWatcher {self.watch_dirs}>"
+
+
+# Got it from: https://stackoverflow.com/questions/52403065/argparse-optional-boolean
+def str_to_bool(value):
+    if value.lower() in {'false', 'f', '0', 'no', 'n'}:
+        return False
+    elif value.lower() in {'true', 't', '1', 'yes', 'y'}:
+        return True
+    else:
+        raise argparse.ArgumentTypeError(f'Invalid boolean value: {value}')
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="AnyOCR Watch - Recognize images dropped into folders", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-w', '--watch', help='Folder to watch, can be repeated', action='append', required=True)
+    parser.add_argument('-p', '--prompt', help='Path to the prompt file to read, or "auto" to pick the template from each image', required=True)
+    parser.add_argument('-o', '--output-dir', help='Write results to this folder instead of next to the files')
+    parser.add_argument('-c', '--checkpoint', help='Checkpoint database of processed files', default=OCR_WATCH_CHECKPOINT_FILEPATH)
+    parser.add_argument('-r', '--recursive', help='Also watch sub-folders', type=str_to_bool, nargs='?', const=True, default=False)
+    parser.add_argument('-j', '--workers', help='Number of files recognized concurrently', type=int, default=OCR_WATCH_WORKERS)
+    parser.add_argument('-i', '--interval', help='Polling interval in seconds', type=float, default=OCR_WATCH_POLL_SECONDS)
+    parser.add_argument('-v', '--vision', help='Use Azure AI vision or not', type=str_to_bool, nargs='?', const=True, default=OCR_USE_AZURE_VISION)
+    parser.add_argument('--detail', help='Image detail level', choices=[level.value for level in AnyOCREngineImageDetailLevel], default=AnyOCREngineImageDetailLevel.DetailAuto.value)
+    parser.add_argument('--sink', help='Also append flattened results to this .parquet, .csv or .jsonl file')
+    parser.add_argument('--once', help='Process the files present now and exit', type=str_to_bool, nargs='?', const=True, default=False)
+    parser.add_argument('-d', '--debug', help='Show debugging messages', type=str_to_bool, nargs='?', const=True, default=False)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    load_dotenv()
+
+    args = parse_arguments()
+
+    # Configure logging
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    from rich.logging import RichHandler
+    logging.basicConfig(level=log_level, format="%(message)s", datefmt="[%X]", handlers=[RichHandler()])
+
+    logging.getLogger("rich").info("[bold green]AnyOCR Watch[/] is starting...", extra={"markup": True})
+    engine = AnyOCREngine(
+        azure_deployment_name=os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"),
+        api_version=OCR_API_VERSION_DEFAULT,
+        azure_vision_key=os.environ.get("AZURE_AI_VISION_API_KEY"),
+        azure_vision_api_version=OCR_API_VERSION_AI_VISION,
+        azure_vision_endpoint=os.environ.get("AZURE_AI_VISION_ENDPOINT"),
+        azure_vision_active=args.vision,
+        stream_include_usage=OCR_STREAM_INCLUDE_USAGE,
+    )
+
+    watcher = AnyOCRWatcher(
+        engine,
+        args.watch,
+        args.prompt,
+        AnyOCRCheckpoint(args.checkpoint),
+        output_dir=args.output_dir,
+        recursive=args.recursive,
+        workers=args.workers,
+        poll_interval=args.interval,
+        img_detail_level=AnyOCREngineImageDetailLevel(args.detail),
+        sink=create_sink(args.sink) if args.sink else None,
+    )
+    signal.signal(signal.SIGINT, watcher.stop)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    try:
+        watcher.run(once=args.once)
+    finally:
+        if watcher.sink is not None:
+            watcher.sink.close()
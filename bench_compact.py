@@ -0,0 +1,127 @@
+"""
+Compact output benchmark
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Compares completion tokens and latency per template with and without compact output (see AnyOCRCompact):
+every template is run on its image in both modes, and the expanded compact answers are checked to have
+the same shape as the plain ones. With --estimate, no request is sent: the completion tokens of saved
+results (JSON files) are counted locally as the model would write them, plain and compact.
+
+Usage:
+    python bench_compact.py -p prompts/prompt_json_kk.md=kk.jpg -p prompts/prompt_json_toll.md=toll.jpg -r 3
+    python bench_compact.py --estimate results/kk_1.json results/toll_1.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+from dotenv import load_dotenv
+
+from _constants import *
+from AnyOCREngine import AnyOCREngine, AnyOCREngineImageDetailLevel, AnyOCREngineOpMode
+from AnyOCRCompact import compact_json
+
+
+def key_paths(data, path: str = "") -> set:
+    # Paths of all values, with list items collapsed, to compare the shape of two answers
+    if isinstance(data, dict):
+        return set().union(*(key_paths(value, f"{path}.{key}") for key, value in data.items())) if data else {path}
+    if isinstance(data, list):
+        return set().union(*(key_paths(value, f"{path}[]") for value in data)) if data else {path}
+    return {path}
+
+
+def estimate_result(data) -> dict:
+    # Templates show indented examples, so that's how plain answers are written; compact answers are minified
+    plain_tokens = AnyOCREngine.estimate_text_tokens(json.dumps(data, ensure_ascii=False, indent=2))
+    minified_tokens = AnyOCREngine.estimate_text_tokens(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    compact_tokens = AnyOCREngine.estimate_text_tokens(json.dumps(compact_json(data), ensure_ascii=False, separators=(",", ":")))
+    return {"plain": plain_tokens, "minified": minified_tokens, "compact": compact_tokens}
+
+
+def run_template(engine: AnyOCREngine, prompt_file: str, img_url: str, repeat: int, img_detail_level: AnyOCREngineImageDetailLevel) -> dict:
+    user_message = AnyOCREngine.load_prompt_from_file(AnyOCREngineOpMode.Recognition, prompt_file, OCR_PROMPT_GENERATOR_FILEPATH)
+    img_src = AnyOCREngine.load_image(img_url)
+
+    runs = {"plain": [], "compact": []}
+    shapes = {}
+    for _ in range(repeat):
+        for mode in runs:
+            start_time = time.time()
+            engine.recognize(
+                img_src=img_src,
+                user_message=user_message,
+                streaming_response=False,
+                img_detail_level=img_detail_level,
+                temperature=0.0,
+                compact_output=mode == "compact",
+            )
+            runs[mode].append((engine.last_usage.completion_tokens, time.time() - start_time))
+            try:
+                shapes.setdefault(mode, key_paths(AnyOCREngine.parse_json_content(engine.last_all_content)))
+            except json.JSONDecodeError:
+                shapes.setdefault(mode, None)
+
+    result = {"same_shape": shapes["plain"] is not None and shapes["plain"] == shapes["compact"]}
+    for mode, mode_runs in runs.items():
+        result[mode] = {
+            "completion_tokens": statistics.median(tokens for tokens, _ in mode_runs),
+            "latency": statistics.median(latency for _, latency in mode_runs),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AnyOCR compact output benchmark - completion tokens and latency per template", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--prompt', help='Template and its image as prompt_file=image_url', action='append', default=[])
+    parser.add_argument('-r', '--repeat', help='Number of runs per template and mode (medians are reported)', type=int, default=3)
+    parser.add_argument('-l', '--detail', help='Image detail level', choices=[level.value for level in AnyOCREngineImageDetailLevel], default=AnyOCREngineImageDetailLevel.DetailLow.value)
+    parser.add_argument('--estimate', help='Only count the completion tokens of these saved results (JSON files), without sending requests', nargs='+')
+    parser.add_argument('-o', '--output', help='Also write the report to this file')
+    args = parser.parse_args()
+
+    if args.estimate:
+        lines = [f"{'result':<40} {'plain':>8} {'minified':>9} {'compact':>8} {'saved':>7}"]
+        for result_file in args.estimate:
+            with open(result_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # API responses, or the recognized data itself
+            if isinstance(data, dict) and data.get("status") == "OK" and "data" in data:
+                data = data["data"]
+            est = estimate_result(data)
+            lines.append(f"{result_file:<40} {est['plain']:>8} {est['minified']:>9} {est['compact']:>8} {1 - est['compact'] / est['plain']:>7.0%}")
+    else:
+        if not args.prompt:
+            parser.error("Give at least one --prompt prompt_file=image_url, or --estimate")
+        load_dotenv()
+        engine = AnyOCREngine(
+            azure_deployment_name=os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            api_version=OCR_API_VERSION_DEFAULT,
+            azure_vision_active=False,
+        )
+        lines = [f"{'template':<40} {'plain tok':>9} {'compact tok':>11} {'saved':>7} {'plain s':>8} {'compact s':>9}  same shape"]
+        for prompt in args.prompt:
+            prompt_file, _, img_url = prompt.partition("=")
+            result = run_template(engine, prompt_file, img_url, args.repeat, AnyOCREngineImageDetailLevel(args.detail))
+            plain, compact = result["plain"], result["compact"]
+            lines.append(
+                f"{prompt_file:<40} {plain['completion_tokens']:>9.0f} {compact['completion_tokens']:>11.0f} "
+                f"{1 - compact['completion_tokens'] / plain['completion_tokens']:>7.0%} {plain['latency']:>8.2f} {compact['latency']:>9.2f}  "
+                f"{'yes' if result['same_shape'] else 'NO'}"
+            )
+
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
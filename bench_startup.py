@@ -0,0 +1,121 @@
+"""
+Startup benchmark
+Copyright (c) 2024 Andri Yadi (an.dri@me.com)
+DycodeX, eFishery
+
+Measures the import time of each AnyOCR module in a fresh interpreter (python -X importtime),
+so cold start regressions of the console app and the API service show up.
+
+Usage:
+    python bench_startup.py
+    python bench_startup.py -r 10 --budget anyocr_api=300 --budget anyocr_app=150
+"""
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+BENCH_MODULES = [
+    "_constants",
+    "AnyOCREngine",
+    "AnyOCRDocument",
+    "AnyOCRImageHash",
+    "AnyOCRRouter",
+    "AnyOCRDedupIndex",
+    "AnyOCRBatch",
+    "AnyOCRResultStore",
+    "AnyOCRAdmission",
+    "AnyOCRLedger",
+    "AnyOCRCheckpoint",
+    "AnyOCRSinks",
+    "AnyOCRLogging",
+    "AnyOCRCassette",
+    "AnyOCRTextCache",
+    "AnyOCRLocalOCR",
+    "AnyOCRCompact",
+    "AnyOCRCircuitBreaker",
+    "anyocr_app",
+    "anyocr_api",
+    "anyocr_watch",
+]
+
+# Heavy third-party modules worth reporting when they're pulled in at import time
+BENCH_HEAVY_MODULES = ["openai", "fastapi", "pydantic", "rich", "blinker", "PIL", "tiktoken", "requests"]
+
+
+def measure_import(module: str) -> tuple:
+    """
+    Import a module in a fresh interpreter. Returns (cumulative import time in ms, {heavy module: ms}).
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr.strip().splitlines()[-1]}")
+
+    total_ms = 0.0
+    heavy_ms = {}
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+
+        name = name.strip()
+        if name == module:
+            total_ms = int(cumulative) / 1000
+        elif name in BENCH_HEAVY_MODULES:
+            heavy_ms[name] = int(cumulative) / 1000
+    return total_ms, heavy_ms
+
+
+def parse_budgets(budgets: list) -> dict:
+    parsed_budgets = {}
+    for budget in budgets or []:
+        module, _, max_ms = budget.partition("=")
+        parsed_budgets[module] = float(max_ms)
+    return parsed_budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AnyOCR startup benchmark - import time per module", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('modules', nargs='*', help='Modules to measure', default=BENCH_MODULES)
+    parser.add_argument('-r', '--repeat', help='Number of fresh interpreter runs per module', type=int, default=5)
+    parser.add_argument('-b', '--budget', help='Import time budget as module=ms, fails the run when exceeded', action='append')
+    parser.add_argument('-o', '--output', help='Also write the report to this file')
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget)
+    lines = [f"{'module':<20} {'median ms':>10} {'min ms':>10}  heavy imports (ms)"]
+    over_budget = []
+
+    for module in args.modules:
+        runs = [measure_import(module) for _ in range(args.repeat)]
+        totals = [total_ms for total_ms, _ in runs]
+        median_ms = statistics.median(totals)
+        heavy_ms = runs[totals.index(min(totals))][1]
+
+        heavy_info = ", ".join(f"{name} {ms:.0f}" for name, ms in sorted(heavy_ms.items(), key=lambda item: -item[1]))
+        lines.append(f"{module:<20} {median_ms:>10.1f} {min(totals):>10.1f}  {heavy_info or '-'}")
+
+        if module in budgets and median_ms > budgets[module]:
+            over_budget.append(f"{module}: {median_ms:.1f} ms > budget {budgets[module]:.1f} ms")
+
+    report = "\n".join(lines + over_budget)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import asyncio
+import pytest
+from AnyOCRAdmission import AnyOCRAdmissionController, AnyOCRAdmissionRejected
+
+
+async def hold_slot(controller, client_id, started, release, order):
+    async with controller.admit(client_id):
+        order.append(client_id)
+        started.set()
+        await release.wait()
+
+
+def test_waiting_clients_are_served_round_robin():
+    async def scenario():
+        controller = AnyOCRAdmissionController(max_in_flight=1, max_queue=10)
+        release = asyncio.Event()
+        order = []
+
+        tasks = [asyncio.create_task(hold_slot(controller, "batch", asyncio.Event(), release, order))]
+        await asyncio.sleep(0)
+        for client_id in ["batch", "batch", "batch", "user"]:
+            tasks.append(asyncio.create_task(hold_slot(controller, client_id, asyncio.Event(), release, order)))
+            await asyncio.sleep(0)
+
+        assert controller.stats()["queued"] == 4
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, controller.stats()
+
+    order, stats = asyncio.run(scenario())
+    # The interactive user doesn't wait behind the whole batch
+    assert order == ["batch", "batch", "user", "batch", "batch"]
+    assert stats["in_flight"] == 0
+    assert stats["admitted"] == 5
+
+
+def test_full_queue_evicts_heaviest_client_or_rejects():
+    async def scenario():
+        controller = AnyOCRAdmissionController(max_in_flight=1, max_queue=2)
+        release = asyncio.Event()
+        order = []
+
+        running = asyncio.create_task(hold_slot(controller, "batch", asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+        queued = [asyncio.create_task(hold_slot(controller, "batch", asyncio.Event(), release, order)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        # A newcomer takes the place of the newest batch waiter
+        newcomer = asyncio.create_task(hold_slot(controller, "user", asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+
+        # The queue is now shared evenly, so the next one is rejected outright
+        with pytest.raises(AnyOCRAdmissionRejected) as rejected:
+            await controller.acquire("batch")
+        assert rejected.value.retry_after >= 1
+
+        release.set()
+        results = await asyncio.gather(running, *queued, newcomer, return_exceptions=True)
+        return results, order, controller.stats()
+
+    results, order, stats = asyncio.run(scenario())
+    assert isinstance(results[2], AnyOCRAdmissionRejected)
+    assert order == ["batch", "batch", "user"]
+    assert stats["rejected"] == 2
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        controller = AnyOCRAdmissionController(max_in_flight=1, max_queue=4)
+        release = asyncio.Event()
+
+        running = asyncio.create_task(hold_slot(controller, "a", asyncio.Event(), release, []))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        assert controller.stats()["queued"] == 1
+
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        queued_after_cancel = controller.stats()["queued"]
+
+        release.set()
+        await running
+        return queued_after_cancel, controller.stats()
+
+    queued_after_cancel, stats = asyncio.run(scenario())
+    assert queued_after_cancel == 0
+    assert stats["in_flight"] == 0
+
+
+def test_fan_out_call_holds_a_slot_per_upstream_call():
+    async def scenario():
+        controller = AnyOCRAdmissionController(max_in_flight=4, max_queue=4)
+        release = asyncio.Event()
+        order = []
+
+        async def hold_slots(client_id, slots):
+            async with controller.admit(client_id, slots=slots) as held_slots:
+                order.append((client_id, held_slots, controller.in_flight))
+                await release.wait()
+
+        running = asyncio.create_task(hold_slots("user", 1))
+        await asyncio.sleep(0)
+        # Needs all 4 slots, and isn't overtaken by a single-slot call queued after it
+        tiled = asyncio.create_task(hold_slots("tiled", 8))
+        await asyncio.sleep(0)
+        single = asyncio.create_task(hold_slots("other", 1))
+        await asyncio.sleep(0)
+        queued = controller.stats()["queued"]
+
+        release.set()
+        await asyncio.gather(running, tiled, single)
+        return queued, order, controller.stats()
+
+    queued, order, stats = asyncio.run(scenario())
+    assert queued == 2
+    assert order == [("user", 1, 1), ("tiled", 4, 4), ("other", 1, 1)]
+    assert stats["in_flight"] == 0
+
+
+async def hold_lane_slot(controller, client_id, lane, release, order):
+    async with controller.admit(client_id, lane):
+        order.append(lane)
+        await release.wait()
+
+
+def test_interactive_lane_goes_first_until_bulk_is_starved():
+    async def scenario(max_starvation_seconds):
+        controller = AnyOCRAdmissionController(max_in_flight=1, max_queue=10, max_starvation_seconds=max_starvation_seconds)
+        order = []
+
+        hold = asyncio.Event()
+        running = asyncio.create_task(hold_lane_slot(controller, "backfill", "bulk", hold, order))
+        await asyncio.sleep(0)
+        # Queued calls finish as soon as they're admitted
+        release = asyncio.Event()
+        release.set()
+        tasks = [asyncio.create_task(hold_lane_slot(controller, "backfill", "bulk", release, order))]
+        await asyncio.sleep(0.05)
+        for client_id in ["app-1", "app-2"]:
+            tasks.append(asyncio.create_task(hold_lane_slot(controller, client_id, "interactive", release, order)))
+            await asyncio.sleep(0)
+
+        hold.set()
+        await asyncio.gather(running, *tasks)
+        return order[1:], controller.stats()
+
+    # Strict priority: the bulk call queued first waits for both interactive calls
+    order, stats = asyncio.run(scenario(max_starvation_seconds=None))
+    assert order == ["interactive", "interactive", "bulk"]
+    assert stats["lanes"]["bulk"]["admitted"] == 2
+    assert stats["lanes"]["interactive"]["queue_wait_max"] > 0
+
+    # Past the starvation bound, it goes first
+    order, stats = asyncio.run(scenario(max_starvation_seconds=0.01))
+    assert order == ["bulk", "interactive", "interactive"]
+    assert stats["lanes"]["bulk"]["promoted"] == 1
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+
+def test_full_queue_evicts_bulk_for_interactive():
+    async def scenario():
+        controller = AnyOCRAdmissionController(max_in_flight=1, max_queue=1)
+        release = asyncio.Event()
+        order = []
+
+        running = asyncio.create_task(hold_lane_slot(controller, "app", "interactive", release, order))
+        await asyncio.sleep(0)
+        bulk = asyncio.create_task(hold_lane_slot(controller, "backfill", "bulk", release, order))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(hold_lane_slot(controller, "app", "interactive", release, order))
+        await asyncio.sleep(0)
+
+        release.set()
+        results = await asyncio.gather(running, bulk, interactive, return_exceptions=True)
+        return results, order, controller.stats()
+
+    results, order, stats = asyncio.run(scenario())
+    assert isinstance(results[1], AnyOCRAdmissionRejected)
+    assert order == ["interactive", "interactive"]
+    assert stats["lanes"]["bulk"]["rejected"] == 1
+    assert stats["lanes"]["interactive"]["admitted"] == 2
@@ -0,0 +1,53 @@
+import os
+import json
+import pytest
+from AnyOCREngine import AnyOCREngine
+from AnyOCRBatch import write_batch_files, ingest_batch_results, sum_batch_usage
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "test_fixtures")
+
+# 1x1 pixel PNG
+TEST_IMG_SRC = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+
+def create_engine():
+    return AnyOCREngine(api_key="test-key", azure_base_url="https://example.openai.azure.com", azure_deployment_name="gpt-4-vision")
+
+
+def test_write_batch_files_splits_by_lines(tmp_path):
+    engine = create_engine()
+    file_paths = write_batch_files(engine, [TEST_IMG_SRC] * 5, "Extract all text.", str(tmp_path), max_lines=2)
+    assert [os.path.basename(p) for p in file_paths] == ["batch_input_001.jsonl", "batch_input_002.jsonl", "batch_input_003.jsonl"]
+
+    with open(file_paths[0], "r") as f:
+        request = json.loads(f.readline())
+    assert request["method"] == "POST"
+    assert request["url"] == "/chat/completions"
+    assert request["body"]["model"] == "gpt-4-vision"
+    assert request["body"]["messages"] == engine.build_messages("Extract all text.", TEST_IMG_SRC)
+
+    with open(os.path.join(tmp_path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    assert len(manifest) == 5
+
+
+def test_write_batch_files_splits_by_size(tmp_path):
+    file_paths = write_batch_files(create_engine(), [TEST_IMG_SRC] * 3, "Extract all text.", str(tmp_path), max_file_bytes=1000)
+    assert len(file_paths) == 3
+
+
+def test_ingest_batch_results():
+    results = ingest_batch_results(
+        [os.path.join(FIXTURES_DIR, "batch_output.jsonl")],
+        os.path.join(FIXTURES_DIR, "batch_manifest.json"),
+    )
+    assert [r["status"] for r in results] == ["OK", "NOT_JSON", "ERROR"]
+    assert results[0]["img_url"] == "receipts/toll_1.jpg"
+    assert results[0]["data"]["jumlah_tarif"] == 22000
+    assert results[0]["usage"]["total_tokens"] == 600
+    assert results[1]["content"] == "The image is too blurry to read."
+    assert results[2]["error"]["code"] == "invalid_image"
+
+    usage = sum_batch_usage(results)
+    assert usage["total_tokens"] == 1150
+    assert usage["est_cost"] == pytest.approx(AnyOCREngine.estimate_cost(1080, 70) * 0.5)
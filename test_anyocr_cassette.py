@@ -0,0 +1,80 @@
+import json
+import time
+import httpx
+import pytest
+from openai import APIConnectionError
+
+from AnyOCREngine import AnyOCREngine, AnyOCREngineResponseHandler, AnyOCREngineImageDetailLevel
+from AnyOCRCassette import AnyOCRCassette, AnyOCRRecordingTransport, AnyOCRCassetteMismatch, create_replay_client
+
+CASSETTE_FILE = "test_fixtures/cassette_vision_stream.json"
+
+
+def make_engine(http_client, azure_vision_active=True):
+    return AnyOCREngine(
+        api_key="test",
+        azure_base_url="https://example.com",
+        azure_deployment_name="gpt-4v",
+        api_version="2024-02-15-preview",
+        azure_vision_active=azure_vision_active,
+        azure_vision_key="test",
+        azure_vision_endpoint="https://example.com",
+        azure_vision_api_version="2023-12-01-preview",
+        response_handler=AnyOCREngineResponseHandler(name="Test Handler"),
+        http_client=http_client,
+    )
+
+
+def recognize(engine, timeout=None):
+    engine.recognize(
+        img_src="data:image/jpeg;base64,/9j/4AAQ",
+        user_message="Extract all text.",
+        streaming_response=True,
+        img_detail_level=AnyOCREngineImageDetailLevel.DetailLow,
+        timeout=timeout,
+    )
+
+
+def test_replay_extensions_stream():
+    engine = make_engine(create_replay_client(CASSETTE_FILE, speed=0))
+    recognize(engine)
+
+    assert AnyOCREngine.parse_json_content(engine.last_all_content)["nik"] == "3515080101900001"
+    assert engine.last_grounding_content.startswith("PROVINSI JAWA TIMUR")
+    assert engine.last_usage.estimated
+
+    # Every recorded response is served once (with a timeout, the upstream client doesn't retry)
+    with pytest.raises(APIConnectionError) as error:
+        recognize(engine, timeout=10)
+    assert isinstance(error.value.__cause__, AnyOCRCassetteMismatch)
+
+
+def test_replay_is_accelerated():
+    recorded_seconds = AnyOCRCassette.load(CASSETTE_FILE).interactions[0]["response"]["chunks"][-1]["t"]
+    engine = make_engine(create_replay_client(CASSETTE_FILE, speed=10, loop=True))
+
+    start_time = time.monotonic()
+    recognize(engine)
+    recognize(engine)
+    assert 2 * recorded_seconds / 10 <= time.monotonic() - start_time < 2 * recorded_seconds
+
+
+def test_recording_redacts_secrets(tmp_path):
+    def upstream(request):
+        content = json.dumps({"choices": [{"index": 0, "message": {"role": "assistant", "content": '{"nik": "123"}'}, "finish_reason": "stop"}],
+                              "usage": {"prompt_tokens": 120, "completion_tokens": 8, "total_tokens": 128}})
+        return httpx.Response(200, headers={"content-type": "application/json"}, content=content)
+
+    cassette = AnyOCRCassette(str(tmp_path / "cassette.json"))
+    engine = make_engine(httpx.Client(transport=AnyOCRRecordingTransport(cassette, httpx.MockTransport(upstream))), azure_vision_active=False)
+    engine.recognize(img_src="data:image/jpeg;base64,/9j/4AAQ", user_message="Extract all text.", streaming_response=False)
+
+    with open(tmp_path / "cassette.json") as f:
+        recorded = f.read()
+    assert "/9j/4AAQ" not in recorded and '"api-key": "REDACTED"' in recorded
+
+    # Replays as recorded
+    engine = make_engine(create_replay_client(str(tmp_path / "cassette.json"), speed=0), azure_vision_active=False)
+    engine.recognize(img_src="data:image/jpeg;base64,/9j/4AAQ", user_message="Extract all text.", streaming_response=False)
+    assert engine.last_all_content == '{"nik": "123"}'
+    assert engine.last_usage.total_tokens == 128
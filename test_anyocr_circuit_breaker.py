@@ -0,0 +1,78 @@
+import time
+import pytest
+
+
+def test_breaker_opens_on_errors_and_latency_and_recovers():
+    from AnyOCRCircuitBreaker import AnyOCRCircuitBreaker
+
+    breaker = AnyOCRCircuitBreaker("vision", min_calls=4, max_error_rate=0.5, max_p95_latency=1.0, open_seconds=0.05)
+    for ok in [True, False, False, False]:
+        assert breaker.allow()
+        breaker.record(ok, 0.1)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats()["refused"] == 1
+
+    # Half-open after open_seconds: a single probe, and its success closes the breaker
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+
+    # Slow first chunks open it too
+    for _ in range(4):
+        assert breaker.allow()
+        breaker.record(True, 2.5)
+    assert breaker.state == "open"
+    assert breaker.stats()["last_open_reason"].startswith("p95 latency")
+
+    # A failed probe opens it again
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(False, None)
+    assert breaker.state == "open"
+    assert breaker.opened == 3
+
+
+def test_engine_falls_back_to_plain_route_while_vision_is_open():
+    from types import SimpleNamespace
+    from AnyOCREngine import AnyOCREngine
+    from AnyOCRCircuitBreaker import AnyOCRCircuitOpen, create_circuit_breakers
+
+    requests = []
+    routes = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        if routes[-1]:
+            raise ConnectionError("Azure AI Vision is down")
+        return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content='{"nik": "3515080101900001"}'))], usage=None)])
+
+    def create_client(azure_vision_active, timeout=None):
+        routes.append(azure_vision_active)
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))), {}
+
+    breakers = create_circuit_breakers(min_calls=2, open_seconds=60)
+    engine = AnyOCREngine(api_key="test", azure_base_url="https://example.com", azure_deployment_name="gpt-4v", circuit_breakers=breakers)
+    engine._create_client = create_client
+    img_src = "data:image/jpeg;base64,/9j/4AAQ"
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            engine.recognize(img_src=img_src, user_message="Extract the NIK.", fallback_user_message="Extract the NIK, without OCR.")
+    assert breakers["vision"].state == "open"
+
+    engine.recognize(img_src=img_src, user_message="Extract the NIK.", fallback_user_message="Extract the NIK, without OCR.")
+    assert routes[-1] is False
+    assert engine.last_route_fallback
+    assert engine.last_all_content == '{"nik": "3515080101900001"}'
+    assert requests[-1]["messages"][-1]["content"][0]["text"] == "Extract the NIK, without OCR."
+    assert breakers["plain"].stats()["calls"] == 1
+
+    # Nothing is left to fall back to
+    breakers["plain"]._open("test")
+    with pytest.raises(AnyOCRCircuitOpen) as circuit_open:
+        engine.recognize(img_src=img_src, user_message="Extract the NIK.")
+    assert circuit_open.value.route == "plain"
+    assert circuit_open.value.retry_after >= 1
@@ -0,0 +1,39 @@
+def test_expand_compact_json():
+    from AnyOCRCompact import expand_compact_json, compact_json
+
+    data = {
+        "no_kartu_keluarga": "3204372008130010",
+        "anggota_keluarga": [
+            {"nama_lengkap": "MUCHLIS", "nik": "5271042709720004", "pendidikan": {"jenjang": "D3"}},
+            {"nama_lengkap": "SITI", "nik": "5271046510750002", "pendidikan": {"jenjang": "SLTA"}},
+        ],
+        "tags": ["a", "b"],
+    }
+    assert expand_compact_json(compact_json(data)) == data
+    assert compact_json(data)["anggota_keluarga"]["__k"] == ["nama_lengkap", "nik", "pendidikan"]
+
+    # Rows written as objects anyway are kept, and extra values are dropped
+    compact = {"rows": {"__k": ["a", "b"], "__v": [[1, 2, 3], {"a": 4, "b": 5}]}}
+    assert expand_compact_json(compact) == {"rows": [{"a": 1, "b": 2}, {"a": 4, "b": 5}]}
+
+
+def test_compact_output_is_expanded():
+    import json
+    from types import SimpleNamespace
+    from AnyOCREngine import AnyOCREngine
+
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        content = '```json\n{"rows":{"__k":["nama","nik"],"__v":[["MUCHLIS","5271042709720004"],["SITI",null]]}}\n```'
+        usage = SimpleNamespace(prompt_tokens=300, completion_tokens=30, total_tokens=330)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+    engine = AnyOCREngine(api_key="test", azure_base_url="https://example.com", azure_deployment_name="gpt-4v", azure_vision_active=False)
+    engine._create_client = lambda azure_vision_active, timeout=None: (SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))), {})
+
+    engine.recognize(img_src="data:image/jpeg;base64,/9j/4AAQ", user_message="Extract the family members.", streaming_response=False, compact_output=True)
+    assert "__k" in requests[-1]["messages"][-1]["content"][0]["text"]
+    assert json.loads(engine.last_all_content) == {"rows": [{"nama": "MUCHLIS", "nik": "5271042709720004"}, {"nama": "SITI", "nik": None}]}
+    assert "__v" in engine.last_compact_content
@@ -0,0 +1,70 @@
+import io
+import base64
+import random
+from AnyOCRDedupIndex import BKTree, AnyOCRNearDuplicateIndex, compute_image_hash, compute_content_digest
+
+
+def test_bktree_search_matches_linear_scan():
+    rng = random.Random(42)
+    values = [rng.getrandbits(64) for _ in range(500)]
+    tree = BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+
+    query = values[123] ^ 0b1011
+    expected = sorted(((value ^ query).bit_count(), i) for i, value in enumerate(values) if (value ^ query).bit_count() <= 12)
+    assert sorted(tree.search(query, 12)) == expected
+
+
+def test_lookup_is_scoped_by_template():
+    index = AnyOCRNearDuplicateIndex(max_distance=4)
+    result = {"status": "OK", "data": {"nik": "123"}, "usage": {"total_tokens": 500, "est_cost": 0.01}}
+    index.store("prompt_json_ktp.md", 0b1111, result)
+
+    assert index.lookup("prompt_json_ktp.md", 0b1110) == (result, 1)
+    assert index.lookup("prompt_json_kk.md", 0b1111) is None
+
+    stats = index.stats()
+    assert stats["hits"] == 1
+    assert stats["lookups"] == 2
+    assert stats["saved_tokens"] == 500
+
+
+def test_evicts_least_recently_used():
+    index = AnyOCRNearDuplicateIndex(max_distance=0, max_entries=2)
+    index.store("ktp", 1, {"data": 1})
+    index.store("ktp", 2, {"data": 2})
+    index.lookup("ktp", 1)
+    index.store("ktp", 3, {"data": 3})
+
+    assert index.lookup("ktp", 2) is None
+    assert index.lookup("ktp", 1) is not None
+    assert index.lookup("ktp", 3) is not None
+
+
+def make_card_data_url(name, nik):
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (856, 540), (200, 220, 240))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, 856, 60], fill=(30, 60, 150))
+    draw.text((20, 20), "PROVINSI JAWA TIMUR", fill="white")
+    for i, (label, value) in enumerate([("NIK", nik), ("Nama", name), ("Alamat", "JL. MERDEKA 1")]):
+        draw.text((20, 100 + i * 40), label, fill="black")
+        draw.text((150, 100 + i * 40), f": {value}", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_same_layout_with_other_text_is_not_reused():
+    index = AnyOCRNearDuplicateIndex()
+    budi = make_card_data_url("BUDI SANTOSO", "3515080101900001")
+    siti = make_card_data_url("SITI AMINAH", "3515084402920002")
+    result = {"status": "OK", "data": {"nik": "3515080101900001"}, "usage": {"total_tokens": 500}}
+    index.store("ktp", compute_image_hash(budi), result, compute_content_digest(budi))
+
+    # The perceptual hash alone can't tell these cards apart
+    assert (compute_image_hash(budi) ^ compute_image_hash(siti)).bit_count() <= index.max_distance
+    assert index.lookup("ktp", compute_image_hash(siti), compute_content_digest(siti)) is None
+    assert index.lookup("ktp", compute_image_hash(budi), compute_content_digest(budi)) == (result, 0)
@@ -0,0 +1,112 @@
+from AnyOCRDocument import dpi_for_detail_level, guess_bytes_mime_type, is_document, merge_column_results, merge_json_results, split_image_tiles
+
+
+def test_is_document():
+    assert is_document("scans/lab_report.pdf")
+    assert is_document("https://example.com/kk.tiff?download=1")
+    assert is_document("data:application/pdf;base64,JVBERi0=")
+    assert not is_document("https://example.com/ktp.jpg")
+
+
+def test_dpi_for_detail_level():
+    # A4 page: 595 x 842 pt, shortest side is 8.26 inch
+    assert dpi_for_detail_level(595, 842, "high") == 93
+    assert dpi_for_detail_level(595, 842, "low") == 72
+
+
+def test_merge_json_results_concatenates_tables():
+    page_1 = {
+        "patient": {"name": "Aurorae, Princess"},
+        "small_blood_count": {"columns": ["test", "result"], "rows": [["leukozyten", "5.0"]]},
+    }
+    page_2 = {
+        "patient": {"name": "-", "date_of_birth": "28.11.1896"},
+        "small_blood_count": {"columns": ["test", "result"], "rows": [["erythrozyten", "4.6"]]},
+    }
+    merged = merge_json_results([page_1, page_2])
+    assert merged["patient"] == {"name": "Aurorae, Princess", "date_of_birth": "28.11.1896"}
+    assert merged["small_blood_count"]["rows"] == [["leukozyten", "5.0"], ["erythrozyten", "4.6"]]
+
+
+def test_merge_json_results_dedup_overlap():
+    tile_1 = {"Data Kualitas Air": {"Columns": ["ID Kolam", "DOC"], "Rows": [["B1", 3], ["B2", 3], ["B3", 4]]}}
+    tile_2 = {"Data Kualitas Air": {"Columns": [], "Rows": [["B3", "4"], ["B4", 3]]}}
+    merged = merge_json_results([tile_1, tile_2], dedup_overlap=True)
+    assert merged["Data Kualitas Air"]["Rows"] == [["B1", 3], ["B2", 3], ["B3", 4], ["B4", 3]]
+
+
+def make_image_data_url(width, height, key_color=None, key_width=0):
+    import io
+    import base64
+    from PIL import Image
+
+    image = Image.new("RGB", (width, height), "white")
+    if key_color:
+        image.paste(key_color, (0, 0, key_width, height))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+
+def load_tile(tile):
+    import io
+    import base64
+    from PIL import Image
+
+    return Image.open(io.BytesIO(base64.b64decode(tile.split(",", 1)[1])))
+
+
+def test_split_image_tiles_small_image_is_not_split():
+    img_src = make_image_data_url(1600, 500)
+    assert split_image_tiles(img_src) == (None, [img_src])
+
+
+def test_split_image_tiles_tall_image_into_strips():
+    layout, tiles = split_image_tiles(make_image_data_url(1600, 2400), overlap_ratio=0.1)
+    assert layout == "rows"
+    # Strips of 1600 x 600 px overlapping by 60 px: ceil((2400 - 60) / 540) = 5
+    assert len(tiles) == 5
+    assert all(load_tile(tile).size == (1600, 600) for tile in tiles)
+
+    layout, tiles = split_image_tiles(make_image_data_url(1600, 24000), max_tiles=6)
+    assert len(tiles) == 6
+    assert sum(load_tile(tile).height for tile in tiles) >= 24000
+
+
+def test_split_image_tiles_wide_image_into_columns_with_key_column():
+    # A 6000 x 1500 form: one tile is 4000 px wide, 900 px of which is the key column
+    layout, tiles = split_image_tiles(make_image_data_url(6000, 1500, key_color="red", key_width=900), overlap_ratio=0.1)
+    assert layout == "columns"
+    assert len(tiles) == 2
+    for tile in tiles:
+        tile_image = load_tile(tile).convert("RGB")
+        assert tile_image.height == 1500 and tile_image.width <= 4000
+        # Every tile starts with the key column, and goes on with the rest of the form (JPEG colors aren't exact)
+        red, green, blue = tile_image.getpixel((10, 750))
+        assert red > 240 and green < 16 and blue < 16
+        assert min(tile_image.getpixel((950, 750))) > 240
+
+
+def test_merge_column_results_joins_tables_on_key_column():
+    tile_1 = {
+        "tanggal": "12/03/2024",
+        "Data Kualitas Air": {"Columns": ["ID Kolam", "DOC", "pH"], "Rows": [["B1", 3, 7.1], ["B2", 3, 7.4]]},
+    }
+    tile_2 = {
+        "tanggal": "-",
+        "Data Kualitas Air": {"Columns": ["ID Kolam", "pH", "DO"], "Rows": [["B2", 7.4, 5.5], ["B1", 7.1, 6.0], ["B3", 7.0, 4.8]]},
+    }
+    merged = merge_column_results([tile_1, tile_2])
+    assert merged["tanggal"] == "12/03/2024"
+    assert merged["Data Kualitas Air"]["Columns"] == ["ID Kolam", "DOC", "pH", "DO"]
+    assert merged["Data Kualitas Air"]["Rows"] == [["B1", 3, 7.1, 6.0], ["B2", 3, 7.4, 5.5], ["B3", None, None, 4.8]]
+
+
+def test_guess_bytes_mime_type_from_content():
+    import base64
+
+    png_bytes = base64.b64decode(make_image_data_url(16, 16).split(",", 1)[1])
+    assert guess_bytes_mime_type(png_bytes) == "image/png"
+    assert guess_bytes_mime_type(b"%PDF-1.7\n") == "application/pdf"
+    assert guess_bytes_mime_type(b"II*\x00\x08\x00") == "image/tiff"
+    assert guess_bytes_mime_type(b"<html>") is None
@@ -0,0 +1,546 @@
+from types import SimpleNamespace
+
+from AnyOCREngine import AnyOCREngine, AnyOCREngineImageDetailLevel
+
+
+def fake_client(create, routes=None):
+    # Stands in for AnyOCREngine._create_client(): chat.completions.create() is the given function,
+    # and the route of every call (True for Azure Vision) is appended to routes
+    def create_client(azure_vision_active, timeout=None):
+        if routes is not None:
+            routes.append(azure_vision_active)
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))), {}
+
+    return create_client
+
+
+def chunk(content):
+    # A streamed chunk of the plain route
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))], usage=None)
+
+
+def vision_chunk(delta):
+    # A streamed chunk of the Azure Vision (extensions) route, e.g. vision_chunk({"content": "..."})
+    return SimpleNamespace(choices=[SimpleNamespace(messages=[{"delta": delta}])])
+
+
+def completion(content, prompt_tokens=100, completion_tokens=10):
+    # A non-streamed response
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+def test_choose_pack_size_limited_by_completion_budget():
+    with open("prompts/prompt_json_toll.md", "r") as f:
+        user_message = f.read()
+
+    pack_size = AnyOCREngine.choose_pack_size(user_message, 50, AnyOCREngineImageDetailLevel.DetailLow, 4096)
+    assert 1 <= pack_size <= 10
+    assert pack_size * AnyOCREngine.estimate_completion_tokens(user_message) <= 4096
+
+
+def test_choose_pack_size_never_exceeds_image_count():
+    assert AnyOCREngine.choose_pack_size("Extract all text.", 2) == 2
+
+
+def test_estimate_image_tokens():
+    # Examples from https://platform.openai.com/docs/guides/vision/calculating-costs
+    assert AnyOCREngine.estimate_image_tokens(1024, 1024, AnyOCREngineImageDetailLevel.DetailHigh) == 765
+    assert AnyOCREngine.estimate_image_tokens(2048, 4096, AnyOCREngineImageDetailLevel.DetailHigh) == 1105
+    assert AnyOCREngine.estimate_image_tokens(4096, 8192, AnyOCREngineImageDetailLevel.DetailLow) == 85
+
+
+def test_estimate_token_usage_reserves_max_tokens():
+    est_info = AnyOCREngine.estimate_token_usage("Extract all text.", ["missing.jpg"], max_tokens=1000)
+    assert est_info["max_completion_tokens"] == 1000
+    assert est_info["max_total_tokens"] == est_info["prompt_tokens"] + 1000
+    assert est_info["max_est_cost"] >= est_info["est_cost"]
+
+
+def make_streaming_engine(chunks, azure_vision_active=False, stream_include_usage=False):
+    from AnyOCREngine import AnyOCREngineResponseHandler
+
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return iter(chunks)
+
+    handler = AnyOCREngineResponseHandler(name="Test Handler")
+    engine = AnyOCREngine(
+        api_key="test",
+        azure_base_url="https://example.com",
+        azure_deployment_name="gpt-4v",
+        azure_vision_active=azure_vision_active,
+        response_handler=handler,
+        stream_include_usage=stream_include_usage,
+    )
+    engine._create_client = fake_client(create)
+    return engine, handler, requests
+
+
+def test_streaming_usage_from_final_chunk():
+
+    usage = SimpleNamespace(prompt_tokens=120, completion_tokens=8, total_tokens=128)
+    chunks = [
+        chunk('{"nik": '),
+        chunk('"123"}'),
+        SimpleNamespace(choices=[], usage=usage),
+    ]
+    engine, handler, requests = make_streaming_engine(chunks, stream_include_usage=True)
+    received = []
+
+    def on_usage_available(sender, **kwargs):
+        received.append(kwargs["usage"])
+
+    handler.on_usage_available.connect(on_usage_available, handler)
+
+    engine.recognize(img_src="missing.jpg", user_message="Extract all text.", streaming_response=True)
+
+    assert requests[0]["extra_body"]["stream_options"] == {"include_usage": True}
+    assert engine.last_all_content == '{"nik": "123"}'
+    assert received == [usage]
+
+
+def test_streaming_usage_is_estimated_for_extensions_stream():
+
+    chunks = [
+        vision_chunk({"content": '{"nik": '}),
+        vision_chunk({"content": '"123"}'}),
+    ]
+    engine, _, requests = make_streaming_engine(chunks, azure_vision_active=True, stream_include_usage=True)
+    engine.recognize(img_src="missing.jpg", user_message="Extract all text.", streaming_response=True, img_detail_level=AnyOCREngineImageDetailLevel.DetailLow)
+
+    assert "stream_options" not in requests[0]["extra_body"]
+    assert engine.last_usage.estimated
+    assert engine.last_usage.completion_tokens > 0
+    assert engine.last_usage.total_tokens == engine.last_usage.prompt_tokens + engine.last_usage.completion_tokens
+    assert engine.last_usage.prompt_tokens > 85
+
+
+def test_cancel_event_closes_stream():
+    import threading
+    import pytest
+    from AnyOCREngine import AnyOCREngineCancelled
+
+    cancel_event = threading.Event()
+
+    class Stream:
+        closed = False
+
+        def __iter__(self):
+            for content in ['{"nik": ', '"123"', ', "nama": ', '"Budi"}']:
+                if self.closed:
+                    return
+                yield chunk(content)
+                # The client goes away after the first chunk
+                cancel_event.set()
+
+        def close(self):
+            self.closed = True
+
+    stream = Stream()
+    engine, _, _ = make_streaming_engine([])
+    engine._create_client = fake_client(lambda **kwargs: stream)
+
+    with pytest.raises(AnyOCREngineCancelled) as cancelled:
+        engine.recognize(img_src="missing.jpg", user_message="Extract all text.", streaming_response=True, cancel_event=cancel_event)
+
+    assert stream.closed
+    assert cancelled.value.reason == "cancelled"
+    assert engine.last_all_content == '{"nik": '
+    assert cancelled.value.usage.estimated
+    assert cancelled.value.saved_completion_tokens > 0
+
+
+def test_json_completion_detector():
+    from AnyOCREngine import AnyOCREngineJSONCompletionDetector
+
+    detector = AnyOCREngineJSONCompletionDetector()
+    assert detector.feed("```json\n{\"items\": [{\"nama\": \"}]{\\\"\"}") is None
+    assert detector.feed("], \"total\": 3") is None
+    assert detector.feed("}\n```\nThe table above") == 1
+
+    assert AnyOCREngineJSONCompletionDetector().feed('{"status": "error"} Explanation: the image is blurry') == 19
+
+    # Not a JSON answer, never stops
+    detector = AnyOCREngineJSONCompletionDetector()
+    assert detector.feed("| Nama | NIK |\n| {x} |") is None
+    assert detector.feed("}") is None
+
+
+def test_stop_condition_closes_stream_after_json():
+    from AnyOCREngine import AnyOCREngineJSONCompletionDetector
+
+    class Stream:
+        closed = False
+        chunks_read = 0
+
+        def __iter__(self):
+            for content in ['{"status": ', '"error"}\n', "The image is ", "too blurry to read."]:
+                self.chunks_read += 1
+                yield chunk(content)
+
+        def close(self):
+            self.closed = True
+
+    stream = Stream()
+    engine, _, _ = make_streaming_engine([])
+    engine._create_client = fake_client(lambda **kwargs: stream)
+
+    engine.recognize(img_src="missing.jpg", user_message="Extract all text.", streaming_response=True, stop_condition=AnyOCREngineJSONCompletionDetector())
+
+    assert stream.closed and stream.chunks_read == 2
+    assert engine.last_stopped_early
+    assert AnyOCREngine.parse_json_content(engine.last_all_content) == {"status": "error"}
+    assert engine.last_usage.estimated
+
+
+def test_handlers_have_their_own_signals():
+
+    def make_chunks(content):
+        return [chunk(content)]
+
+    engine_a, handler_a, _ = make_streaming_engine(make_chunks('{"nik": "1"}'))
+    engine_b, handler_b, _ = make_streaming_engine(make_chunks('{"nik": "2"}'))
+    received_a, received_b = [], []
+
+    def on_chunk_a(sender, **kwargs):
+        received_a.append(kwargs["content"])
+
+    def on_chunk_b(sender, **kwargs):
+        received_b.append(kwargs["content"])
+
+    # Receivers connected without a sender only hear their own handler
+    handler_a.on_chunked_content_available.connect(on_chunk_a)
+    handler_b.on_chunked_content_available.connect(on_chunk_b)
+    assert handler_a.on_chunked_content_available is not handler_b.on_chunked_content_available
+
+    engine_a.recognize(img_src="missing.jpg", user_message="Extract all text.", streaming_response=True)
+    engine_b.recognize(img_src="missing.jpg", user_message="Extract all text.", streaming_response=True)
+    assert received_a == ['{"nik": "1"}']
+    assert received_b == ['{"nik": "2"}']
+
+
+def test_queue_handler_yields_events_in_order():
+    import asyncio
+    import threading
+    from AnyOCREngine import AnyOCREngineQueueResponseHandler
+
+    chunks = [
+        chunk('{"nik": '),
+        chunk('"123"}'),
+    ]
+    engine, _, _ = make_streaming_engine(chunks)
+    engine.response_handler = AnyOCREngineQueueResponseHandler(name="Request 1")
+    thread = threading.Thread(target=engine.recognize, kwargs={"img_src": "missing.jpg", "user_message": "Extract all text."})
+    thread.start()
+    events = list(engine.response_handler)
+    thread.join()
+
+    assert [event for event, _ in events] == ["chunk", "chunk", "content", "usage", "completed"]
+    assert events[2][1] == '{"nik": "123"}'
+
+    def create_client(azure_vision_active, timeout=None):
+        raise ConnectionError("offline")
+
+    async def consume():
+        engine.response_handler = AnyOCREngineQueueResponseHandler(name="Request 2", loop=asyncio.get_running_loop())
+        engine._create_client = create_client
+        recognition = asyncio.get_running_loop().run_in_executor(None, lambda: engine.recognize(img_src="missing.jpg", user_message="Extract all text."))
+        events = [event async for event in engine.response_handler]
+        await asyncio.gather(recognition, return_exceptions=True)
+        return events
+
+    events = asyncio.run(consume())
+    assert [event for event, _ in events] == ["error", "completed"]
+    assert isinstance(events[0][1], ConnectionError)
+
+
+def test_prompting_again_is_a_text_only_pass():
+    import json
+    from AnyOCREngine import AnyOCREngineJSONCompletionDetector
+    from AnyOCRTextCache import AnyOCRTextCache
+
+    grounding = {"grounding": {"lines": [{"text": "NIK : 3515080101900001"}, {"text": "Nama : BUDI SANTOSO"}], "status": "Success"}}
+    vision_chunks = [
+        vision_chunk({"role": "assistant"}),
+        vision_chunk({"content": '{"nik": "3515080101900001"}'}),
+        vision_chunk({"content": " Done."}),
+        vision_chunk({"role": "tool", "content": json.dumps(grounding)}),
+    ]
+    text_chunks = [chunk('{"nama": "BUDI SANTOSO"}')]
+
+    engine, _, requests = make_streaming_engine(vision_chunks, azure_vision_active=True)
+    engine.text_cache = AnyOCRTextCache(":memory:")
+    routes = []
+
+    class Stream(list):
+        def close(self):
+            pass
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return Stream(vision_chunks if routes[-1] else text_chunks)
+
+    engine._create_client = fake_client(create, routes)
+    img_src = "data:image/jpeg;base64,/9j/4AAQ"
+
+    # Without wait_for_grounding, early stop wins: the grounding output after the answer is never read, nor cached
+    engine.recognize(img_src=img_src, user_message="Extract the NIK.", stop_condition=AnyOCREngineJSONCompletionDetector())
+    assert engine.last_stopped_early and engine.last_grounding is None
+    engine.recognize(img_src=img_src, user_message="Extract the NIK.", stop_condition=AnyOCREngineJSONCompletionDetector())
+    assert routes == [True, True] and not engine.last_ocr_text_reused
+
+    # Unless asked to wait for it, then the discarded (but billed) rest of the answer is in the estimated usage
+    engine.recognize(img_src=img_src, user_message="Extract the NIK.", stop_condition=AnyOCREngineJSONCompletionDetector(), wait_for_grounding=True)
+    assert engine.last_all_content == '{"nik": "3515080101900001"}'
+    assert engine.last_grounding_content == "NIK : 3515080101900001\nNama : BUDI SANTOSO"
+    assert not engine.last_ocr_text_reused
+    assert engine.last_usage.completion_tokens == AnyOCREngine.estimate_text_tokens('{"nik": "3515080101900001"} Done.')
+
+    engine.recognize(img_src=img_src, user_message="Extract the name.")
+    assert routes == [True, True, True, False]
+    assert engine.last_ocr_text_reused
+    assert engine.last_all_content == '{"nama": "BUDI SANTOSO"}'
+    user_content = requests[-1]["messages"][-1]["content"]
+    assert all(part["type"] == "text" for part in user_content)
+    assert "Nama : BUDI SANTOSO" in user_content[-1]["text"]
+
+    # Not without the cached text
+    engine.recognize(img_src=img_src, user_message="Extract the name.", reuse_ocr_text=False)
+    assert routes[-1] is True
+
+    # Nor in another scope, e.g. for another API tenant
+    engine.text_cache_scope = "team-b"
+    engine.recognize(img_src=img_src, user_message="Extract the name.")
+    assert routes[-1] is True and not engine.last_ocr_text_reused
+
+
+def test_ocr_text_is_keyed_by_image_content(tmp_path):
+    from AnyOCRTextCache import ocr_text_key
+
+    image_path = tmp_path / "ktp.png"
+    image_path.write_bytes(b"first scan")
+    first_key = ocr_text_key(str(image_path))
+    assert ocr_text_key(str(image_path), scope="team-b") != first_key
+
+    # Same source, new content
+    image_path.write_bytes(b"second scan")
+    assert ocr_text_key(str(image_path)) != first_key
+
+
+def test_hybrid_path_depends_on_local_ocr_confidence(monkeypatch):
+    import AnyOCRLocalOCR
+    from AnyOCRLocalOCR import AnyOCRHybridStats, local_ocr_from_data
+
+    data = {
+        "text": ["", "GERBANG", "TOL", "CIKUPA", "", "Rp", "12.000"],
+        "conf": [-1, 96, 95, 91, -1, 90, 88],
+        "block_num": [1, 1, 1, 1, 1, 1, 1],
+        "par_num": [1, 1, 1, 1, 1, 1, 1],
+        "line_num": [0, 1, 1, 1, 2, 2, 2],
+    }
+    local_ocr = local_ocr_from_data(data)
+    assert local_ocr["text"] == "GERBANG TOL CIKUPA\nRp 12.000"
+    assert local_ocr["words"] == 5
+    assert abs(local_ocr["confidence"] - 0.92) < 1e-9
+
+    engine, _, requests = make_streaming_engine([])
+    routes = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return completion('{"gerbang": "CIKUPA"}', prompt_tokens=200, completion_tokens=20)
+
+    engine._create_client = fake_client(create, routes)
+    stats = AnyOCRHybridStats()
+    img_src = "data:image/jpeg;base64,/9j/4AAQ"
+
+    monkeypatch.setattr(AnyOCRLocalOCR, "run_local_ocr", lambda img_src, lang: local_ocr)
+    result = engine.recognize_hybrid(img_src=img_src, user_message="Extract the toll gate.", min_confidence=0.9, stats=stats)
+    assert result["path"] == "hybrid"
+    assert result["data"] == {"gerbang": "CIKUPA"}
+    assert routes[-1] is False
+    user_content = requests[-1]["messages"][-1]["content"]
+    assert "GERBANG TOL CIKUPA" in user_content[1]["text"]
+    assert user_content[-1]["image_url"]["detail"] == "low"
+
+    result = engine.recognize_hybrid(img_src=img_src, user_message="Extract the toll gate.", min_confidence=0.95, stats=stats)
+    assert result["path"] == "high_detail"
+    assert requests[-1]["messages"][-1]["content"][-1]["image_url"]["detail"] == "high"
+
+    report = stats.report()
+    assert report["hybrid"]["calls"] == report["high_detail"]["calls"] == 1
+    assert report["hybrid"]["share"] == 0.5
+    assert report["hybrid"]["avg_total_tokens"] == 220
+
+
+def test_recognize_multi_runs_every_prompt_on_the_same_image():
+
+    engine, _, requests = make_streaming_engine([])
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        user_message = kwargs["messages"][-1]["content"][0]["text"]
+        content = "The image is clear." if user_message == "Judge the clarity." else '{"jenis_dokumen": "KTP"}'
+        return completion(content)
+
+    engine._create_client = fake_client(create)
+    img_src = "data:image/jpeg;base64,/9j/4AAQ"
+
+    result = engine.recognize_multi(img_src=img_src, user_messages=["Which document is this?", "Judge the clarity."])
+    assert [r["status"] for r in result["results"]] == ["OK", "NOT_JSON"]
+    assert result["results"][0]["data"] == {"jenis_dokumen": "KTP"}
+    assert result["usage"]["total_tokens"] == 220
+    assert all(r["messages"][-1]["content"][1]["image_url"]["url"] == img_src for r in requests)
+
+
+def make_image_data_url(width, height):
+    import io
+    import base64
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(buffer, format="PNG")
+    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+
+def test_recognize_tiled_stitches_strips_and_drops_overlapping_rows():
+    import re
+
+    tile_contents = {
+        1: '{"Data Kualitas Air": {"Columns": ["ID Kolam", "DOC"], "Rows": [["B1", 3], ["B2", 3]]}}',
+        2: '{"Data Kualitas Air": {"Columns": [], "Rows": [["B2", "3"], ["B3", 4]]}}',
+        3: '{"Data Kualitas Air": {"Columns": [], "Rows": [["B3", 4], ["B4", 5]]}}',
+    }
+    engine, _, requests = make_streaming_engine([])
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        user_message = kwargs["messages"][-1]["content"][0]["text"]
+        tile_no = int(re.search(r"tile (\d+) of 3: a horizontal strip", user_message).group(1))
+        return completion(tile_contents[tile_no])
+
+    engine._create_client = fake_client(create)
+
+    # 1600 x 1500 px: three 1600 x 600 px strips
+    result = engine.recognize_tiled(img_src=make_image_data_url(1600, 1500), user_message="Extract the table.", max_workers=1)
+    assert result["status"] == "OK"
+    assert result["data"]["Data Kualitas Air"]["Columns"] == ["ID Kolam", "DOC"]
+    assert result["data"]["Data Kualitas Air"]["Rows"] == [["B1", 3], ["B2", 3], ["B3", 4], ["B4", 5]]
+    assert [tile["tile"] for tile in result["tiles"]] == [1, 2, 3]
+    assert result["usage"]["total_tokens"] == 330
+    assert all(request["messages"][-1]["content"][1]["image_url"]["detail"] == "high" for request in requests)
+
+
+def test_recognize_tiled_joins_column_tiles_row_by_row():
+    import re
+
+    tile_contents = {
+        1: '{"Data Kualitas Air": {"Columns": ["ID Kolam", "DOC", "pH"], "Rows": [["B1", 3, 7.1], ["B2", 3, 7.4]]}}',
+        2: '{"Data Kualitas Air": {"Columns": ["ID Kolam", "pH", "DO"], "Rows": [["B1", 7.1, 6.0], ["B2", 7.4, 5.5]]}}',
+    }
+    engine, _, _ = make_streaming_engine([])
+
+    def create(**kwargs):
+        user_message = kwargs["messages"][-1]["content"][0]["text"]
+        tile_no = int(re.search(r"tile (\d+) of 2: a vertical slice", user_message).group(1))
+        return completion(tile_contents[tile_no])
+
+    engine._create_client = fake_client(create)
+
+    result = engine.recognize_tiled(img_src=make_image_data_url(6000, 1500), user_message="Extract the table.")
+    assert result["data"]["Data Kualitas Air"] == {
+        "Columns": ["ID Kolam", "DOC", "pH", "DO"],
+        "Rows": [["B1", 3, 7.1, 6.0], ["B2", 3, 7.4, 5.5]],
+    }
+
+
+def test_recognize_packed_splits_json_array_per_image():
+    engine, _, requests = make_streaming_engine([])
+    routes = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return completion('```json\n[{"gerbang": "CIKUPA"}, {"gerbang": "BITUNG"}, {"gerbang": "KARAWACI"}]\n```')
+
+    engine._create_client = fake_client(create, routes)
+    img_srcs = [f"data:image/jpeg;base64,/9j/{i}" for i in range(3)]
+
+    result = engine.recognize_packed(img_srcs=img_srcs, user_message="Extract the toll gate.", pack_size=3)
+    assert [r["data"]["gerbang"] for r in result["results"]] == ["CIKUPA", "BITUNG", "KARAWACI"]
+    assert [r["index"] for r in result["results"]] == [0, 1, 2]
+    assert len(requests) == 1 and routes == [False]
+    # One request with all images, in order
+    image_urls = [part["image_url"]["url"] for part in requests[0]["messages"][-1]["content"] if part["type"] == "image_url"]
+    assert image_urls == img_srcs
+    assert [pack["images"] for pack in result["packs"]] == [[0, 1, 2]]
+    assert result["usage"]["total_tokens"] == 110
+
+
+def test_recognize_packed_falls_back_one_by_one():
+    engine, _, requests = make_streaming_engine([])
+    img_srcs = [f"data:image/jpeg;base64,/9j/{i}" for i in range(4)]
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        image_urls = [part["image_url"]["url"] for part in kwargs["messages"][-1]["content"] if part["type"] == "image_url"]
+        if image_urls == img_srcs[:2]:
+            # Short array: one result is missing
+            return completion('[{"gerbang": "CIKUPA"}]')
+        if image_urls == img_srcs[2:]:
+            return completion('[{"gerbang": "BITUNG"}, {"gerbang": ')
+        return completion(f'{{"gerbang": "{img_srcs.index(image_urls[0])}"}}')
+
+    engine._create_client = fake_client(create)
+
+    result = engine.recognize_packed(img_srcs=img_srcs, user_message="Extract the toll gate.", pack_size=2, max_workers=1)
+    assert [r["data"] for r in result["results"]] == [{"gerbang": str(i)} for i in range(4)]
+    # 2 packs, then every image of both on its own
+    assert len(requests) == 6
+    assert [pack["images"] for pack in result["packs"]] == [[0, 1], [2, 3], [0], [1], [2], [3]]
+    assert result["usage"]["total_tokens"] == 6 * 110
+
+
+def test_expired_ocr_text_is_purged_on_put():
+    from AnyOCRTextCache import AnyOCRTextCache
+
+    cache = AnyOCRTextCache(":memory:", retention_seconds=60, purge_interval_seconds=0)
+    grounding = {"lines": [{"text": "NIK : 3515080101900001"}]}
+    cache.put("old", grounding)
+    cache._conn.execute("UPDATE ocr_text SET created_at = created_at - 120 WHERE key = 'old'")
+
+    cache.put("new", grounding)
+    assert cache.stats()["entries"] == 1
+    assert cache.get("new") is not None
+
+
+def test_remote_image_is_downloaded_once_for_the_text_cache(monkeypatch):
+    import AnyOCRDocument
+    from AnyOCRTextCache import AnyOCRTextCache
+
+    downloads = []
+    load_document_bytes = AnyOCRDocument.load_document_bytes
+
+    def fake_load_document_bytes(doc_src, timeout=AnyOCRDocument.DOCUMENT_DOWNLOAD_TIMEOUT):
+        if doc_src.startswith("data:"):
+            return load_document_bytes(doc_src)
+        downloads.append(doc_src)
+        return b"\xff\xd8\xff\xe0 scan"
+
+    monkeypatch.setattr(AnyOCRDocument, "load_document_bytes", fake_load_document_bytes)
+    # With a usage chunk, so the usage isn't estimated over the image
+    usage = SimpleNamespace(prompt_tokens=300, completion_tokens=10, total_tokens=310)
+    engine, _, requests = make_streaming_engine([chunk('{"nik": "123"}'), SimpleNamespace(choices=[], usage=usage)])
+    engine.text_cache = AnyOCRTextCache(":memory:")
+
+    # Sent upstream as the bytes that were hashed
+    engine.recognize(img_src="https://example.com/ktp.jpg", user_message="Extract the NIK.")
+    assert downloads == ["https://example.com/ktp.jpg"]
+    assert requests[-1]["messages"][-1]["content"][1]["image_url"]["url"].startswith("data:image/jpeg;base64,")
+
+    # Neither a lookup nor a put (plain route) can happen: the image is left to upstream
+    engine.recognize(img_src="https://example.com/ktp.jpg", user_message="Extract the NIK.", reuse_ocr_text=False)
+    assert len(downloads) == 1
+    assert requests[-1]["messages"][-1]["content"][1]["image_url"]["url"] == "https://example.com/ktp.jpg"
@@ -0,0 +1,88 @@
+import time
+import pytest
+from AnyOCRLedger import AnyOCRTenantLedger, AnyOCRQuotaExceeded, OCR_LEDGER_ANONYMOUS_TENANT
+
+
+def make_usage(total_tokens, est_cost=0.01):
+    return {"prompt_tokens": total_tokens - 100, "completion_tokens": 100, "total_tokens": total_tokens, "est_cost": est_cost}
+
+
+def test_tenants_are_named_and_unknown_keys_share_anonymous():
+    ledger = AnyOCRTenantLedger(":memory:", tenants={"secret-key": {"name": "team-a", "tokens_per_minute": 500}})
+    assert ledger.tenant_for_key("secret-key") == "team-a"
+    assert ledger.tenant_for_key(None) == OCR_LEDGER_ANONYMOUS_TENANT
+    assert ledger.limits("team-a") == {"minute": 500, "day": None}
+
+    # Unknown keys share one quota, but not their stored results
+    assert ledger.tenant_for_key("other-key") == OCR_LEDGER_ANONYMOUS_TENANT
+    owner = ledger.owner_for_key("other-key")
+    assert owner.startswith("key-") and "other-key" not in owner
+    assert ledger.owner_for_key("secret-key") == "team-a"
+
+
+def test_only_keys_marked_admin_are_admin():
+    ledger = AnyOCRTenantLedger(":memory:", tenants={"ops-key": {"name": "ops", "admin": True}, "secret-key": {"name": "team-a"}})
+    assert ledger.is_admin_key("ops-key")
+    assert not ledger.is_admin_key("secret-key")
+    assert not ledger.is_admin_key("other-key")
+    assert not ledger.is_admin_key(None)
+
+
+def test_null_limits_use_defaults():
+    tenants = {"secret-key": {"name": "team-a", "tokens_per_minute": None, "tokens_per_day": 5000}}
+    ledger = AnyOCRTenantLedger(":memory:", tokens_per_minute=1000, tokens_per_day=100000, tenants=tenants)
+    assert ledger.limits("team-a") == {"minute": 1000, "day": 5000}
+
+
+def test_minute_quota_counts_reservations_and_recorded_usage():
+    ledger = AnyOCRTenantLedger(":memory:", tokens_per_minute=1000)
+    ledger.record("team-a", make_usage(600))
+    reservation_id = ledger.reserve("team-a", 300)
+
+    with pytest.raises(AnyOCRQuotaExceeded) as exceeded:
+        ledger.reserve("team-a", 200)
+    assert exceeded.value.window == "minute"
+    assert exceeded.value.used == 900
+    assert 1 <= exceeded.value.retry_after <= 61
+
+    # Other tenants aren't affected
+    ledger.settle(ledger.reserve("team-b", 900), make_usage(900))
+
+    # The actual usage replaces the estimate
+    ledger.settle(reservation_id, make_usage(250))
+    ledger.settle(ledger.reserve("team-a", 150), None)
+    assert ledger.quota_status("team-a")["minute"] == {"used": 850, "limit": 1000}
+
+
+def test_request_larger_than_quota_is_never_admitted():
+    ledger = AnyOCRTenantLedger(":memory:", tokens_per_day=1000)
+    with pytest.raises(AnyOCRQuotaExceeded) as exceeded:
+        ledger.reserve("team-a", 1500)
+    assert exceeded.value.window == "day"
+    assert exceeded.value.retry_after is None
+
+
+def test_report_per_tenant_and_day():
+    ledger = AnyOCRTenantLedger(":memory:")
+    ledger.record("team-a", make_usage(500, 0.01), "recognize")
+    ledger.record("team-a", make_usage(700, 0.02), "recognize-packed")
+    ledger.record("team-b", make_usage(300, 0.005), "recognize")
+
+    report = ledger.report()
+    assert [entry["tenant"] for entry in report] == ["team-a", "team-b"]
+    assert report[0]["calls"] == 2
+    assert report[0]["total_tokens"] == 1200
+    assert report[0]["est_cost"] == pytest.approx(0.03)
+
+    daily = ledger.report(since=time.time() - 60, tenant="team-b", daily=True)
+    assert len(daily) == 1
+    assert daily[0]["tenant"] == "team-b" and daily[0]["day"]
+
+
+def test_usage_past_retention_is_purged_on_record():
+    ledger = AnyOCRTenantLedger(":memory:", retention_days=1, purge_interval_seconds=0)
+    ledger.record("team-a", make_usage(500))
+    ledger._conn.execute("UPDATE usage SET ts = ts - 2 * 24 * 60 * 60")
+
+    ledger.record("team-a", make_usage(300))
+    assert [entry["total_tokens"] for entry in ledger.report()] == [300]
@@ -0,0 +1,55 @@
+import io
+import json
+import logging
+
+import AnyOCRLogging
+from AnyOCRLogging import setup_logging, stop_logging, log_payload
+
+
+def test_json_lines_are_written_off_thread():
+    stream = io.StringIO()
+    setup_logging("json", payload_sample_rate=1.0, stream=stream)
+    try:
+        logger = logging.getLogger("rich")
+        logger.info("Load prompt from file [bold green]prompts/prompt_json_ktp.md[/].", extra={"markup": True})
+        log_payload(logger, "Recognized", {"status": "OK", "data": {"nik": "123"}}, total_tokens=520)
+        log_payload(logger, "Recognized", {"data": "x" * 10000})
+    finally:
+        stop_logging()
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines[0]["msg"] == "Load prompt from file prompts/prompt_json_ktp.md."
+    assert "markup" not in lines[0]
+    assert lines[1]["payload"] == {"status": "OK", "data": {"nik": "123"}}
+    assert lines[1]["total_tokens"] == 520
+    assert lines[2]["payload_truncated"]
+    assert len(lines[2]["payload"]) == AnyOCRLogging.OCR_LOG_DEFAULT_PAYLOAD_MAX_CHARS
+
+
+def test_payloads_are_sampled():
+    stream = io.StringIO()
+    setup_logging("json", payload_sample_rate=0.0, stream=stream)
+    try:
+        log_payload(logging.getLogger("rich"), "Recognized", {"status": "OK"}, total_tokens=520)
+    finally:
+        stop_logging()
+
+    line = json.loads(stream.getvalue())
+    assert line["msg"] == "Recognized" and line["total_tokens"] == 520
+    assert "payload" not in line
+
+
+def test_exceptions_keep_their_traceback_apart():
+    stream = io.StringIO()
+    setup_logging("json", stream=stream)
+    try:
+        try:
+            raise ValueError("blurry image")
+        except ValueError:
+            logging.getLogger("rich").exception("Recognition of %s failed", "ktp.jpg")
+    finally:
+        stop_logging()
+
+    line = json.loads(stream.getvalue())
+    assert line["msg"] == "Recognition of ktp.jpg failed"
+    assert line["exc"].startswith("Traceback") and "ValueError: blurry image" in line["exc"]
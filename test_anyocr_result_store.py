@@ -0,0 +1,31 @@
+from AnyOCRResultStore import AnyOCRResultStore, AnyOCRIdempotencyState
+
+
+def test_repeated_key_returns_stored_response(tmp_path):
+    store = AnyOCRResultStore(str(tmp_path / "store.db"))
+    assert store.begin("key-1", "fp") == (AnyOCRIdempotencyState.New, None)
+    assert store.begin("key-1", "fp") == (AnyOCRIdempotencyState.InProgress, None)
+
+    response = {"status": "OK", "data": {"nik": "123"}, "usage": {"total_tokens": 554}}
+    store.complete("key-1", response)
+    assert store.begin("key-1", "fp") == (AnyOCRIdempotencyState.Done, response)
+    assert store.begin("key-1", "other-fp") == (AnyOCRIdempotencyState.Mismatch, None)
+
+
+def test_failed_call_can_be_retried(tmp_path):
+    store = AnyOCRResultStore(str(tmp_path / "store.db"))
+    store.begin("key-1", "fp")
+    store.fail("key-1")
+    assert store.begin("key-1", "fp") == (AnyOCRIdempotencyState.New, None)
+
+
+def test_expired_and_abandoned_entries(tmp_path):
+    store = AnyOCRResultStore(str(tmp_path / "store.db"), retention_seconds=0, in_progress_timeout=0)
+    store.begin("key-1", "fp")
+    store.complete("key-1", "plain text response")
+    # Retention of 0 seconds: the stored response is purged and the key can be used again
+    assert store.begin("key-1", "fp")[0] == AnyOCRIdempotencyState.New
+
+    store = AnyOCRResultStore(str(tmp_path / "store2.db"), in_progress_timeout=0)
+    store.begin("key-2", "fp")
+    assert store.begin("key-2", "fp")[0] == AnyOCRIdempotencyState.New
@@ -0,0 +1,39 @@
+from PIL import Image, ImageDraw
+from AnyOCRRouter import AnyOCRTemplateRouter
+
+
+def create_image(path, size, color, stripes):
+    image = Image.new("RGB", size, color)
+    draw = ImageDraw.Draw(image)
+    for i in range(stripes):
+        y = (i + 1) * size[1] // (stripes + 1)
+        draw.rectangle((size[0] // 10, y, size[0] * 9 // 10, y + size[1] // 40), fill="black")
+    image.save(path)
+    return str(path)
+
+
+def test_route_to_best_template(tmp_path):
+    router = AnyOCRTemplateRouter("prompt_sample.md", min_confidence=0.8)
+    router.add_reference("prompt_json_ktp.md", create_image(tmp_path / "ktp.png", (860, 540), (120, 170, 230), 3))
+    router.add_reference("prompt_json_toll.md", create_image(tmp_path / "toll.png", (300, 900), (250, 250, 250), 12))
+
+    prompt_file, confidence = router.route(create_image(tmp_path / "ktp_photo.png", (900, 560), (115, 165, 225), 3))
+    assert prompt_file == "prompt_json_ktp.md"
+    assert confidence >= 0.8
+
+
+def test_route_falls_back_below_threshold(tmp_path):
+    router = AnyOCRTemplateRouter("prompt_sample.md", min_confidence=0.99)
+    router.add_reference("prompt_json_ktp.md", create_image(tmp_path / "ktp.png", (860, 540), (120, 170, 230), 3))
+
+    prompt_file, _ = router.route(create_image(tmp_path / "receipt.png", (300, 900), (250, 250, 250), 12))
+    assert prompt_file == "prompt_sample.md"
+
+
+def test_save_and_load_index(tmp_path):
+    router = AnyOCRTemplateRouter("prompt_sample.md")
+    router.add_reference("prompt_json_ktp.md", create_image(tmp_path / "ktp.png", (860, 540), (120, 170, 230), 3))
+    router.save(tmp_path / "index.json")
+
+    loaded_router = AnyOCRTemplateRouter("prompt_sample.md").load(tmp_path / "index.json")
+    assert loaded_router.index == router.index
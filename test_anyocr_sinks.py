@@ -0,0 +1,64 @@
+import csv
+import json
+import pytest
+
+from AnyOCRSinks import create_sink, flatten_data, AnyOCRCSVSink
+
+POND_REPORT = {
+    "pond": {"name": "Kolam A1", "area_m2": 400},
+    "samples": ["08:00", "16:00"],
+    "water_quality": {
+        "columns": ["Parameter", "Value"],
+        "rows": [["pH", 7.5], ["DO", 5.2, "low"]],
+    },
+}
+
+
+def test_tables_are_exploded_per_cell():
+    records = list(flatten_data(POND_REPORT))
+    assert records[:4] == [
+        ("pond.name", None, None, "Kolam A1"),
+        ("pond.area_m2", None, None, "400"),
+        ("samples[0]", None, None, "08:00"),
+        ("samples[1]", None, None, "16:00"),
+    ]
+    assert records[4:] == [
+        ("water_quality", 0, "Parameter", "pH"),
+        ("water_quality", 0, "Value", "7.5"),
+        ("water_quality", 1, "Parameter", "DO"),
+        ("water_quality", 1, "Value", "5.2"),
+        ("water_quality", 1, "2", "low"),
+    ]
+
+
+def test_sinks_write_in_batches(tmp_path):
+    with create_sink(str(tmp_path / "reports.jsonl"), batch_size=4) as sink:
+        sink.write(POND_REPORT, source="pond_1.jpg", prompt_file="prompts/prompt_json_pond.md")
+        # Full batches are already written, the rest is buffered
+        assert sink.records_written == 8
+    assert sink.records_written == 9
+
+    with open(tmp_path / "reports.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert records[-1] == {
+        "source": "pond_1.jpg",
+        "prompt_file": "prompts/prompt_json_pond.md",
+        "status": "OK",
+        "path": "water_quality",
+        "row": 1,
+        "column": "2",
+        "value": "low",
+    }
+
+    # CSV files are appended to, with a single header
+    for source in ("pond_1.jpg", "pond_2.jpg"):
+        with create_sink(str(tmp_path / "reports.csv")) as sink:
+            assert isinstance(sink, AnyOCRCSVSink)
+            sink.write(POND_REPORT, source=source)
+    with open(tmp_path / "reports.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 18
+    assert rows[9]["source"] == "pond_2.jpg" and rows[9]["path"] == "pond.name"
+
+    with pytest.raises(ValueError):
+        create_sink(str(tmp_path / "reports.xlsx"))
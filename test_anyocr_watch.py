@@ -0,0 +1,128 @@
+import os
+import json
+from types import SimpleNamespace
+from PIL import Image
+
+from AnyOCRCheckpoint import AnyOCRCheckpoint, AnyOCRCheckpointState
+from anyocr_watch import AnyOCRWatcher
+
+CALLS = []
+
+
+class FakeEngine:
+    def recognize(self, **kwargs):
+        CALLS.append(kwargs)
+        self.last_all_content = '```json\n{"nik": "123"}\n```'
+        self.last_usage = SimpleNamespace(prompt_tokens=500, completion_tokens=20, total_tokens=520)
+
+
+def make_scan(file_path, color):
+    Image.new("RGB", (64, 48), color).save(file_path)
+    # Scans older than the settle time are complete
+    os.utime(file_path, (1, 1))
+
+
+def test_checkpoint_is_keyed_by_content(tmp_path):
+    checkpoint = AnyOCRCheckpoint(str(tmp_path / "watch.db"))
+    make_scan(tmp_path / "a.jpg", (200, 0, 0))
+
+    stat = os.stat(tmp_path / "a.jpg")
+    sha256 = checkpoint.file_hash(str(tmp_path / "a.jpg"), stat.st_size, stat.st_mtime)
+    assert checkpoint.get(sha256) is None
+
+    assert checkpoint.start(sha256, str(tmp_path / "a.jpg")) == 1
+    checkpoint.fail(sha256, "timeout")
+    assert checkpoint.start(sha256, str(tmp_path / "a.jpg")) == 2
+    checkpoint.complete(sha256, str(tmp_path / "a.jpg.json"), {"total_tokens": 520})
+
+    entry = checkpoint.get(sha256)
+    assert entry["state"] == AnyOCRCheckpointState.Done
+    assert entry["attempts"] == 2
+    assert entry["usage"] == {"total_tokens": 520}
+
+
+def test_restart_never_recognizes_a_file_again(tmp_path):
+    scans_dir = tmp_path / "scans"
+    scans_dir.mkdir()
+    make_scan(scans_dir / "ktp_1.jpg", (200, 0, 0))
+    make_scan(scans_dir / "ktp_2.png", (0, 200, 0))
+    (scans_dir / "notes.txt").write_text("not a scan")
+
+    def run_watcher():
+        watcher = AnyOCRWatcher(
+            FakeEngine(),
+            [str(scans_dir)],
+            "prompts/prompt_json_ktp.md",
+            AnyOCRCheckpoint(str(tmp_path / "watch.db")),
+            output_dir=str(tmp_path / "results"),
+            workers=2,
+        )
+        watcher.run(once=True)
+        return watcher
+
+    CALLS.clear()
+    watcher = run_watcher()
+    assert len(CALLS) == 2
+    assert watcher.processed == 2 and watcher.total_tokens == 1040
+
+    with open(tmp_path / "results" / "ktp_1.jpg.json") as f:
+        result = json.load(f)
+    assert result["status"] == "OK"
+    assert result["data"] == {"nik": "123"}
+
+    # A copy of a processed scan is done too
+    make_scan(scans_dir / "ktp_1_copy.jpg", (200, 0, 0))
+    run_watcher()
+    assert len(CALLS) == 2
+
+
+def test_sink_failure_never_recognizes_a_file_again(tmp_path):
+    scans_dir = tmp_path / "scans"
+    scans_dir.mkdir()
+    make_scan(scans_dir / "ktp_1.jpg", (200, 0, 0))
+
+    class FullDiskSink:
+        def write(self, data, **fields):
+            raise OSError("No space left on device")
+
+        def flush(self):
+            pass
+
+    def run_watcher(sink=None):
+        watcher = AnyOCRWatcher(
+            FakeEngine(),
+            [str(scans_dir)],
+            "prompts/prompt_json_ktp.md",
+            AnyOCRCheckpoint(str(tmp_path / "watch.db")),
+            output_dir=str(tmp_path / "results"),
+            sink=sink,
+        )
+        watcher.run(once=True)
+        return watcher
+
+    CALLS.clear()
+    watcher = run_watcher(FullDiskSink())
+    assert len(CALLS) == 1
+    assert watcher.processed == 1 and watcher.failed == 0 and watcher.sink_failed == 1
+
+    run_watcher()
+    assert len(CALLS) == 1
+
+
+def test_result_written_before_a_crash_is_picked_up(tmp_path):
+    scans_dir = tmp_path / "scans"
+    scans_dir.mkdir()
+    make_scan(scans_dir / "ktp_1.jpg", (200, 0, 0))
+    checkpoint = AnyOCRCheckpoint(str(tmp_path / "watch.db"))
+    watcher = AnyOCRWatcher(FakeEngine(), [str(scans_dir)], "prompts/prompt_json_ktp.md", checkpoint, output_dir=str(tmp_path / "results"))
+
+    # The previous run wrote the result, then crashed before completing the checkpoint
+    stat = os.stat(scans_dir / "ktp_1.jpg")
+    sha256 = checkpoint.file_hash(str(scans_dir / "ktp_1.jpg"), stat.st_size, stat.st_mtime)
+    checkpoint.start(sha256, str(scans_dir / "ktp_1.jpg"))
+    watcher.write_result(str(scans_dir / "ktp_1.jpg"), {"status": "OK", "data": {"nik": "123"}, "sha256": sha256})
+
+    CALLS.clear()
+    watcher.run(once=True)
+    assert CALLS == []
+    assert checkpoint.get(sha256)["state"] == AnyOCRCheckpointState.Done